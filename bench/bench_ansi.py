@@ -0,0 +1,219 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Benchmark for ansi.parse_ANSI(), which xlogs runs on every line from the server.
+#
+#    PYTHONPATH=core python3 bench/bench_ansi.py [CAPTURE]
+#
+# The text is bench/mud_output.ansi: a few thousand lines in the style of what
+# MUD servers send (channel chatter, room descriptions, combat spam and prompts, with
+# ANSI and xterm256 colours, coloured maps and a colour test pattern.)  It's compared
+# with `legacy_parse_ANSI', the parser as it was before (a copy, below), and both are
+# then given single lines of more and more colour changes, which the legacy parser
+# took quadratic time over.
+#
+# mud_output.ansi is made up, not recorded: a real session can't be shipped without
+# the say-so of everyone whose chatter is in it.  What the parsers' speed depends on
+# is how long the lines are, and how many colour codes of which kinds they have (the
+# numbers are printed first, to compare).  The made-up text has plenty of all of
+# those, down to maps and 256-colour chatter with a code every word or character, the
+# worst of what real servers send.  To measure a real session instead, give the file
+# it's in: everything the server sent, as `nc HOST PORT >CAPTURE' records it.  (Any
+# Telnet negotiation in it is left in the text, which does the parsers no harm.)
+
+import os
+import sys
+import copy
+import time
+
+import ansi
+
+
+# The parser as it was:
+def legacy_parse_ANSI(text):
+    """Decompose a string that contains ANSI color codes into a
+    list of the general form
+    
+       [{'fg': 2}, "text with foreground 2", {}, "text with default colors"]
+    
+    That is to say, contiguous chunks of the string (viewed from the
+    same-color-properties perspective) are stored as strings,
+    and changes in the color properties are stored as a dictionary
+    containing all the color properties that have been set, which affects
+    everything after it until the next dictionary."""
+
+    assert type(text) == str
+
+    state = "TEXT"
+    acc = []
+
+    def accumulate_text(text):
+       if len(acc) == 0 or type(acc[-1]) != str:
+          acc.append(text)
+       else:
+          acc[-1] = acc[-1] + text
+
+    cursor = 0
+    last_colors = {}
+
+    while cursor < len(text):
+       character = text[cursor]
+
+       if state == "TEXT":
+          if character == ansi.ANSI_ESC:
+             state = "ansi.ANSI_ESC"
+          else:
+             # TODO: Grab the whole chunk of text to the next ESC at once
+             accumulate_text(character)
+          cursor += 1
+             
+       elif state == "ansi.ANSI_ESC":
+          if character == "[":
+             state = "ANSI_CSI"
+          elif character == "c":      # ( resets everything )
+             acc.append({})
+             state = "TEXT"
+          elif character in ['X', '_', '^', ']', 'P']:
+             state = "ANSI_STRING_COMMAND"
+          else:
+             # ... we have no idea.
+             # TODO: Should we raise an error here or just fail silently?
+             state = "TEXT"
+
+          cursor += 1
+
+       elif state == "ANSI_STRING_COMMAND":
+          # We just ignore all the string commands.
+          endofstr = text[cursor:].find(ansi.ANSI_ST) + cursor
+          if endofstr == -1:
+             cursor = len(text)
+          else:
+             cursor = endofstr + len(ansi.ANSI_ST)
+
+       elif state == "ANSI_CSI":
+          endofcode = text[cursor:].find('m') + cursor
+          if endofcode == -1:
+             raise ansi.ANSIParsingError("Unbounded CSI")
+
+          codes = text[cursor:endofcode]
+
+          if codes.find(":") != -1:
+             raise ansi.ANSIParsingError("Unspported separator (':') found")
+
+          colors = copy.copy(last_colors)
+
+          xterm256mode = 0
+          xterm256fg_bg = 0
+          for code in codes.split(';'):
+             code = int(code)
+
+             if xterm256mode == 1:
+                if code == 5:
+                   xterm256mode = 2
+                else:
+                   raise ansi.ANSIParsingError("xterm256 color parsing: expected a 5, got {}".format(code))
+
+             elif xterm256mode == 2:
+                if code > 255 or code < 0:
+                   raise ansi.ANSIParsingError("xterm256 color parsing: color {} is out of bounds".format(code))
+
+                if xterm256fg_bg == 38:
+                   colors['fg'] = code
+                elif xterm256fg_bg == 48:
+                   colors['bg'] = code
+                else:
+                   # Theoretically, this should never be reached ... but there's no reason
+                   # not to cover one's bases.
+                   raise ansi.ANSIParsingError("xterm256 color parsing: {} is not 38 or 48".format(xterm256fg_bg))
+
+                xterm256mode = 0
+
+             elif code == 1:
+                colors['bold'] = 1
+
+             elif code == 2:
+                colors['bold'] = 0
+
+             elif code == 7:
+                colors['inverse'] = 1
+
+             elif code == 27:
+                colors['inverse'] = 0
+
+             elif code >= 30 and code <= 37:
+                # Sets foreground color
+                colors['fg'] = code - 30
+
+             elif code >= 40 and code <= 47:
+                # Sets background color
+                colors['bg'] = code - 40
+
+             elif code >= 90 and code <= 97:
+                # Sets intense foreground color (nonstandard)
+                colors['fg'] = code - 90 + 8 # see wikipedia and/or old impl.
+
+             elif code >= 100 and code <= 107:
+                # Sets intense background color (nonstandard)
+                colors['bg'] = code - 100 + 8
+
+             elif code == 38 or code == 48:
+                # Sets an extended xterm256 color
+                xterm256mode = 1
+                xterm256fg_bg = code
+
+             elif code == 0:
+                # Resets attributes
+                for attr in ['fg', 'bg', 'bold', 'inverse']:
+                   if attr in colors:
+                      del colors[attr]
+
+          if colors != last_colors:
+             last_colors = copy.copy(colors)
+             if len(acc) >= 1 and type(acc[-1]) == dict:
+                # update
+                acc[-1] = colors
+             else:
+                acc.append(colors)
+
+          cursor = endofcode + 1
+          state = "TEXT"
+
+    return acc
+
+
+def run(parse, lines, repeat):
+   start = time.perf_counter()
+   for x in range(repeat):
+      for line in lines:
+         try:
+            parse(line)
+         except ansi.ANSIParsingError:
+            pass
+   return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+   if len(sys.argv) > 1:
+      path = sys.argv[1]
+   else:
+      path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mud_output.ansi')
+   with open(path, 'rb') as f:
+      lines = f.read().decode('utf-8', errors='replace').splitlines()
+   size = sum(len(line) for line in lines)
+   codes = [line.count(ansi.ANSI_ESC + "[") for line in lines]
+
+   legacy = run(legacy_parse_ANSI, lines, 3) / 3
+   current = run(ansi.parse_ANSI, lines, 3) / 3
+   print("{}: {} lines, {} characters".format(os.path.basename(path), len(lines), size))
+   print("{:.1f} characters and {:.1f} colour codes per line, {:.0f}% of lines without any".format(
+      size / len(lines), sum(codes) / len(lines), 100 * codes.count(0) / len(lines)))
+   print("{:>8}  {:>12}  {:>8}".format("", "lines/s", "MB/s"))
+   print("{:>8}  {:>12.0f}  {:>8.2f}".format("legacy", len(lines) / legacy, size / legacy / 1e6))
+   print("{:>8}  {:>12.0f}  {:>8.2f}".format("current", len(lines) / current, size / current / 1e6))
+
+   print()
+   print("{:>14}  {:>12}  {:>12}".format("colour changes", "legacy ms", "current ms"))
+   for n in [100, 1000, 10000]:
+      line = ''.join("\x1b[{}m{}".format(31 + x % 7, "#" if x % 2 else ".") for x in range(n)) + "\x1b[0m"
+      print("{:>14}  {:>12.2f}  {:>12.2f}".format(
+         n, run(legacy_parse_ANSI, [line], 1) * 1000, run(ansi.parse_ANSI, [line], 1) * 1000))
+
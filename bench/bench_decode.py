@@ -0,0 +1,105 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Benchmark for turning what a server sends into decoded lines, in different encodings.
+#
+#    PYTHONPATH=core python3 bench/bench_decode.py
+#
+# The text is bench/mud_output.ansi (nearly all ASCII), the same with some of its words
+# swapped for ones with accents (for latin-1 and cp1252, and for utf-8 with characters of
+# more than one byte), and some Japanese and Korean for the CJK encodings.  It arrives
+# RECV_MAX bytes at a time, and every line is asked for its string, as xlogs and the
+# proxy do.  `lazy' is how it used to be done: each line decoded by itself when it's
+# first asked for.  `eager' decodes all the lines from each read together, with
+# bytes.decode() for the encodings in STATELESS_ENCODINGS and the connection's
+# incremental decoder for the others.  (`"decode": "auto"', the default, is lazy for
+# LAZY_ENCODINGS and eager for the rest.)
+#
+# For iso2022_kr, `lazy' gets the wrong answer (that's the `wrong' column): the
+# character set is only named once, at the start, so on its own every line after the
+# first can't be decoded.
+
+import os
+import time
+
+import proxy
+
+
+REPEAT = 10
+
+ACCENTED = {'the': 'thé', 'and': 'ànd', 'of': 'öf', 'in': 'ïn', 'a': 'â'}
+
+JAPANESE = ["市場の広場\r\n",
+            "石畳の広場には屋台が並び、"
+            "港からの風に日よけがはためい"
+            "ている。\r\n",
+            "出口： 西 北 上\r\n",
+            "衛兵が「こんにちは、旅の方」"
+            "と言った。\r\n"]
+
+KOREAN = ["시장 광장\r\n",
+          "자갈 깔린 광장에 노점들이 늘어서 있고, 항구에서 부는 바람에 차양이 펄럭인다.\r\n",
+          "출구: 서 북 위\r\n",
+          "경비병이 \"안녕하시오, 나그네여\" 하고 말했다.\r\n"]
+
+
+def corpus():
+   path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mud_output.ansi')
+   with open(path, 'rb') as f:
+      return f.read().decode('ascii')
+
+
+def accented(text):
+   return ' '.join(ACCENTED.get(word, word) for word in text.split(' '))
+
+
+def run(mode, encoding, data, expected):
+   c = proxy.LineBufferingSocketContainer()
+   c.set_encoding(encoding)
+   c.decode = mode
+
+   lines = 0
+   wrong = 0
+   start = time.perf_counter()
+   for x in range(REPEAT):
+      got = []
+      for i in range(0, len(data), proxy.RECV_MAX):
+         for line in c.feed(data[i:i+proxy.RECV_MAX]):
+            got.append(line.as_str())
+      lines += len(got)
+      if x == 0:
+         wrong = sum(1 for a, b in zip(got, expected) if a != b)
+   elapsed = time.perf_counter() - start
+
+   return (lines / elapsed, len(data) * REPEAT / elapsed / 1e6, wrong)
+
+
+if __name__ == '__main__':
+   ascii_text = corpus()
+   accented_text = accented(ascii_text)
+   japanese_text = ''.join(JAPANESE) * 1000
+   korean_text = ''.join(KOREAN) * 1000
+
+   cases = [('utf-8', ascii_text),
+            ('utf-8', accented_text),
+            ('ascii', ascii_text),
+            ('latin-1', accented_text),
+            ('cp1252', accented_text),
+            ('utf-8', japanese_text),
+            ('shift_jis', japanese_text),
+            ('euc_jp', japanese_text),
+            ('iso2022_jp', japanese_text),
+            ('iso2022_kr', korean_text)]
+
+   print("{:>12}  {:>9}  {:>12}  {:>10}  {:>6}  {:>13}  {:>10}".format(
+      "encoding", "text", "lazy lines/s", "MB/s", "wrong", "eager lines/s", "MB/s"))
+   for encoding, text in cases:
+      kind = {id(ascii_text): 'ascii', id(accented_text): 'accented',
+              id(japanese_text): 'japanese', id(korean_text): 'korean'}[id(text)]
+      data = text.encode(encoding)
+      expected = text.splitlines(True)
+
+      lazy = run('lazy', encoding, data, expected)
+      eager = run('eager', encoding, data, expected)
+      assert eager[2] == 0
+      print("{:>12}  {:>9}  {:>12.0f}  {:>10.1f}  {:>6}  {:>13.0f}  {:>10.1f}".format(
+         encoding, kind, lazy[0], lazy[1], lazy[2], eager[0], eager[1]))
@@ -0,0 +1,125 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Benchmark for handing a line to the handler for its connection's state, with lots of
+# idle clients connected.
+#
+#    PYTHONPATH=core python3 bench/bench_dispatch.py
+#
+# The handlers are swapped for ones that do nothing, so what's timed is just finding
+# the right one.  `legacy_handle_lines' is how Proxy.handle_lines() used to do that:
+# trying each state's list of sockets in turn.  The clients are socketpairs; the last
+# one to connect sends the lines, which was the worst case for the lists.  The
+# `connect+drop' columns time a client going through the states from connection to
+# disconnection.
+
+import socket
+import time
+import logging
+import resource
+import unittest.mock
+import ssl
+
+import proxy
+
+
+LINES = 20000
+CYCLES = 200
+
+
+def legacy_handle_lines(states, s, lines):
+   for line in lines:
+      for state in states:
+         if s in state[0]:
+            result = state[1](s, line)
+            if result:
+               break # to next line
+
+
+def legacy_remove(states, s):
+   for state in states:
+      if s in state[0]:
+         del state[0][state[0].index(s)]
+
+
+def nothing(s, line):
+   return True
+
+
+def make_proxy():
+   proxy.cfg = {'servers': {}, 'warn_about_connections': False}
+   # (There's no need for a password or a certificate to dispatch lines.)
+   with unittest.mock.patch.object(proxy, 'Password'), \
+        unittest.mock.patch.object(ssl.SSLContext, 'load_cert_chain'):
+      p = proxy.Proxy(proxy.cfg)
+   p.setup_clients()
+   p.states = {name: (sockets, nothing) for name, (sockets, handler) in p.states.items()}
+   return p
+
+
+def run(n_clients):
+   p = make_proxy()
+   pairs = [socket.socketpair() for _ in range(n_clients)]
+   for ours, theirs in pairs:
+      p.add_client(ours, None)
+      p.set_state(ours, 'client')
+
+   talker = pairs[-1][0]
+   lines = [proxy.TextLine(b"say Hello there.\r\n", 'utf-8')] * 100
+
+   legacy_states = [(list(p.link_sockets), nothing),
+                    (list(p.server_sockets), nothing),
+                    (list(p.verifying_sockets), nothing),
+                    (list(p.unauthenticated_sockets), nothing),
+                    (list(p.client_sockets), nothing)]
+
+   start = time.perf_counter()
+   for x in range(LINES // len(lines)):
+      legacy_handle_lines(legacy_states, talker, lines)
+   legacy = (time.perf_counter() - start) / LINES
+
+   start = time.perf_counter()
+   for x in range(LINES // len(lines)):
+      p.handle_lines(talker, lines)
+   current = (time.perf_counter() - start) / LINES
+
+   # A client connecting, logging in and leaving again, the old way and the new.
+   ours, theirs = socket.socketpair()
+   start = time.perf_counter()
+   for x in range(CYCLES):
+      legacy_states[3][0].append(ours)
+      legacy_remove(legacy_states, ours)
+      legacy_states[4][0].append(ours)
+      legacy_remove(legacy_states, ours)
+   legacy_cycle = (time.perf_counter() - start) / CYCLES
+
+   p.watch(ours, proxy.LocalClient(ours))
+   start = time.perf_counter()
+   for x in range(CYCLES):
+      p.set_state(ours, 'unauthenticated')
+      p.set_state(ours, 'client')
+      p.set_state(ours, None)
+   current_cycle = (time.perf_counter() - start) / CYCLES
+
+   for a, b in pairs + [(ours, theirs)]:
+      a.close()
+      b.close()
+
+   return (legacy, current, legacy_cycle, current_cycle)
+
+
+if __name__ == '__main__':
+   logging.getLogger().setLevel(logging.WARNING)
+
+   # Two file descriptors per client.
+   soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+   resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+   print("{:>8}  {:>14}  {:>14}  {:>18}  {:>18}".format(
+      "clients", "legacy ns/line", "ns/line", "legacy connect+drop", "connect+drop"))
+   for n in [1, 10, 100, 1000]:
+      if 2 * n + 50 > hard:
+         print("{:>8}  (not enough file descriptors)".format(n))
+         continue
+      legacy, current, legacy_cycle, current_cycle = run(n)
+      print("{:>8}  {:>14.0f}  {:>14.0f}  {:>16.0f}ns  {:>16.0f}ns".format(
+         n, legacy * 1e9, current * 1e9, legacy_cycle * 1e9, current_cycle * 1e9))
@@ -0,0 +1,102 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Benchmark for fanning server lines out to many subscribed clients.
+#
+#    PYTHONPATH=core python3 bench/bench_fanout.py
+#
+# Clients are socketpairs whose far ends get drained between batches.  With a big
+# batch the sockets fill up and output backs up in the proxy, which is where copying
+# hurts most.  `LegacyClient' does what LocalClient.write_line() used to: bytes
+# concatenation into a private buffer and a slice per send().  The `corked' column
+# wraps every TICK lines in OutputCork.cork()/uncork() the way Proxy.run() does.
+
+import socket
+import time
+import logging
+
+import proxy
+
+
+LINES = 5000
+TICK = 50
+
+
+class LegacyClient:
+   def __init__(self, socket):
+      socket.setblocking(False)
+      self.socket = socket
+      self.buf = b''
+
+   def write_line(self, line):
+      self.buf += line.as_bytes()
+      while len(self.buf) > 0 and 10 in self.buf:
+         try:
+            t = self.buf.index(10)
+            n = self.socket.send(self.buf[:t+1])
+            self.buf = self.buf[n:]
+         except BlockingIOError:
+            break
+
+
+def drain(peers):
+   for p in peers:
+      try:
+         while p.recv(1 << 20):
+            pass
+      except BlockingIOError:
+         pass
+
+
+def run(n_subs, mode, batch):
+   legacy = mode == 'legacy'
+   cork = proxy.OutputCork()
+   server = proxy.RemoteServer("localhost", 0, "bench")
+   pairs = [socket.socketpair() for _ in range(n_subs)]
+   peers = []
+
+   for ours, theirs in pairs:
+      theirs.setblocking(False)
+      peers.append(theirs)
+      if legacy:
+         server.subscribers.append(LegacyClient(ours))
+      else:
+         c = proxy.LocalClient(ours)
+         if mode == 'corked':
+            c.cork = cork
+         server.subscribe(c)
+
+   line = proxy.TextLine(b"\x1b[1;32mSomeone says, \"This is a fairly ordinary line of chatter.\"\x1b[0m\r\n", 'utf-8')
+
+   start = time.perf_counter()
+   for x in range(LINES // batch):
+      for y in range(batch):
+         if y % TICK == 0:
+            cork.cork()
+         if legacy:
+            for sub in server.subscribers:
+               sub.write_line(line)
+         else:
+            server.handle_data(line)
+         if y % TICK == TICK - 1:
+            cork.uncork()
+      drain(peers)
+   elapsed = time.perf_counter() - start
+
+   for ours, theirs in pairs:
+      ours.close()
+      theirs.close()
+
+   return LINES / elapsed
+
+
+if __name__ == '__main__':
+   # (flush() logs every time a socket fills up.)
+   logging.getLogger().setLevel(logging.WARNING)
+
+   for batch in [50, 2500]:
+      print("Draining clients every {} lines:".format(batch))
+      print("{:>12}  {:>14}  {:>14}  {:>14}".format("subscribers", "legacy lines/s", "uncorked", "corked"))
+      for n in [1, 5, 10, 25, 50]:
+         print("{:>12}  {:>14.0f}  {:>14.0f}  {:>14.0f}".format(
+            n, run(n, 'legacy', batch), run(n, 'uncorked', batch), run(n, 'corked', batch)))
+      print()
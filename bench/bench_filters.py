@@ -0,0 +1,126 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Benchmark for passing server lines through filters, a batch (one read()'s worth) at a
+# time.
+#
+#    PYTHONPATH=core:. python3 bench/bench_filters.py
+#
+# The filters are the usual ones, scrollback and xlogs (logging to a temporary
+# directory), plus no_curly_quotes and say_quote_strip, which only change what clients
+# send, as if they'd been put on every connection.  `legacy' is what
+# Proxy.handle_line_server() used to do for each line: call every filter's
+# from_server() and hand the line to the subscribers.  `batch' uses the filters'
+# compiled chain, with from_server_batch() where there is one; `adapted' hides that, so
+# the per-line from_server() is called by FilteredSocket.run_filters() instead.  Each
+# number is the best of REPEAT runs, since xlogs' writer thread makes them jump about.
+
+import socket
+import sys
+import time
+import tempfile
+import logging
+import traceback
+
+import proxy
+import plugins.scrollback
+import plugins.xlogs
+import plugins.no_curly_quotes
+import plugins.say_no_end_quotes
+
+
+LINES = 20000
+REPEAT = 5
+
+
+class PerLine:
+   """Shows only the per-line interface of `f'."""
+   def __init__(self, f):
+      self.from_server = f.from_server
+      self.passes_through = getattr(f, 'passes_through', ())
+
+
+def legacy_handle_lines(server, lines):
+   for line in lines:
+      ln = line
+      for f in server.filters:
+         try:
+            ln = f.from_server(ln)
+         except Exception:
+            kind, value, t = sys.exc_info()
+            logging.error("Error applying a server filter: {}".format(repr(value)))
+            logging.error(traceback.format_exc())
+
+         if ln is None:
+            break
+
+      if ln is not None:
+         server.handle_data(ln)
+
+
+def current_handle_lines(server, lines):
+   lines = server.run_filters('from_server', lines)
+   if len(lines) > 0:
+      server.handle_batch(lines)
+
+
+def run(mode, per_read, logdir, verbose=False):
+   server = proxy.RemoteServer("localhost", 0, "bench")
+   server.add_filters([["no_curly_quotes", {}],
+                       ["say_quote_strip", {}],
+                       ["scrollback", {"length": 1000}],
+                       ["xlogs", {"filename": logdir + "/CONNECTION-DATE.xml"}]],
+                      {"no_curly_quotes": plugins.no_curly_quotes.CurlyQuoteFilter,
+                       "say_quote_strip": plugins.say_no_end_quotes.SayQuoteStripper,
+                       "scrollback": plugins.scrollback.MemoryFilter,
+                       "xlogs": plugins.xlogs.LoggingFilter})
+   if mode == 'adapted':
+      server.filters = [PerLine(f) for f in server.filters]
+      server.compile_filters()
+
+   cork = proxy.OutputCork()
+   ours, theirs = socket.socketpair()
+   theirs.setblocking(False)
+   client = proxy.LocalClient(ours)
+   client.cork = cork
+   server.subscribe(client)
+
+   line = proxy.TextLine(b"\x1b[1;32mSomeone says, \"This is a fairly ordinary line of chatter.\"\x1b[0m\r\n", 'utf-8')
+   lines = [line] * per_read
+
+   start = time.perf_counter()
+   for x in range(LINES // per_read):
+      cork.cork()
+      if mode == 'legacy':
+         legacy_handle_lines(server, lines)
+      else:
+         current_handle_lines(server, lines)
+      cork.uncork()
+      try:
+         while theirs.recv(1 << 20):
+            pass
+      except BlockingIOError:
+         pass
+   elapsed = time.perf_counter() - start
+
+   if mode != 'legacy' and per_read == 50 and verbose:
+      for timing in server.filter_timings():
+         print("   ({}) {}".format(mode, timing.describe()))
+
+   for f in plugins.xlogs.open_logs[:]:
+      f.close()
+   ours.close()
+   theirs.close()
+
+   return LINES / elapsed
+
+
+if __name__ == '__main__':
+   logging.getLogger().setLevel(logging.WARNING)
+
+   with tempfile.TemporaryDirectory() as logdir:
+      print("{:>14}  {:>14}  {:>14}  {:>14}".format("lines per read", "legacy lines/s", "batch", "adapted"))
+      for per_read in [1, 10, 50]:
+         best = {mode: max(run(mode, per_read, logdir, x == 0) for x in range(REPEAT))
+                 for mode in ['legacy', 'batch', 'adapted']}
+         print("{:>14}  {:>14.0f}  {:>14.0f}  {:>14.0f}".format(
+            per_read, best['legacy'], best['batch'], best['adapted']))
@@ -0,0 +1,81 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Microbenchmark for the receive path: Telnet stripping plus line splitting.
+#
+#    PYTHONPATH=core python3 bench/bench_read.py
+#
+# `legacy_read' is the byte-at-a-time loop LineBufferingSocketContainer.read() used
+# to run, kept here so there's something to compare against.
+
+import time
+
+import proxy
+import telnet
+
+
+def legacy_read(buf, linesep=proxy.LINE_SEPARATOR):
+   q = []
+   stripped = b''
+   in_command = False
+
+   x = 0
+   while x < len(buf):
+      if in_command:
+         if buf[x] == telnet.IAC:
+            stripped += bytes([telnet.IAC])
+            in_command = False
+         elif buf[x] <= telnet.DONT and buf[x] >= telnet.WILL:
+            pass
+         else:
+            in_command = False
+      else:
+         if buf[x] == telnet.IAC:
+            in_command = True
+         else:
+            stripped += buf[x:x+1]
+      x += 1
+
+   while linesep in stripped:
+      t = stripped.index(linesep)
+      q += [stripped[:t+1]]
+      stripped = stripped[t+1:]
+
+   return q
+
+
+def make_burst(size):
+   """Something that looks like a room description followed by a prompt."""
+   line = b"\x1b[1;33mA long, winding corridor stretches off to the north and south.\x1b[0m\r\n"
+   prompt = b"HP:100/100 MP:50/50 > \xff\xf9\r\n"
+   unit = line * 10 + prompt
+   return (unit * (size // len(unit) + 1))[:size]
+
+
+def time_it(fn, data, repeat):
+   best = None
+   for _ in range(repeat):
+      start = time.perf_counter()
+      fn(data)
+      elapsed = time.perf_counter() - start
+      if best is None or elapsed < best:
+         best = elapsed
+   return len(data) / best / 1e6
+
+
+def new_read(data):
+   c = proxy.LineBufferingSocketContainer()
+   lines = []
+   for x in range(0, len(data), proxy.RECV_MAX):
+      lines += c.feed(data[x:x+proxy.RECV_MAX])
+   return lines
+
+
+if __name__ == '__main__':
+   print("{:>10}  {:>12}  {:>12}".format("burst", "legacy MB/s", "new MB/s"))
+   for size in [4096, 16384, 65536, 262144]:
+      data = make_burst(size)
+      assert [l.as_bytes() for l in new_read(data)] == legacy_read(data)
+
+      legacy = time_it(legacy_read, data, 3 if size <= 65536 else 1)
+      new = time_it(new_read, data, 10)
+      print("{:>10}  {:>12.2f}  {:>12.2f}".format(size, legacy, new))
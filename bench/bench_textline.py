@@ -0,0 +1,143 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Benchmark for what happens to a TextLine on its way through the proxy.
+#
+#    PYTHONPATH=core python3 bench/bench_textline.py
+#
+# The lines are those in bench/mud_output.ansi.  Each goes through what it would meet
+# as a line from the server (xlogs parsing its colours; the test filter looking at it
+# twice) and as a line from a client (the check for a command, then say_quote_strip and
+# no_curly_quotes.)  `LegacyTextLine' is TextLine as it was before (a copy, below),
+# which decoded the line again every time it was asked for the string.
+#
+# `decodes/line' counts how many times the bytes were decoded, `bytes/line' is how much
+# memory is allocated along the way (tracemalloc's peak, so it's what's live at the
+# worst moment), and `object' is the size of the TextLine itself.
+
+import os
+import sys
+import time
+import tracemalloc
+
+import ansi
+import proxy
+
+
+class LegacyTextLine:
+   def __init__(self, string, encoding):
+      assert type(string) == bytes or type(string) == str
+      self.__enc = encoding
+
+      self.set(string)
+
+   def set(self, string):
+      if type(string) == bytes:
+         self.__raw = string
+      else:
+         self.__raw = string.encode(self.__enc)
+
+   def as_str(self):
+      s = ""
+      r = self.__raw
+
+      while len(r) > 0:
+         try:
+            s += r.decode(self.__enc)
+            r = ''
+         except UnicodeDecodeError as e:
+            s += r[:e.start].decode(self.__enc)
+
+            for byte in r[e.start:e.end]:
+               s += '?(' + str(byte) + ')'
+
+            r = r[e.end:]
+
+      return s
+
+   def as_bytes(self):
+      return self.__raw
+
+   def as_spans(self):
+      return ansi.parse_ANSI(self.as_str())
+
+
+decodes = 0
+
+class CountedLegacyTextLine(LegacyTextLine):
+   def as_str(self):
+      global decodes
+      decodes += 1
+      return super().as_str()
+
+class CountedTextLine(proxy.TextLine):
+   __slots__ = ()
+
+   def as_str(self):
+      global decodes
+      if self._TextLine__str is None:
+         decodes += 1
+      return super().as_str()
+
+
+def journey(line_class, data):
+   line = line_class(data, 'utf-8')
+
+   # From the server: xlogs, then the test filter.
+   try:
+      line.as_spans()
+   except ansi.ANSIParsingError:
+      pass
+   line.as_str()
+   line.as_str()
+
+   # From a client: is it a command?  Then say_quote_strip and no_curly_quotes.
+   line.as_str().startswith(proxy.COMMAND_PREFIX)
+   if line.as_str()[:1] == '"':
+      line.as_str().replace("\r\n", "")
+   line.set(line.as_str().replace('’', "'"))
+
+   return line
+
+
+def run(line_class, counted_class, lines):
+   global decodes
+
+   start = time.perf_counter()
+   for data in lines:
+      journey(line_class, data)
+   elapsed = time.perf_counter() - start
+
+   tracemalloc.start()
+   peak = 0
+   for data in lines[:500]:
+      tracemalloc.reset_peak()
+      base = tracemalloc.get_traced_memory()[0]
+      line = journey(line_class, data)
+      peak += tracemalloc.get_traced_memory()[1] - base
+      del line
+   tracemalloc.stop()
+
+   decodes = 0
+   for data in lines:
+      journey(counted_class, data)
+
+   line = line_class(lines[0], 'utf-8')
+   size = sys.getsizeof(line)
+   if hasattr(line, '__dict__'):
+      size += sys.getsizeof(line.__dict__)
+
+   return (len(lines) / elapsed, decodes / len(lines), peak / min(500, len(lines)), size)
+
+
+if __name__ == '__main__':
+   path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mud_output.ansi')
+   with open(path, 'rb') as f:
+      lines = [line + b'\r\n' for line in f.read().split(b'\r\n')]
+   # Some with bytes that aren't UTF-8, as when a server uses another encoding.
+   lines += [line.replace(b'e', b'\xe9') for line in lines[:len(lines) // 10]]
+
+   print("{:>8}  {:>10}  {:>12}  {:>10}  {:>8}".format("", "lines/s", "decodes/line", "bytes/line", "object"))
+   for name, line_class, counted_class in [("legacy", LegacyTextLine, CountedLegacyTextLine),
+                                           ("current", proxy.TextLine, CountedTextLine)]:
+      rate, decoded, allocated, size = run(line_class, counted_class, lines)
+      print("{:>8}  {:>10.0f}  {:>12.1f}  {:>10.0f}  {:>8}".format(name, rate, decoded, allocated, size))
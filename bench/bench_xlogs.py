@@ -0,0 +1,106 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Benchmark for how long logging holds up the thread that's handing out server lines.
+#
+#    PYTHONPATH=core:. python3 bench/bench_xlogs.py
+#
+# Batches of lines from bench/mud_output.ansi go through xlogs' from_server_batch(),
+# into a temporary directory.  `legacy' is how it used to be, writing and flushing the
+# batch there and then (LegacyLoggingFilter, below); `writer' hands it to the LogWriter
+# thread.  The slow disks are simulated by sleeping in every flush(), as if each went
+# over the network.  `lines/s' and `worst call' are for from_server_batch() alone;
+# `drained' is how long until everything was on disk.
+
+import builtins
+import os
+import time
+import tempfile
+import collections
+import logging
+
+import proxy
+from plugins import xlogs
+
+
+LINES = 20000
+PER_READ = 10
+
+
+class SlowFile:
+   """A file that takes `delay' seconds longer to flush."""
+   def __init__(self, f, delay):
+      self.f = f
+      self.delay = delay
+      self.name = f.name
+
+   def write(self, text):
+      return self.f.write(text)
+
+   def flush(self):
+      self.f.flush()
+      time.sleep(self.delay)
+
+   def fileno(self):
+      return self.f.fileno()
+
+   def close(self):
+      self.f.close()
+
+
+class LegacyLoggingFilter(xlogs.LoggingFilter):
+   def send(self, lines):
+      self.filehandle.filehandle.write(self.take_xml())
+      self.filehandle.filehandle.flush()
+
+
+class Connection:
+   name = "bench"
+
+   def __init__(self):
+      self.stats = collections.Counter()
+
+
+def corpus():
+   path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mud_output.ansi')
+   with open(path, 'rb') as f:
+      return [proxy.TextLine(line, 'utf-8') for line in f.read().splitlines(True)]
+
+
+def run(kind, delay, lines, logdir):
+   xlogs.open = lambda *args, **kwargs: SlowFile(builtins.open(*args, **kwargs), delay)
+   impl = LegacyLoggingFilter if kind == 'legacy' else xlogs.LoggingFilter
+   connection = Connection()
+   f = impl(connection, {'filename': logdir + "/CONNECTION-{}-{}.xml".format(kind, delay)})
+   f.server_connect(True)
+
+   batches = [lines[i:i+PER_READ] for i in range(0, len(lines), PER_READ)]
+   batches = (batches * (LINES // len(lines) + 1))[:LINES // PER_READ]
+
+   worst = 0
+   start = time.perf_counter()
+   for batch in batches:
+      t = time.perf_counter()
+      f.from_server_batch(batch)
+      worst = max(worst, time.perf_counter() - t)
+   elapsed = time.perf_counter() - start
+
+   f.server_connect(False)
+   xlogs.teardown(None)
+   drained = time.perf_counter() - start
+
+   del xlogs.open
+   return (LINES / elapsed, worst, drained, connection.stats['xlogs_dropped_lines'])
+
+
+if __name__ == '__main__':
+   logging.getLogger().setLevel(logging.ERROR)
+   lines = corpus()
+
+   with tempfile.TemporaryDirectory() as logdir:
+      print("{:>12}  {:>7}  {:>10}  {:>11}  {:>8}  {:>8}".format(
+         "flush delay", "", "lines/s", "worst call", "drained", "dropped"))
+      for delay in [0, 0.001, 0.005]:
+         for kind in ['legacy', 'writer']:
+            rate, worst, drained, dropped = run(kind, delay, lines, logdir)
+            print("{:>10.0f}ms  {:>7}  {:>10.0f}  {:>9.2f}ms  {:>7.2f}s  {:>8}".format(
+               delay * 1000, kind, rate, worst * 1000, drained, dropped))
@@ -1,159 +1,206 @@
 # vim: ts=3:sw=3:expandtab
 
-import copy
+import re
 
 ANSI_ESC = "\x1B"
 ANSI_ST = "\x1B\\"                                # ST = String Terminator
 
+# Everything that starts with ESC: an SGR or other CSI sequence (ESC [, parameters,
+# intermediate bytes and the final byte that says what it is; only SGR sequences,
+# ending in `m', matter here), the start of a CSI sequence that never ends, a reset (ESC
+# c), a string command (ignored, up to the String Terminator), or anything else (also
+# ignored.)  parse_ANSI() splits lines on these, so the groups come out in between the
+# bits of text.
+_ESCAPES = re.compile(r'\x1b(?:\[([0-?]*)[ -/]*([@-~])|(\[)|(c)|[X_^\]P].*?(?:\x1b\\|\Z)|.?)', re.S)
+
+_ATTRS = ('fg', 'bg', 'bold', 'inverse')
+_PLAIN = (None, None, None, None)   # (fg, bg, bold, inverse); None where unset
+
 class ANSIParsingError(Exception):
    pass
 
+class Colors(dict):
+   """The colour properties in force, as parse_ANSI() hands them out: a dictionary
+   like {'fg': 2, 'bold': 1}.  There's only ever one Colors for each combination,
+   shared between every line that uses it, so they can't be changed."""
+   __slots__ = ()
+
+   def _read_only(self, *args, **kwargs):
+      raise TypeError("Colors can't be changed")
+
+   __setitem__ = __delitem__ = __ior__ = _read_only
+   clear = pop = popitem = setdefault = update = _read_only
+
+   def __hash__(self):
+      return hash(tuple(sorted(self.items())))
+
+   def __copy__(self):
+      return self
+
+   def __deepcopy__(self, memo):
+      return self
+
+   def __reduce__(self):
+      return (dict, (dict(self),))
+
+_interned = {}    # (fg, bg, bold, inverse) -> Colors
+
+def _colors(state):
+   try:
+      return _interned[state]
+   except KeyError:
+      colors = Colors((attr, value) for attr, value in zip(_ATTRS, state) if value is not None)
+      _interned[state] = colors
+      return colors
+
+PLAIN = _colors(_PLAIN)
+
+# What each SGR sequence does to each state it's been seen in, since it's mostly the
+# same few over and over.
+_sgr_cache = {}
+_SGR_CACHE_MAX = 4096
+
+def _apply_SGR(state, params):
+   """The state after the SGR (`ESC [ params m') sequence."""
+   if ':' in params:
+      raise ANSIParsingError("Unspported separator (':') found")
+
+   fg, bg, bold, inverse = state
+
+   xterm256mode = 0
+   xterm256fg_bg = 0
+   for code in params.split(';'):
+      if code == '':
+         code = 0    # (`ESC [ m' is a reset)
+      else:
+         try:
+            code = int(code)
+         except ValueError:
+            raise ANSIParsingError("Bad SGR parameter {}".format(repr(code)))
+
+      if xterm256mode == 1:
+         if code == 5:
+            xterm256mode = 2
+         else:
+            raise ANSIParsingError("xterm256 color parsing: expected a 5, got {}".format(code))
+
+      elif xterm256mode == 2:
+         if code > 255 or code < 0:
+            raise ANSIParsingError("xterm256 color parsing: color {} is out of bounds".format(code))
+
+         if xterm256fg_bg == 38:
+            fg = code
+         else:
+            bg = code
+
+         xterm256mode = 0
+
+      elif code == 0:
+         # Resets attributes
+         fg = bg = bold = inverse = None
+
+      elif code == 1:
+         bold = 1
+
+      elif code == 2:
+         bold = 0
+
+      elif code == 7:
+         inverse = 1
+
+      elif code == 27:
+         inverse = 0
+
+      elif code >= 30 and code <= 37:
+         # Sets foreground color
+         fg = code - 30
+
+      elif code >= 40 and code <= 47:
+         # Sets background color
+         bg = code - 40
+
+      elif code >= 90 and code <= 97:
+         # Sets intense foreground color (nonstandard)
+         fg = code - 90 + 8 # see wikipedia and/or old impl.
+
+      elif code >= 100 and code <= 107:
+         # Sets intense background color (nonstandard)
+         bg = code - 100 + 8
+
+      elif code == 38 or code == 48:
+         # Sets an extended xterm256 color
+         xterm256mode = 1
+         xterm256fg_bg = code
+
+   return (fg, bg, bold, inverse)
+
 def parse_ANSI(text):
-    """Decompose a string that contains ANSI color codes into a
-    list of the general form
-    
-       [{'fg': 2}, "text with foreground 2", {}, "text with default colors"]
-    
-    That is to say, contiguous chunks of the string (viewed from the
-    same-color-properties perspective) are stored as strings,
-    and changes in the color properties are stored as a dictionary
-    containing all the color properties that have been set, which affects
-    everything after it until the next dictionary."""
-
-    assert type(text) == str
-
-    state = "TEXT"
-    acc = []
-
-    def accumulate_text(text):
-       if len(acc) == 0 or type(acc[-1]) != str:
-          acc.append(text)
-       else:
-          acc[-1] = acc[-1] + text
-
-    cursor = 0
-    last_colors = {}
-
-    while cursor < len(text):
-       character = text[cursor]
-
-       if state == "TEXT":
-          if character == ANSI_ESC:
-             state = "ANSI_ESC"
-          else:
-             # TODO: Grab the whole chunk of text to the next ESC at once
-             accumulate_text(character)
-          cursor += 1
-             
-       elif state == "ANSI_ESC":
-          if character == "[":
-             state = "ANSI_CSI"
-          elif character == "c":      # ( resets everything )
-             acc.append({})
-             state = "TEXT"
-          elif character in ['X', '_', '^', ']', 'P']:
-             state = "ANSI_STRING_COMMAND"
-          else:
-             # ... we have no idea.
-             # TODO: Should we raise an error here or just fail silently?
-             state = "TEXT"
-
-          cursor += 1
-
-       elif state == "ANSI_STRING_COMMAND":
-          # We just ignore all the string commands.
-          endofstr = text[cursor:].find(ANSI_ST) + cursor
-          if endofstr == -1:
-             cursor = len(text)
-          else:
-             cursor = endofstr + len(ANSI_ST)
-
-       elif state == "ANSI_CSI":
-          endofcode = text[cursor:].find('m') + cursor
-          if endofcode == -1:
-             raise ANSIParsingError("Unbounded CSI")
-
-          codes = text[cursor:endofcode]
-
-          if codes.find(":") != -1:
-             raise ANSIParsingError("Unspported separator (':') found")
-
-          colors = copy.copy(last_colors)
-
-          xterm256mode = 0
-          xterm256fg_bg = 0
-          for code in codes.split(';'):
-             code = int(code)
-
-             if xterm256mode == 1:
-                if code == 5:
-                   xterm256mode = 2
-                else:
-                   raise ANSIParsingError("xterm256 color parsing: expected a 5, got {}".format(code))
-
-             elif xterm256mode == 2:
-                if code > 255 or code < 0:
-                   raise ANSIParsingError("xterm256 color parsing: color {} is out of bounds".format(code))
-
-                if xterm256fg_bg == 38:
-                   colors['fg'] = code
-                elif xterm256fg_bg == 48:
-                   colors['bg'] = code
-                else:
-                   # Theoretically, this should never be reached ... but there's no reason
-                   # not to cover one's bases.
-                   raise ANSIParsingError("xterm256 color parsing: {} is not 38 or 48".format(xterm256fg_bg))
-
-                xterm256mode = 0
-
-             elif code == 1:
-                colors['bold'] = 1
-
-             elif code == 2:
-                colors['bold'] = 0
-
-             elif code == 7:
-                colors['inverse'] = 1
-
-             elif code == 27:
-                colors['inverse'] = 0
-
-             elif code >= 30 and code <= 37:
-                # Sets foreground color
-                colors['fg'] = code - 30
-
-             elif code >= 40 and code <= 47:
-                # Sets background color
-                colors['bg'] = code - 40
-
-             elif code >= 90 and code <= 97:
-                # Sets intense foreground color (nonstandard)
-                colors['fg'] = code - 90 + 8 # see wikipedia and/or old impl.
-
-             elif code >= 100 and code <= 107:
-                # Sets intense background color (nonstandard)
-                colors['bg'] = code - 100 + 8
-
-             elif code == 38 or code == 48:
-                # Sets an extended xterm256 color
-                xterm256mode = 1
-                xterm256fg_bg = code
-
-             elif code == 0:
-                # Resets attributes
-                for attr in ['fg', 'bg', 'bold', 'inverse']:
-                   if attr in colors:
-                      del colors[attr]
-
-          if colors != last_colors:
-             last_colors = copy.copy(colors)
-             if len(acc) >= 1 and type(acc[-1]) == dict:
-                # update
-                acc[-1] = colors
-             else:
-                acc.append(colors)
-
-          cursor = endofcode + 1
-          state = "TEXT"
-
-    return acc
+   """Decompose a string that contains ANSI color codes into a
+   list of the general form
+
+      [{'fg': 2}, "text with foreground 2", {}, "text with default colors"]
+
+   That is to say, contiguous chunks of the string (viewed from the
+   same-color-properties perspective) are stored as strings,
+   and changes in the color properties are stored as a dictionary
+   (a Colors) containing all the color properties that have been set, which affects
+   everything after it until the next dictionary."""
+
+   assert type(text) == str
+
+   if ANSI_ESC not in text:
+      return [text] if len(text) > 0 else []
+
+   acc = []
+   state = _PLAIN
+
+   pieces = iter(_ESCAPES.split(text))
+   pending = [next(pieces)]   # text since the last change of colors
+
+   for params, final, unbounded, reset, after in zip(pieces, pieces, pieces, pieces, pieces):
+      if final == 'm':
+         key = (state, params)
+         try:
+            new = _sgr_cache[key]
+         except KeyError:
+            new = _apply_SGR(state, params)
+            if len(_sgr_cache) >= _SGR_CACHE_MAX:
+               _sgr_cache.clear()
+            _sgr_cache[key] = new
+
+         if new != state:
+            state = new
+            text = ''.join(pending)
+            if len(text) > 0:
+               acc.append(text)
+               acc.append(_colors(state))
+            elif len(acc) >= 1 and type(acc[-1]) is Colors:
+               # update
+               acc[-1] = _colors(state)
+            else:
+               acc.append(_colors(state))
+            pending = []
+
+      elif unbounded is not None:
+         raise ANSIParsingError("Unbounded CSI")
+
+      elif reset is not None:
+         # ( resets everything )
+         state = _PLAIN
+         text = ''.join(pending)
+         if len(text) > 0:
+            acc.append(text)
+         acc.append(PLAIN)
+         pending = []
+
+      # (Other CSI sequences, string commands and escapes we have no idea about are
+      # just dropped.)
+
+      if len(after) > 0:
+         pending.append(after)
+
+   text = ''.join(pending)
+   if len(text) > 0:
+      acc.append(text)
+
+   return acc
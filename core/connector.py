@@ -0,0 +1,464 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Connecting to remote servers without blocking the main loop.
+#
+# A ConnectionManager looks up a server's addresses (on a thread, since getaddrinfo()
+# blocks, with the answers cached for a while), then races connections to them "happy
+# eyeballs" style (RFC 8305): it starts on the first address, and if that hasn't
+# worked out after a short delay, starts on the next as well, alternating between
+# IPv6 and IPv4; the first to connect wins.  The TLS handshake, if there is one, is
+# done the same non-blocking way.  The whole thing has a time limit.  When it's done
+# it hands the socket to the proxy, or, if it failed (or the connection is lost
+# later), tries again after a delay that doubles each time.  A connection that's lost
+# soon after it was made counts as a failed attempt too.
+#
+# The manager doesn't run an event loop itself; it asks `engine' (the Proxy) for what
+# it needs:
+#
+#    engine.call_later(delay, callback, *args)     -> something with a cancel() method
+#    engine.call_soon_threadsafe(callback, *args)
+#    engine.watch_fd(sock, events, callback)       (callback(sock, mask), selectors.EVENT_*)
+#    engine.unwatch_fd(sock)
+#    engine.connection_ready(server, sock)
+#
+# and tells it nothing else.  Per-server numbers go in `server.stats' and
+# `server.latency' (a dict of LatencyHistogram's, or anything with an add(seconds).)
+#
+# Each server with TLS has its own ResumingContext (`server.tls_context'), made once
+# at startup by make_tls_context(), which keeps the server's last TLS session so that
+# reconnecting can skip most of the handshake.
+
+import os
+import socket
+import ssl
+import selectors
+import errno
+import logging
+import random
+import time
+import concurrent.futures
+
+
+DNS_TTL = 300 # seconds to remember what a host name resolved to
+CONNECT_TIMEOUT = 30 # seconds, for resolving, connecting and the TLS handshake together
+HAPPY_EYEBALLS_DELAY = 0.25 # seconds before trying the next address as well
+RECONNECT_DELAY = 2 # seconds before the first reconnection attempt
+RECONNECT_MAX_DELAY = 300 # seconds; the delay doubles up to this
+STABLE_AFTER = 30 # seconds a connection has to last before it doesn't count as a failure
+
+
+class DNSCache:
+   """Remembers getaddrinfo() answers for `ttl' seconds."""
+   def __init__(self, ttl=DNS_TTL):
+      self.ttl = ttl
+      self.entries = {}   # (host, port) -> (addresses, when they expire)
+
+   def get(self, host, port, now=None):
+      """The cached addresses for (host, port), or None if there aren't any (fresh ones.)"""
+      if now is None:
+         now = time.monotonic()
+
+      entry = self.entries.get((host, port))
+      if entry is None:
+         return None
+      if entry[1] <= now:
+         del self.entries[(host, port)]
+         return None
+      return entry[0]
+
+   def put(self, host, port, addresses, now=None):
+      if now is None:
+         now = time.monotonic()
+      self.entries[(host, port)] = (addresses, now + self.ttl)
+
+
+def interleave(addresses):
+   """Order getaddrinfo() results the way RFC 8305 suggests: alternate between address
+   families, starting with whichever came first."""
+   by_family = {}
+   for a in addresses:
+      by_family.setdefault(a[0], []).append(a)
+
+   queues = list(by_family.values())
+   result = []
+   while len(queues) > 0:
+      for q in queues:
+         result.append(q.pop(0))
+      queues = [q for q in queues if len(q) > 0]
+   return result
+
+
+def backoff_delay(failures, initial=RECONNECT_DELAY, maximum=RECONNECT_MAX_DELAY):
+   """How long to wait before the next attempt after `failures' failed ones in a row:
+   doubling each time, up to `maximum', and randomized a little so that lots of
+   servers dropped at once don't all come back at once."""
+   delay = min(maximum, initial * (2 ** min(failures, 32)))
+   return delay * random.uniform(0.5, 1.0)
+
+
+class ResumingContext(ssl.SSLContext):
+   """An SSLContext for connecting to one server.  It offers the last session it was
+   given (see ConnectionManager.remember_session()) on every new connection, however
+   the connection is made: wrap_socket() is what the selectors loop uses, and
+   wrap_bio() is what asyncio uses."""
+   session = None
+   resume = True
+
+   def wrap_socket(self, sock, **kwargs):
+      if kwargs.get('session') is None and self.resume:
+         kwargs['session'] = self.session
+      return super().wrap_socket(sock, **kwargs)
+
+   def wrap_bio(self, incoming, outgoing, **kwargs):
+      if kwargs.get('session') is None and self.resume:
+         kwargs['session'] = self.session
+      return super().wrap_bio(incoming, outgoing, **kwargs)
+
+
+def make_tls_context(verify=False, ca_file=None, resume=True):
+   """Make a ResumingContext for a server.  Unless `verify' is set, the server's
+   certificate isn't checked at all.  That's insecure and bad, but plenty of MUDs don't
+   have a certificate that would pass.  With `verify', it's checked against `ca_file',
+   or the system's certificates if that's not given."""
+   context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+   if verify:
+      if ca_file is not None:
+         context.load_verify_locations(ca_file)
+      else:
+         context.load_default_certs()
+   else:
+      context.check_hostname = False
+      context.verify_mode = ssl.CERT_NONE
+   context.resume = resume
+   return context
+
+
+class Attempt:
+   """One try at connecting to a server, from looking up its name to finishing the
+   TLS handshake."""
+   def __init__(self, server):
+      self.server = server
+      self.started = time.monotonic()
+      self.addresses = []
+      self.connect_started = None
+      self.sockets = []      # connects in progress
+      self.next_timer = None
+      self.timeout_timer = None
+      self.tls_socket = None
+      self.tls_started = None
+      self.errors = []
+      self.finished = False
+
+
+class ConnectionManager:
+   def __init__(self, engine, cfg):
+      self.engine = engine
+      self.cfg = cfg
+      self.dns = DNSCache(cfg.get('dns_ttl', DNS_TTL))
+      self.resolver = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+      # With the asyncio engine, the TLS handshake is left to the loop; see
+      # AsyncioProxy.connection_ready().
+      self.handshake_tls = True
+
+      self.attempts = {}         # server -> Attempt in progress
+      self.reconnect_timers = {} # server -> timer for its next attempt
+      self.failures = {}         # server -> failed attempts in a row
+      self.connected_at = {}     # server -> when its current connection was made
+
+   def setting(self, server, name, default):
+      """A per-server setting, or the global one, or `default'."""
+      return server.settings.get(name, self.cfg.get(name, default))
+
+   def connecting(self, server):
+      """Whether there's an attempt to connect to `server' under way."""
+      return server in self.attempts
+
+   def connect(self, server):
+      """Start connecting to `server', unless it's already connected or connecting.
+      Returns whether it did."""
+      if server.connected or self.connecting(server):
+         return False
+
+      timer = self.reconnect_timers.pop(server, None)
+      if timer is not None:
+         timer.cancel()
+
+      logging.info("Starting to connect to server {}:{}.".format(server.host, server.port))
+
+      attempt = Attempt(server)
+      self.attempts[server] = attempt
+      server.stats['connect_attempts'] += 1
+
+      attempt.timeout_timer = self.engine.call_later(
+         self.setting(server, 'connect_timeout', CONNECT_TIMEOUT), self.time_out, attempt)
+
+      addresses = self.dns.get(server.host, server.port)
+      if addresses is not None:
+         server.stats['dns_cache_hits'] += 1
+         self.resolved(attempt, addresses)
+      else:
+         server.stats['dns_cache_misses'] += 1
+         future = self.resolver.submit(socket.getaddrinfo, server.host, server.port,
+                                       0, socket.SOCK_STREAM)
+         future.add_done_callback(
+            lambda f: self.engine.call_soon_threadsafe(self.lookup_done, attempt, f))
+
+      return True
+
+   def lookup_done(self, attempt, future):
+      if attempt.finished:
+         return
+
+      server = attempt.server
+      try:
+         addresses = future.result()
+      except OSError as e:
+         self.fail(attempt, "couldn't look up {}: {}".format(server.host, e))
+         return
+
+      server.latency['dns'].add(time.monotonic() - attempt.started)
+      self.dns.put(server.host, server.port, addresses)
+      self.resolved(attempt, addresses)
+
+   def resolved(self, attempt, addresses):
+      attempt.addresses = interleave(addresses)
+      attempt.connect_started = time.monotonic()
+      self.try_next(attempt)
+
+   def try_next(self, attempt):
+      """Start connecting to the next address, and set a timer to start on the one after
+      that if this one's slow."""
+      if attempt.next_timer is not None:
+         attempt.next_timer.cancel()
+         attempt.next_timer = None
+
+      while len(attempt.addresses) > 0:
+         family, kind, proto, canonname, address = attempt.addresses.pop(0)
+         sock = None
+         try:
+            sock = socket.socket(family, kind, proto)
+            sock.setblocking(False)
+            err = sock.connect_ex(address)
+         except OSError as e:
+            if sock is not None:
+               sock.close()
+            attempt.errors.append(str(e))
+            continue
+
+         if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            attempt.errors.append(os_error_text(err))
+            continue
+
+         attempt.sockets.append(sock)
+         self.engine.watch_fd(sock, selectors.EVENT_WRITE,
+                              lambda s, mask: self.connect_done(attempt, s))
+
+         if len(attempt.addresses) > 0:
+            attempt.next_timer = self.engine.call_later(
+               self.setting(attempt.server, 'happy_eyeballs_delay', HAPPY_EYEBALLS_DELAY),
+               self.try_next, attempt)
+         return
+
+      # Nothing left to try.
+      if len(attempt.sockets) == 0:
+         self.fail(attempt, "; ".join(attempt.errors) or "no addresses")
+
+   def connect_done(self, attempt, sock):
+      """Called when a connecting socket is writable, i.e. it's connected or it's failed."""
+      if sock not in attempt.sockets:
+         return # given up on earlier in the same pass through the loop
+
+      self.engine.unwatch_fd(sock)
+      attempt.sockets.remove(sock)
+
+      err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if err != 0:
+         sock.close()
+         attempt.errors.append(os_error_text(err))
+         # Don't wait for the timer to try the next one.
+         if len(attempt.sockets) == 0:
+            self.try_next(attempt)
+         return
+
+      # We have a winner; forget the rest.
+      if attempt.next_timer is not None:
+         attempt.next_timer.cancel()
+         attempt.next_timer = None
+      self.close_sockets(attempt)
+
+      server = attempt.server
+      server.latency['connect'].add(time.monotonic() - attempt.connect_started)
+
+      if server.use_SSL and self.handshake_tls:
+         self.start_tls(attempt, sock)
+      else:
+         self.succeed(attempt, sock)
+
+   def start_tls(self, attempt, sock):
+      try:
+         attempt.tls_socket = attempt.server.tls_context.wrap_socket(
+            sock, server_hostname=attempt.server.host, do_handshake_on_connect=False)
+      except (ssl.SSLError, OSError) as e:
+         sock.close()
+         self.fail(attempt, "SSL error: {}".format(e))
+         return
+
+      attempt.tls_started = time.monotonic()
+      self.continue_tls(attempt)
+
+   def continue_tls(self, attempt):
+      sock = attempt.tls_socket
+      if sock is None:
+         return
+      try:
+         sock.do_handshake()
+
+      except ssl.SSLWantReadError:
+         self.engine.watch_fd(sock, selectors.EVENT_READ, lambda s, mask: self.continue_tls(attempt))
+         return
+
+      except ssl.SSLWantWriteError:
+         self.engine.watch_fd(sock, selectors.EVENT_WRITE, lambda s, mask: self.continue_tls(attempt))
+         return
+
+      except (ssl.SSLError, OSError) as e:
+         self.engine.unwatch_fd(sock)
+         attempt.tls_socket = None
+         sock.close()
+         self.fail(attempt, "SSL error: {}".format(e))
+         return
+
+      self.engine.unwatch_fd(sock)
+      attempt.tls_socket = None
+      self.tls_done(attempt.server, attempt.tls_started, sock)
+      self.succeed(attempt, sock)
+
+   def tls_done(self, server, started, ssl_object):
+      """Note how long a TLS handshake with `server' took, and whether it resumed an
+      old session.  `ssl_object' is the SSLSocket or SSLObject."""
+      elapsed = time.monotonic() - started
+      if ssl_object.session_reused:
+         server.stats['tls_resumed'] += 1
+         server.latency['tls_resumed'].add(elapsed)
+      else:
+         server.stats['tls_full_handshakes'] += 1
+         server.latency['tls_handshake'].add(elapsed)
+      self.remember_session(server, ssl_object)
+
+   def remember_session(self, server, ssl_object):
+      """Keep `ssl_object''s session to offer next time.  (With TLS 1.3 the session
+      only turns up some time after the handshake, so it's worth calling this again
+      when the connection closes.)"""
+      if ssl_object is None or not isinstance(server.tls_context, ResumingContext):
+         return
+      session = ssl_object.session
+      if session is not None:
+         server.tls_context.session = session
+
+   def resumption_savings(self, server):
+      """Roughly how many milliseconds resuming sessions has saved, going by the
+      average full handshake with `server'; None if there's nothing to go on."""
+      full = server.latency.get('tls_handshake')
+      resumed = server.latency.get('tls_resumed')
+      if full is None or resumed is None or full.n == 0 or resumed.n == 0:
+         return None
+      return resumed.n * (full.total / full.n - resumed.total / resumed.n)
+
+   def succeed(self, attempt, sock):
+      server = attempt.server
+      self.finish(attempt)
+      server.latency['total'].add(time.monotonic() - attempt.started)
+      self.connected_at[server] = time.monotonic()
+      self.engine.connection_ready(server, sock)
+
+   def fail(self, attempt, reason):
+      server = attempt.server
+      self.finish(attempt)
+      server.stats['connect_failures'] += 1
+      server.warn_all("Connection attempt failed: {}".format(reason))
+      self.failed(server)
+
+   def failed(self, server):
+      """Called when trying to connect to `server' didn't work out, however far it got."""
+      self.failures[server] = self.failures.get(server, 0) + 1
+      self.schedule_reconnect(server)
+
+   def time_out(self, attempt):
+      attempt.server.stats['connect_timeouts'] += 1
+      if attempt.tls_socket is not None:
+         self.engine.unwatch_fd(attempt.tls_socket)
+         attempt.tls_socket.close()
+         attempt.tls_socket = None
+      self.fail(attempt, "timed out")
+
+   def finish(self, attempt):
+      """Clean up after `attempt', which is over, one way or another."""
+      attempt.finished = True
+      for timer in (attempt.next_timer, attempt.timeout_timer):
+         if timer is not None:
+            timer.cancel()
+      attempt.next_timer = attempt.timeout_timer = None
+      self.close_sockets(attempt)
+      if self.attempts.get(attempt.server) is attempt:
+         del self.attempts[attempt.server]
+
+   def close_sockets(self, attempt):
+      for sock in attempt.sockets:
+         self.engine.unwatch_fd(sock)
+         sock.close()
+      attempt.sockets = []
+
+   def connection_lost(self, server):
+      """Called when an established connection to `server' goes away.  One that didn't
+      last `stable_after' seconds counts as a failure, so that a server that accepts
+      and then hangs up straight away is backed off from like any other."""
+      since = self.connected_at.pop(server, None)
+      if since is not None and \
+         time.monotonic() - since < self.setting(server, 'stable_after', STABLE_AFTER):
+         server.stats['short_connections'] += 1
+         self.failed(server)
+         return
+
+      self.failures.pop(server, None)
+      self.schedule_reconnect(server)
+
+   def schedule_reconnect(self, server):
+      if not self.setting(server, 'reconnect', True) or not server.listened_to():
+         return
+      if server in self.reconnect_timers:
+         return
+
+      delay = backoff_delay(self.failures.get(server, 0),
+                            self.setting(server, 'reconnect_delay', RECONNECT_DELAY),
+                            self.setting(server, 'reconnect_max_delay', RECONNECT_MAX_DELAY))
+      server.warn_all("Reconnecting in {:.1f} seconds.".format(delay))
+      self.reconnect_timers[server] = self.engine.call_later(delay, self.reconnect, server)
+
+   def reconnect(self, server):
+      del self.reconnect_timers[server]
+
+      # Nobody's listening any more; don't bother.
+      if not server.listened_to():
+         self.failures.pop(server, None)
+         return
+
+      server.stats['reconnects'] += 1
+      self.connect(server)
+
+   def shutdown(self):
+      """Stop the resolver's threads (when the proxy is quitting), dropping any lookups
+      that haven't started."""
+      try:
+         self.resolver.shutdown(wait=False, cancel_futures=True)
+      except TypeError:
+         # (Before Python 3.9, which lets it cancel them; any left still get looked up.)
+         self.resolver.shutdown(wait=False)
+
+
+def os_error_text(err):
+   try:
+      return "{} ({})".format(errno.errorcode[err], os.strerror(err))
+   except (KeyError, ValueError):
+      return "error {}".format(err)
@@ -0,0 +1,112 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Passing live sockets, and whatever we know about them, to a new proxy process (see
+# Proxy.hot_restart().)  The old process starts the new one with one end of a Unix
+# socketpair, whose file descriptor number it puts in the environment variable named by
+# HANDOFF_ENV, and sends it one message: a length, with the sockets' file descriptors
+# attached (SCM_RIGHTS), followed by that many bytes of JSON describing them.  The new
+# process answers with ACK once it's taken over.
+#
+# The JSON can hold bytes (as {"__bytes__": base64}); sets and tuples come out as lists.
+#
+# Under systemd (with `Type=notify'; see README.md), the new process tells it, before
+# answering, that it's the service's main process now, so that the old one can quit
+# without the whole service being taken for stopped.
+
+import os
+import socket
+import struct
+import array
+import json
+import base64
+import logging
+
+
+HANDOFF_ENV = 'TCPHYDRA_HANDOFF_FD'
+HANDOFF_TIMEOUT = 30 # seconds the old process waits for the new one
+ACK = b'ok'
+
+NOTIFY_ENV = 'NOTIFY_SOCKET'   # set by systemd for a Type=notify service
+
+MAX_FDS = 250 # per message; Linux allows 253 (SCM_MAX_FD)
+
+_HEADER = struct.Struct('!Q')
+
+
+def _encode(obj):
+   if isinstance(obj, (bytes, bytearray, memoryview)):
+      return {'__bytes__': base64.b64encode(bytes(obj)).decode('ascii')}
+   if isinstance(obj, (set, frozenset)):
+      return sorted(obj)
+   raise TypeError("Can't hand off a {}".format(type(obj).__name__))
+
+
+def _decode(d):
+   if len(d) == 1 and '__bytes__' in d:
+      return base64.b64decode(d['__bytes__'])
+   return d
+
+
+def dumps(state):
+   return json.dumps(state, default=_encode).encode('utf-8')
+
+
+def loads(data):
+   return json.loads(data.decode('utf-8'), object_hook=_decode)
+
+
+def send(sock, state, fds):
+   """Send `state' and the file descriptors `fds' (a list of ints) over the Unix socket
+   `sock', which should be blocking (with a timeout, preferably.)"""
+   if len(fds) > MAX_FDS:
+      raise ValueError("Too many sockets to hand off ({})".format(len(fds)))
+
+   data = dumps(state)
+   ancillary = []
+   if len(fds) > 0:
+      ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+
+   sock.sendmsg([_HEADER.pack(len(data))], ancillary)
+   sock.sendall(data)
+
+
+def receive(sock):
+   """Receive what send() sent.  Returns `(state, fds)'."""
+   fds = array.array('i')
+   header, ancillary, flags, address = sock.recvmsg(
+      _HEADER.size, socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+
+   for level, kind, data in ancillary:
+      if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+         fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+
+   if len(header) != _HEADER.size:
+      raise ConnectionError("Handoff message cut short")
+
+   length = _HEADER.unpack(header)[0]
+   data = bytearray()
+   while len(data) < length:
+      chunk = sock.recv(min(length - len(data), 1048576))
+      if len(chunk) == 0:
+         raise ConnectionError("Handoff message cut short")
+      data += chunk
+
+   return (loads(bytes(data)), list(fds))
+
+
+def notify_systemd(message):
+   """Send systemd's service manager `message' (e.g. "READY=1"; see sd_notify(3)), if
+   it's listening; otherwise do nothing."""
+   path = os.environ.get(NOTIFY_ENV)
+   if not path:
+      return
+
+   if path[0] == '@':
+      path = '\0' + path[1:]   # (an abstract socket)
+
+   try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+         sock.connect(path)
+         sock.sendall(message.encode('utf-8'))
+   except OSError as e:
+      logging.warning("Couldn't tell systemd {}: {}".format(repr(message), e))
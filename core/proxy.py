@@ -2,20 +2,23 @@
 
 # 'Telnet' multiplexer for MUDs, etc. Python 3.
 
-# Things we should be doing someday:
-#  - actually understand the underlying protocols (Telnet) instead of just stripping
-#    them out
-
 import sys
 import threading
 import logging
 import traceback
+import time
+import heapq
 
 import socket
 import ssl
 import selectors
+import asyncio
 
 import json
+import zlib
+import codecs
+import collections
+import concurrent.futures
 
 import os
 import hashlib
@@ -24,8 +27,18 @@ import base64
 
 import pkgutil
 import importlib
+import subprocess
 
 import ansi
+import telnet
+import connector
+import handoff
+import shard
+
+try:
+   import uvloop
+except ImportError:
+   uvloop = None
 
 
 CONFIG_FILE = 'config.json'
@@ -40,10 +53,22 @@ MESSAGE_PREFIX_OK = '%% '
 MESSAGE_PREFIX_ERR = '!! '
 
 RECV_MAX = 4096 # bytes
+SEND_MAX = 262144 # bytes per send() or sendmsg() call, at most
+SEND_CHUNKS_MAX = 512 # buffers per sendmsg() call, at most (IOV_MAX is usually 1024)
 
 # (defaults; change in config.json)
 BIND_TO_HOST = "localhost"
 BIND_TO_PORT = 1234
+CLIENT_HIGH_WATER = 1048576 # bytes of output allowed to back up for one client
+
+TLS_HANDSHAKE_TIMEOUT = 10 # seconds a client gets to finish the TLS handshake
+AUTH_WORKERS = 2 # threads checking passwords
+AUTH_ATTEMPTS_PER_MINUTE = 6 # per address (with a burst of up to this many)
+MAX_HELD_LINES = 100 # lines kept from a client while its password is checked
+FILTER_WORKERS = 2 # threads running server filters marked `"offload": true'
+OFFLOAD_HIGH_WATER = 5000 # lines from one world allowed to wait for those
+
+OVERFLOW_POLICIES = ['drop_oldest', 'disconnect', 'pause']
 
 # We want cfg to be global, but not to load it on module import.
 cfg = None
@@ -154,61 +179,208 @@ class Password:
 ###
 
 
+# How TextLine.as_str() shows bytes that aren't valid in the line's encoding: as their
+# numbers, like `?(255)'.
+DECODE_ERRORS = 'tcphydra-byte-numbers'
+
+def _show_byte_numbers(error):
+   return (''.join(['?(' + str(byte) + ')' for byte in error.object[error.start:error.end]]),
+           error.end)
+
+codecs.register_error(DECODE_ERRORS, _show_byte_numbers)
+
+# Encodings where a newline byte is always a newline and never part of some other
+# character, and where a line means the same thing whatever came before it.  A run of
+# whole lines in one of these can be decoded with bytes.decode(); anything else (like
+# ISO-2022-KR, which says which character set it'll be shifting into only once, at the
+# start) goes through its connection's own incremental decoder, in the order it arrived.
+STATELESS_ENCODINGS = ('utf-8', 'ascii', 'iso8859-1', 'cp1252')
+
+# Encodings Python decodes without having to look up a codec, quickly enough that a line
+# at a time costs no more than decoding a read's worth of lines together and splitting
+# them up again (see bench/bench_decode.py.)
+LAZY_ENCODINGS = ('utf-8', 'ascii', 'iso8859-1')
+
+# How a connection turns what it reads into strings (the `decode' setting for each
+# server in config.json):
+#    eager:  all the lines a read() completes are decoded together, as they come in.
+#    lazy:   each line is decoded by itself the first time something asks for it, which
+#            costs nothing for lines nobody looks at, but doesn't work for stateful
+#            encodings.
+#    auto:   lazy for LAZY_ENCODINGS, eager for everything else.
+DECODE_MODES = ('auto', 'eager', 'lazy')
+
+
 class TextLine:
    """An abstract container for lines of text.  This seemed like an important
-   design element at one point, but it may not be nearly as important now."""
-   def __init__(self, string, encoding):
+   design element at one point, but it may not be nearly as important now.
+
+   The decoded string and the parsed ANSI colours are worked out the first time
+   they're asked for, and kept until the line is set() to something else, since
+   several filters (and the proxy) usually want them."""
+   __slots__ = ('__enc', '__raw', '__str', '__spans')
+
+   def __init__(self, string, encoding, decoded=None):
+      """`decoded' is `string' (bytes) already decoded, if the caller has it."""
       assert type(string) == bytes or type(string) == str
       self.__enc = encoding
 
       self.set(string)
+      if decoded is not None:
+         self.__str = decoded
 
    def set(self, string):
       """(Temporary method for testing.)"""
       if type(string) == bytes:
          self.__raw = string
+         self.__str = None
       else:
          self.__raw = string.encode(self.__enc)
+         self.__str = string
+      self.__spans = None
 
    def as_str(self):
       """Try to 'safely', but lossily, decode the raw line into an ordinary string,
       according to the encoding given."""
-      s = ""
-      r = self.__raw
+      if self.__str is None:
+         self.__str = self.__raw.decode(self.__enc, DECODE_ERRORS)
+      return self.__str
 
-      while len(r) > 0:
-         try:
-            s += r.decode(self.__enc)
-            r = ''
-         except UnicodeDecodeError as e:
-            s += r[:e.start].decode(self.__enc)
+   def as_bytes(self):
+      return self.__raw
 
-            for byte in r[e.start:e.end]:
-               s += '?(' + str(byte) + ')'
+   def as_spans(self):
+      """The line as ansi.parse_ANSI() breaks it down (line ending and all.)  Don't
+      change the list.  Can raise ansi.ANSIParsingError."""
+      if self.__spans is None:
+         self.__spans = ansi.parse_ANSI(self.as_str())
+      return self.__spans
 
-            r = r[e.end:]
 
-      return s
+class OutputQueue:
+   """Bytes waiting to go out on a socket.  They're kept as the chunks that were
+   written instead of being copied into one big buffer, and the chunks themselves are
+   never modified, so the same bytes object can sit in any number of queues at once
+   (see RemoteServer.handle_data.)  All a queue owns is its list of references and a
+   cursor into the first one."""
+   def __init__(self):
+      self.chunks = collections.deque()
+      self.offset = 0   # how much of chunks[0] has been sent already
+      self.size = 0     # bytes waiting, in total
+
+   def __len__(self):
+      return self.size
+
+   def append(self, data):
+      if len(data) > 0:
+         self.chunks.append(data)
+         self.size += len(data)
+
+   def peek(self):
+      """The first unsent bytes (not necessarily all of them.)"""
+      if self.offset == 0:
+         return self.chunks[0]
+      return memoryview(self.chunks[0])[self.offset:]
+
+   def peek_many(self, max_chunks, max_bytes):
+      """Views of the first unsent chunks, as many as fit within the limits (but always
+      at least one.)"""
+      views = [self.peek()]
+      total = len(views[0])
+      for x in range(1, min(max_chunks, len(self.chunks))):
+         chunk = self.chunks[x]
+         total += len(chunk)
+         if total > max_bytes:
+            break
+         views.append(chunk)
+      return views
+
+   def advance(self, n_bytes):
+      """Mark `n_bytes' from the front of the queue as sent."""
+      self.size -= n_bytes
+      if self.offset == 0 and n_bytes == len(self.chunks[0]):
+         self.chunks.popleft()
+         return
+      n_bytes += self.offset
+      while n_bytes > 0 and n_bytes >= len(self.chunks[0]):
+         n_bytes -= len(self.chunks.popleft())
+      self.offset = n_bytes
+
+   def clear(self):
+      self.chunks.clear()
+      self.offset = 0
+      self.size = 0
+
+
+class OutputCork:
+   """While corked, writes to the connections sharing this object are only queued, and
+   the connections are remembered; uncork() then flushes each of them once.  The main
+   loop corks before handling a batch of events and uncorks when it's done, so a burst
+   of lines goes out in one send() per connection instead of one per line."""
+   def __init__(self):
+      self.corked = False
+      self.pending = set()
 
-   def as_bytes(self):
-      return self.__raw
+   def cork(self):
+      self.corked = True
+
+   def hold(self, c):
+      """Remember that `c' has output waiting to be flushed at uncork()."""
+      self.pending.add(c)
+
+   def uncork(self):
+      self.corked = False
+
+      pending = self.pending
+      self.pending = set()
+
+      for c in pending:
+         if c.connected:
+            c.end_tick()
+            c.flush()
 
 
 class LineBufferingSocketContainer:
    """A base class that helps handle reading from and writing to a socket.  The
-   I/O is buffered to lines, and telnet control codes (i.e. IAC ...) are dropped.
-   (Thus this class only works with servers that are willing to play dumb.  But
-   that's most servers, luckily for us.)"""
+   I/O is buffered to lines.  Telnet control codes (i.e. IAC ...) are taken out of the
+   text by a telnet.TelnetCodec, which refuses every option unless told otherwise;
+   subclasses see what it found through handle_telnet()."""
    def __init__(self, socket = None):
-      self.__b_send_buffer = b''
-      self.__b_recv_buffer = b''
+      self.__send_queue = OutputQueue()
+      self.__b_send_partial = bytearray()  # written, but waiting for the end of its line
+      self.__unconfirmed = 0  # bytes at the front of the queue an SSL write is stuck on
+      self.__b_recv_buffer = bytearray()
+
+      self.telnet = telnet.TelnetCodec()
+      self.decompressor = None   # zlib.decompressobj while MCCP2 is on (incoming)
+      self.compressor = None     # zlib.compressobj while MCCP2 is on (outgoing)
+      self.compress_flush = 'line'
+      self.compress_pending = False
+
+      self.stats = collections.Counter()
+
+      self.cork = None   # an OutputCork shared by every connection, if any
+      self.gather = False
+      self.blocked = False
+
+      # Whoever runs the event loop (the Proxy) hears about changes in what this
+      # connection is waiting for, and about too much output piling up, through
+      # `watcher'.  See Proxy.update_events() and Proxy.output_overflow().
+      self.watcher = None
+      self.sel_events = 0        # what the watcher's selector is watching the socket for
+      self.state = None          # which of the watcher's states it's in (see Proxy.set_state)
+      self.write_interest = False
+      self.high_water = None     # bytes of queued output that count as too many
+      self.overflowed = False
 
       self.connected = False
 
       self.socket = None
+      self.transport = None   # set instead of a real socket under the asyncio engine
 
-      self.encoding = ENCODING
       self.linesep = LINE_SEPARATOR
+      self.decode = 'auto'    # see DECODE_MODES
+      self.set_encoding(ENCODING)
 
       if socket != None:
          self.attach_socket(socket)
@@ -217,46 +389,223 @@ class LineBufferingSocketContainer:
       """Write a string to the underlying socket."""
       assert type(data) == str
 
-      self.__b_send_buffer += data.encode(self.encoding)
+      self.__queue(telnet.escape(data.encode(self.encoding)))
 
-      self.flush()
+      self.__kick()
 
    def write_line(self, line):
       """Write a TextLine to the underlying socket."""
       assert type(line) == TextLine
 
-      self.__b_send_buffer += line.as_bytes()
+      self.__queue(telnet.escape(line.as_bytes()))
 
-      self.flush()
+      self.__kick()
 
    def write(self, data):
       """Write some bytes to the underlying socket."""
       assert type(data) == bytes
 
-      self.__b_send_buffer += data
+      self.__queue(telnet.escape(data))
+
+      self.__kick()
+
+   def write_segment(self, data):
+      """Write bytes that are already encoded and escaped.  They're queued as they are,
+      without being copied, so one bytes object can be handed to many connections."""
+      if self.compressor is None and len(self.__b_send_partial) == 0:
+         self.__send_queue.append(data)
+      else:
+         self.__queue(data)
+
+      self.__kick()
+
+   def write_telnet(self, data):
+      """Write some raw Telnet commands to the underlying socket.  Unlike the other
+      write methods, this doesn't wait for the end of a line."""
+      self.__queue(data, commit=True)
+
+      if self.connected:
+         self.__kick()
 
-      self.flush()
+   def __kick(self):
+      """Flush now, or at the end of the tick if output is corked."""
+      if self.cork is not None and self.cork.corked:
+         self.cork.hold(self)
+      else:
+         self.end_tick()
+         self.flush()
+
+      if self.high_water is not None and not self.overflowed \
+         and self.__send_queue.size > self.high_water:
+         self.overflowed = True
+         if self.watcher is not None:
+            self.watcher.output_overflow(self)
+
+   def pending_output(self):
+      """How many bytes are queued up to be sent (including any an asyncio transport is
+      still holding.)"""
+      if self.transport is not None:
+         return self.__send_queue.size + self.transport.get_write_buffer_size()
+      return self.__send_queue.size
+
+   def drop_oldest(self, keep):
+      """Throw away whole chunks of queued output, oldest first, until no more than `keep'
+      bytes are left.  Returns how many bytes were dropped.  Nothing can be dropped from
+      a compressed stream without breaking it, so then this does nothing.  (Nor can
+      anything that's already been handed to an asyncio transport.)"""
+      if self.compressor is not None:
+         return 0
+
+      queue = self.__send_queue
+      dropped = 0
+
+      # Chunks that are partly on the wire already, or that an SSL write is still trying
+      # to send, have to stay.
+      first = 0
+      covered = -queue.offset
+      while first < len(queue.chunks) and (covered < 0 or covered < self.__unconfirmed):
+         covered += len(queue.chunks[first])
+         first += 1
+
+      while queue.size > keep and len(queue.chunks) > first:
+         chunk = queue.chunks[first]
+         del queue.chunks[first]
+         queue.size -= len(chunk)
+         dropped += len(chunk)
+
+      return dropped
+
+   def want_read(self):
+      """Whether the socket should be watched for incoming data right now."""
+      return True
+
+   def __queue(self, data, commit=False):
+      """Add `data' to the send buffer, compressing it first if MCCP2 is on.  With
+      `commit', it (and everything before it) goes out without waiting for the end of
+      a line."""
+      if self.compressor is not None:
+         self.stats['mccp_out_raw_bytes'] += len(data)
+         data = self.compressor.compress(data)
+         if commit or self.compress_flush == 'line':
+            data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.compress_pending = False
+         else:
+            self.compress_pending = True
+         self.stats['mccp_out_compressed_bytes'] += len(data)
+
+         # Compressed data doesn't have lines in it any more.
+         commit = True
+
+      partial = self.__b_send_partial
+
+      if commit:
+         if len(partial) > 0:
+            self.__send_queue.append(bytes(partial))
+            partial.clear()
+         self.__send_queue.append(data)
+
+      elif len(partial) == 0 and len(data) > 0 and data[-1] == self.linesep:
+         # The usual case: a whole line (or several.)
+         self.__send_queue.append(data)
+
+      else:
+         partial += data
+         t = partial.rfind(self.linesep)
+         if t != -1:
+            self.__send_queue.append(bytes(partial[:t+1]))
+            del partial[:t+1]
+
+   def start_compression(self, flush='line'):
+      """Compress everything sent from now on (the other end must already know this is
+      coming.)  With `flush' set to 'line' the compressor is flushed after every write;
+      with 'tick' it's only flushed when end_tick() is called."""
+      self.compressor = zlib.compressobj()
+      self.compress_flush = flush
+      self.compress_pending = False
+
+   def stop_compression(self):
+      """Finish the compressed stream; anything sent after this goes out plain."""
+      if self.compressor is not None:
+         data = self.compressor.flush(zlib.Z_FINISH)
+         self.stats['mccp_out_compressed_bytes'] += len(data)
+         self.compressor = None
+         self.write_telnet(data)
+
+   def end_tick(self):
+      """Called when the output of one pass through the main loop is complete, just
+      before it's flushed."""
+      if self.compressor is not None and self.compress_pending:
+         self.compress_pending = False
+         data = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+         self.stats['mccp_out_compressed_bytes'] += len(data)
+         self.__send_queue.append(data)
+
+   def send_subnegotiation(self, option, payload):
+      """Send IAC SB `option' `payload' IAC SE to the other end."""
+      self.telnet.send_subnegotiation(option, payload)
+      self.write_telnet(self.telnet.take_output())
 
    def flush(self):
-      """Send as much buffered input as the socket will allow, but only attempt to
-      do so up to the end of the last complete line."""
+      """Send as much queued output as the socket will allow.  (Only whole lines, Telnet
+      commands and compressed data get queued; the end of an unfinished line waits until
+      the rest of it is written.)"""
       assert self.socket != None
       assert self.connected
 
-      while len(self.__b_send_buffer) > 0 and self.linesep in self.__b_send_buffer:
+      queue = self.__send_queue
+
+      if self.transport is not None:
+         # The transport does its own buffering (and tells us, through the protocol,
+         # when too much of it piles up.)  Nothing in the queue has been sent yet, so
+         # all of it can go.
+         if queue.size > 0:
+            self.transport.writelines(queue.chunks)
+            queue.clear()
+         return
+
+      while queue.size > 0:
          try:
-            t = self.__b_send_buffer.index(self.linesep)
-            n_bytes = self.socket.send(self.__b_send_buffer[:t+1])
-            self.__b_send_buffer = self.__b_send_buffer[n_bytes:]
+            if not self.gather:
+               # SSL sockets can't do scatter/gather, but one big write still beats
+               # lots of little ones.  If the last write didn't go through, SSL insists
+               # that the retry starts with the same bytes and is no shorter; since the
+               # queue only grows at the end, gathering the same way again does that.
+               if len(queue.chunks) == 1:
+                  data = queue.peek()
+               else:
+                  data = b''.join(queue.peek_many(SEND_CHUNKS_MAX, SEND_MAX))
+               self.__unconfirmed = len(data)
+               n_bytes = self.socket.send(data)
+               self.__unconfirmed = 0
+            elif len(queue.chunks) == 1 or self.blocked:
+               # (If the socket was full last time, see if it's got room before going
+               # to the trouble of gathering everything up.)
+               n_bytes = self.socket.send(queue.peek())
+               self.blocked = False
+            else:
+               n_bytes = self.socket.sendmsg(queue.peek_many(SEND_CHUNKS_MAX, SEND_MAX))
+            queue.advance(n_bytes)
 
          except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
-            logging.info("Note: BlockingIOError in flush() call")
+            logging.debug("Note: BlockingIOError in flush() call")
+            self.blocked = True
             break
 
          except OSError:
             logging.error("Got an OSError in flush() call")
             break
 
+      # If anything's left, ask to hear when the socket has room for it.
+      if (queue.size > 0) != self.write_interest:
+         self.write_interest = queue.size > 0
+         if self.watcher is not None:
+            self.watcher.update_events(self)
+
+      if self.overflowed and queue.size <= self.high_water // 2:
+         self.overflowed = False
+         if self.watcher is not None:
+            self.watcher.output_drained(self)
+
    def read(self):
       """Read as much data as the socket will provide.  Returns a pair like `([list of TextLine's or empty],
       found_eof?)'.  If found_eof? is true, the connection has probably died."""
@@ -264,12 +613,12 @@ class LineBufferingSocketContainer:
       assert self.socket != None
 
       has_eof = False
+      q = []
 
       try:
-         data = b''
          while True:
             data = self.socket.recv(RECV_MAX)
-            self.__b_recv_buffer += data
+            q += self.feed(data)
             if len(data) < RECV_MAX:
                # If the length of data returned by a read() call is 0, that actually means the
                # remote side closed the connection.  If there's actually no data to be read,
@@ -277,85 +626,191 @@ class LineBufferingSocketContainer:
                if len(data) == 0:
                   has_eof = True
                break
-            data = b''
 
       except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
          pass
 
+      except ConnectionResetError:
+         has_eof = True
+
       except OSError:
          logging.error("Got an OSError in read() call")
 
-      except ConnectionResetError:
+      except zlib.error as e:
+         logging.error("Bad MCCP stream, dropping connection: {}".format(e))
          has_eof = True
 
-      q = []
-
-      # Telnet codes are a problem.  TODO: Improve this super hacky solution, which just involves
-      # ... completely removing them from the input stream (except for IAC IAC / 255 255.)
+      return (q, has_eof)
 
-      stripped = b''
+   def feed(self, data):
+      """Take some bytes just received from the socket and return a list of the
+      TextLine's they complete.  Anything left over (a partial line, or a partial Telnet
+      command) is kept around for the next call.  Can raise zlib.error if the other end
+      sends a broken MCCP stream."""
+      while len(data) > 0:
+         if self.decompressor is not None:
+            chunk = self.decompress(data)
+            data = b''
+            if self.decompressor.eof:
+               # The compressed stream ended; whatever came after it is plain again.
+               data = self.decompressor.unused_data
+               self.stats['mccp_compressed_bytes'] -= len(data)
+               self.decompressor = None
+         else:
+            chunk = data
+            data = b''
 
-      IAC = 255
-      DONT = 254
-      DO = 253
-      WONT = 252
-      WILL = 251
+         text, events = self.telnet.feed(chunk)
+         self.__b_recv_buffer += text
 
-      in_command = False
+         if self.telnet.consumed < len(chunk):
+            # We stopped after a subnegotiation that changes what the rest looks like.
+            data = chunk[self.telnet.consumed:] + data
 
-      # Speaking of awful hacks, this is probably not very efficient at all:
+         for event in events:
+            # (Only if MCCP2 has been agreed; a stray `IAC SB COMPRESS2 IAC SE' from
+            # anyone else mustn't turn the rest of their stream into zlib.)
+            if type(event) is telnet.Subnegotiation and event.option == telnet.COMPRESS2 \
+               and telnet.COMPRESS2 in self.telnet.remote and self.decompressor is None:
+               logging.info("Starting MCCP2 decompression.")
+               self.decompressor = zlib.decompressobj()
 
-      x = 0
-      while x < len(self.__b_recv_buffer):
-         if in_command:
-            if self.__b_recv_buffer[x] == IAC:
-               stripped += bytes([IAC])
-               in_command = False
-            elif self.__b_recv_buffer[x] <= DONT and self.__b_recv_buffer[x] >= WILL:
-               pass
-            else:
-               # TODO: Figure out if there are Telnet codes that will be baffled by this
-               # (are they all guaranteed to be 2 bytes long except for IAC <DODONTWILLWONT> XYZ?)
-               in_command = False
-         else:
-            if self.__b_recv_buffer[x] == IAC:
-               in_command = True
-            else:
-               stripped += self.__b_recv_buffer[x:x+1]
-         x += 1
+         if len(events) > 0:
+            self.handle_telnet(events)
+         if len(self.telnet.output) > 0:
+            self.write_telnet(self.telnet.take_output())
 
       # The best we can do for a record separator in this case is a byte or byte sequence that
       # means 'newline'. We go with one byte for now for simplicity & because it works with
       # UTF-8/ASCII at least, which comprises most things we're interested in.
 
-      while self.linesep in stripped:
-         t = stripped.index(self.linesep)
-         q += [TextLine(stripped[:t+1], self.encoding)]
-         stripped = stripped[t+1:]
-
-      self.__b_recv_buffer = stripped
-
-      # Make sure it starts in in_command mode again next time around in case the read() call
-      # left us in the middle of a command, which I don't think is *likely* but could happen.
-      # (The rest of the command will get tacked on after the IAC, which will ensure
-      # the thing goes back into command mode immediately prior.)
-
-      if in_command:
-         self.__b_send_buffer += bytes([IAC])
-
-      return (q, has_eof)
+      buf = self.__b_recv_buffer
+      raw = []
+      start = 0
+      text = None
+
+      with memoryview(buf) as view:
+         t = buf.find(self.linesep)
+         while t != -1:
+            raw.append(bytes(view[start:t+1]))
+            start = t + 1
+            t = buf.find(self.linesep, start)
+
+         if start > 0 and (self.decode == 'eager' or
+                           (self.decode == 'auto' and self.codec not in LAZY_ENCODINGS)):
+            text = self.decode_bytes(view[:start])
+
+      if start > 0:
+         del buf[:start]
+
+      encoding = self.encoding
+      if text is not None:
+         # (splitlines() is quickest, but it splits on more than just newlines.)
+         decoded = text.splitlines(True)
+         if len(decoded) == len(raw):
+            return [TextLine(line, encoding, s) for line, s in zip(raw, decoded)]
+         sep = chr(self.linesep)
+         decoded = text.split(sep)
+         if len(decoded) == len(raw) + 1:
+            return [TextLine(line, encoding, s + sep) for line, s in zip(raw, decoded)]
+
+      return [TextLine(line, encoding) for line in raw]
+
+   def set_encoding(self, encoding):
+      """Decode what comes in as `encoding' from now on.  Raises LookupError if there's
+      no such encoding."""
+      info = codecs.lookup(encoding)
+      self.encoding = encoding
+      self.codec = info.name
+      if info.name in STATELESS_ENCODINGS:
+         self.decoder = None
+      else:
+         self.decoder = info.incrementaldecoder(DECODE_ERRORS)
+
+   def decode_bytes(self, data):
+      """Decode `data', some whole lines that have just come in."""
+      if self.decoder is None:
+         return str(data, self.encoding, DECODE_ERRORS)
+      return self.decoder.decode(data)
+
+   def make_line(self, data):
+      """Make a TextLine of `data' (bytes) in this connection's encoding."""
+      return TextLine(data, self.encoding)
+
+   def save_state(self):
+      """What a new process needs to carry on with this connection (see
+      Proxy.hot_restart()), as plain data; or None if it can't, because it's in the
+      middle of an MCCP stream (whose state zlib can't hand over.)"""
+      if self.decompressor is not None or self.compressor is not None:
+         return None
+
+      queue = self.__send_queue
+      unsent = b''.join(queue.peek_many(len(queue.chunks), queue.size)) if queue.size > 0 else b''
+
+      return {'telnet': self.telnet.save_state(),
+              'recv_buffer': bytes(self.__b_recv_buffer),
+              'send_queue': unsent,
+              'send_partial': bytes(self.__b_send_partial),
+              'decoder': self.decoder.getstate() if self.decoder is not None else None,
+              'stats': dict(self.stats)}
+
+   def restore_state(self, state):
+      """Carry on from a state saved by save_state() (after attach_socket().)"""
+      self.telnet.restore_state(state['telnet'])
+      self.__b_recv_buffer = bytearray(state['recv_buffer'])
+      self.__b_send_partial = bytearray(state['send_partial'])
+      self.__send_queue.append(state['send_queue'])
+      if self.decoder is not None and state.get('decoder') is not None:
+         self.decoder.setstate(tuple(state['decoder']))
+      self.stats.update(state['stats'])
+
+   def decompress(self, data):
+      chunk = self.decompressor.decompress(data)
+      self.stats['mccp_compressed_bytes'] += len(data)
+      self.stats['mccp_decompressed_bytes'] += len(chunk)
+      return chunk
+
+   def accept_compression(self):
+      """Let the other end compress what it sends us with MCCP2."""
+      self.telnet.supported_remote.add(telnet.COMPRESS2)
+      self.telnet.interrupt_after.add(telnet.COMPRESS2)
+
+   def handle_telnet(self, events):
+      """Called with the list of events (see telnet.py) whenever a read turns up Telnet
+      commands.  Does nothing by default."""
+      pass
 
    def attach_socket(self, socket):
-      """Set up `self' to work with `socket'."""
-      socket.setblocking(False)
+      """Set up `self' to work with `socket', which can also be an asyncio transport."""
+      if isinstance(socket, asyncio.BaseTransport):
+         self.transport = socket
+         self.gather = False
+      else:
+         socket.setblocking(False)
+         self.transport = None
+         self.gather = hasattr(socket, 'sendmsg') and not isinstance(socket, ssl.SSLSocket)
       self.socket = socket
       self.connected = True
 
+      # Nothing about the last connection carries over.
+      self.telnet.reset()
+      self.decompressor = None
+      self.compressor = None
+      self.__b_recv_buffer = bytearray()
+      if self.decoder is not None:
+         # (A new decoder, since reset() doesn't forget ISO-2022's designations.)
+         self.set_encoding(self.encoding)
+
    def handle_disconnect(self):
       """Call this function when the remote end closed the connection to nullify and
       make false the appropriate variables."""
       self.socket = None
+      self.transport = None
       self.connected = False
+      self.write_interest = False
+      self.overflowed = False
+      self.blocked = False
+      self.__unconfirmed = 0
 
 
 class FilterSpecificationError(Exception):
@@ -364,6 +819,42 @@ class FilterSpecificationError(Exception):
    pass
 
 
+def log_filter_error(method):
+   kind, value, t = sys.exc_info()
+   logging.error("Error applying a {} filter: {}".format(
+      'server' if method == 'from_server' else 'client', repr(value)))
+   logging.error(traceback.format_exc())
+
+
+# The hooks a filter may have besides from_server/from_client, which FilteredSocket
+# makes a list of when the filters are added.
+FILTER_HOOKS = ['server_connect', 'client_connect', 'telnet_event']
+
+FILTER_TIMING_EVERY = 16 # run_filters() times one batch in this many
+
+
+class FilterTiming:
+   """How many lines one filter on a connection has been given, and how long it took.
+   (Only for the batches that were timed; see FilteredSocket.run_filters().)"""
+   def __init__(self, name, method):
+      self.name = name
+      self.method = method
+      self.calls = 0
+      self.lines = 0
+      self.seconds = 0.0
+
+   def add(self, lines, seconds):
+      self.calls += 1
+      self.lines += lines
+      self.seconds += seconds
+
+   def describe(self):
+      """A one-line summary."""
+      return "filter {} ({}): {} lines in {} timed batches, {:.1f}us per line".format(
+         self.name, self.method, self.lines, self.calls,
+         1e6 * self.seconds / self.lines if self.lines > 0 else 0)
+
+
 class FilteredSocket(LineBufferingSocketContainer):
    """This class mostly extends LineBufferingSocketContainer with a list of filters and
    logic for setting it up from a specification."""
@@ -375,6 +866,16 @@ class FilteredSocket(LineBufferingSocketContainer):
    def __init__(self):
       super().__init__()
       self.filters = []
+      self.filter_names = []  # the names they were given in the config
+      self.filter_offload = [] # and whether they said `"offload": true'
+
+      # Made from self.filters by compile_filters().
+      self.chains = {'from_server': [], 'from_client': []}
+      self.stages = {'from_server': [], 'from_client': []}
+      self.hooks = {hook: [] for hook in FILTER_HOOKS}
+
+      self.timing_every = FILTER_TIMING_EVERY
+      self.untimed = 0        # batches since the last one that was timed
 
    def add_filters(self, filters, prototypes):
       """Add filters to self according to the specification in `filters` (same format as
@@ -397,7 +898,132 @@ class FilteredSocket(LineBufferingSocketContainer):
 
          filter_class = prototypes[filter_name]
 
+         # `offload' is for us, not the filter (see RemoteServer.filter_lines().)
+         filter_opts = dict(filter_opts)
+         offload = filter_opts.pop('offload', False) is True
+
          self.filters.append(filter_class(self, filter_opts))
+         self.filter_names.append(filter_name)
+         self.filter_offload.append(offload)
+
+      self.compile_filters()
+
+   def compile_filters(self):
+      """Work out, once, which of the filters' methods will need calling: the lists in
+      self.chains (see run_filters()) and self.hooks.  Call again after changing
+      self.filters by hand.
+
+      A filter that leaves lines in one direction alone can say so, and be left out of
+      that direction's chain, with a `passes_through' attribute listing the methods
+      ('from_server', 'from_client') that it doesn't need called.
+
+      Each chain is also split into self.stages: runs of filters that are all offloaded
+      or all not, as `(offloaded, chain)'."""
+      names = self.filter_names + [type(f).__name__ for f in self.filters[len(self.filter_names):]]
+      offload = self.filter_offload + [False] * (len(self.filters) - len(self.filter_offload))
+
+      for method in self.chains:
+         chain = []
+         stages = []
+         for f, name, offloaded in zip(self.filters, names, offload):
+            if method in getattr(f, 'passes_through', ()):
+               continue
+
+            # A filter that has a `method'_batch gets the whole list at once.
+            try:
+               entry = (getattr(f, method + '_batch'), True, FilterTiming(name, method))
+            except AttributeError:
+               try:
+                  entry = (getattr(f, method), False, FilterTiming(name, method))
+               except AttributeError:
+                  continue
+
+            chain.append(entry)
+            if len(stages) > 0 and stages[-1][0] == offloaded:
+               stages[-1][1].append(entry)
+            else:
+               stages.append((offloaded, [entry]))
+
+         self.chains[method] = chain
+         self.stages[method] = stages
+
+      for hook in self.hooks:
+         self.hooks[hook] = []
+         for f in self.filters:
+            try:
+               self.hooks[hook].append(getattr(f, hook))
+            except AttributeError:
+               pass
+
+   def filter_timings(self):
+      """The FilterTiming's for every filter that's been given any lines."""
+      return [timing for chain in self.chains.values() for (fn, batch, timing) in chain
+              if timing.calls > 0]
+
+   def run_filters(self, method, lines, chain=None):
+      """Pass `lines' (a list of TextLine's) through each filter's `method' in turn
+      ('from_server' or 'from_client') and return the ones that come out the end.
+      (Or through just those in `chain', a part of self.chains[method].)
+
+      A filter that has a `method'_batch (from_server_batch, say) gets the whole list
+      and returns a new one.  Otherwise `method' is called with each line, and returns
+      it, changed or not, or None to drop it.  Filters with neither, or that pass the
+      lines through untouched (see compile_filters()), aren't called at all.
+
+      Only one call in `self.timing_every' is timed, since with a line or two per read
+      asking the clock twice for every filter costs about as much as the filters do."""
+      if chain is None:
+         chain = self.chains[method]
+
+      self.untimed += 1
+      timed = self.untimed >= self.timing_every
+      if timed:
+         self.untimed = 0
+
+      for fn, batch, timing in chain:
+         if timed:
+            started = time.perf_counter()
+            given = len(lines)
+
+         if batch:
+            try:
+               lines = fn(lines)
+            except Exception:
+               log_filter_error(method)
+
+         else:
+            kept = []
+            for line in lines:
+               try:
+                  line = fn(line)
+               except Exception:
+                  log_filter_error(method)
+               if line is not None:
+                  kept.append(line)
+            lines = kept
+
+         if timed:
+            timing.add(given, time.perf_counter() - started)
+
+         if len(lines) == 0:
+            break
+
+      return lines
+
+   def handle_telnet(self, events):
+      """Overridden to pass Telnet events on to any filters that want them."""
+      for event in events:
+         self.tell_filters('telnet_event', event)
+
+   def tell_filters(self, hook, *args):
+      """Call `hook' (one of FILTER_HOOKS) on each filter that has it."""
+      for fn in self.hooks[hook]:
+         try:
+            fn(*args)
+         except Exception:
+            kind, value, t = sys.exc_info()
+            logging.error("Error in a filter's {}: {}".format(hook, repr(value)))
+            logging.error(traceback.format_exc())
 
 
 class RemoteServer(FilteredSocket):
@@ -414,49 +1040,196 @@ class RemoteServer(FilteredSocket):
       self.name = name
 
       self.subscribers = []
+      self.paused_by = set()  # subscribers whose output is backed up; see Proxy.output_overflow
 
-      self.connecting_in_thread = False
       self.use_SSL = False
+      self.tls_context = None
+      self.settings = {}      # this server's part of the config
+      self.latency = collections.defaultdict(LatencyHistogram)
+
+      # For filters that run on other threads; see filter_lines().
+      self.filter_pool = None
+      self.offload_high_water = OFFLOAD_HIGH_WATER
+      self.offload_queue = collections.deque()  # [lines, next stage, lines read]
+      self.offload_queued = 0       # lines read that are in there
+      self.offload_future = None    # the pool's job, while one's running
+      self.offload_backlogged = False
 
    def handle_data(self, data):
       """Called when some data has arrived and needs to be dispatched to the subscribers."""
-      for sub in self.subscribers:
-         sub.write_line(data)
+      self.handle_batch([data])
+
+   def handle_batch(self, lines):
+      """Dispatch a list of TextLine's to the subscribers."""
+      # Encode them once, together; every subscriber's queue shares the same bytes.
+      if len(lines) == 1:
+         segment = telnet.escape(lines[0].as_bytes())
+      else:
+         segment = b''.join([telnet.escape(line.as_bytes()) for line in lines])
+      for sub in tuple(self.subscribers):
+         sub.write_segment(segment)
+
+   def filter_lines(self, lines):
+      """Pass lines read from the server through its filters and on to the subscribers.
+
+      Filters with `"offload": true' in their options run on `filter_pool', so that a
+      slow one doesn't hold up the other worlds.  Each read's lines then wait in
+      `offload_queue' and go through the filters' stages (see compile_filters()) one
+      batch after another, the offloaded stages on the pool and the rest here, so that
+      they come out in the order they came in.  While more than `offload_high_water'
+      lines are waiting, we stop reading from the server."""
+      stages = self.stages['from_server']
+      if self.filter_pool is None or not any(offloaded for offloaded, chain in stages):
+         lines = self.run_filters('from_server', lines)
+         if len(lines) > 0:
+            self.handle_batch(lines)
+         return
+
+      self.offload_queue.append([lines, 0, len(lines)])
+      self.offload_queued += len(lines)
+      self.run_offload_queue()
+
+   def run_offload_queue(self):
+      """Move the batches at the front of offload_queue as far through the filters as
+      they can go without waiting for the pool."""
+      stages = self.stages['from_server']
+
+      while self.offload_future is None and len(self.offload_queue) > 0:
+         job = self.offload_queue[0]
+         lines, stage, read = job
+
+         if stage == len(stages) or len(lines) == 0:
+            self.offload_queue.popleft()
+            self.offload_queued -= read
+            if len(lines) > 0:
+               self.handle_batch(lines)
+            continue
+
+         offloaded, chain = stages[stage]
+         job[1] += 1
+         if offloaded and self.filter_pool is not None:
+            watcher = self.watcher
+            future = self.filter_pool.submit(self.run_filters, 'from_server', lines, chain)
+            self.offload_future = future
+            future.add_done_callback(
+               lambda f: watcher.call_soon_threadsafe(self.offload_done, job, f))
+         else:
+            job[0] = self.run_filters('from_server', lines, chain)
+
+      self.update_backlog()
+
+   def offload_done(self, job, future):
+      """Called back on the main loop when the pool has been through `job'."""
+      if future is not self.offload_future:
+         return # finish_offloaded() already waited for it
+
+      self.offload_future = None
+      job[0] = future.result()   # (run_filters() deals with the filters' exceptions)
+      self.run_offload_queue()
+
+   def finish_offloaded(self):
+      """Put everything still in offload_queue through the rest of the filters now,
+      waiting for the pool if need be.  Done when the connection goes away, say, so
+      that nothing is still being filtered when the filters hear about it."""
+      if self.offload_future is not None:
+         job = self.offload_queue[0]
+         job[0] = self.offload_future.result()
+         self.offload_future = None
+
+      pool = self.filter_pool
+      self.filter_pool = None    # (so that run_offload_queue() does it all here)
+      try:
+         self.run_offload_queue()
+      finally:
+         self.filter_pool = pool
+
+   def update_backlog(self):
+      """Stop reading from the server while too much is waiting for the filter pool, and
+      start again once it's down to half."""
+      if not self.offload_backlogged and self.offload_queued > self.offload_high_water:
+         self.offload_backlogged = True
+         self.stats['offload_backlogged'] += 1
+      elif self.offload_backlogged and self.offload_queued <= self.offload_high_water // 2:
+         self.offload_backlogged = False
+      else:
+         return
+
+      if self.watcher is not None:
+         self.watcher.update_events(self)
+
+   def want_read(self):
+      """Overridden to stop reading from the server while a subscriber is backed up, or
+      the filter pool is (see filter_lines().)"""
+      return len(self.paused_by) == 0 and not self.offload_backlogged
 
    def attach_socket(self, socket):
       """Set up to use socket `socket'.  Overridden to notify any filters when a server is connected."""
       super().attach_socket(socket)
 
+      self.tell_filters('server_connect', True)
+
+   def save_state(self):
+      """Overridden to include the state of any filters that have some."""
+      self.finish_offloaded()
+
+      state = super().save_state()
+      if state is None:
+         return None
+
+      state['filters'] = []
       for f in self.filters:
          try:
-            f.server_connect(True)
+            state['filters'].append([type(f).__name__, f.save_state()])
+         except AttributeError:
+            state['filters'].append([type(f).__name__, None])
+      return state
+
+   def restore_state(self, state):
+      super().restore_state(state)
+
+      for f, (name, saved) in zip(self.filters, state['filters']):
+         if saved is None or type(f).__name__ != name:
+            continue
+         try:
+            f.restore_state(saved)
          except AttributeError:
             pass
 
    def handle_disconnect(self):
       """Called when the connection has been lost."""
+      self.finish_offloaded()
+
       super().handle_disconnect()
       for sub in self.subscribers:
          sub.tell_err("Remote server closed connection.")
 
-      for f in self.filters:
-         try:
-            f.server_connect(False)
-         except AttributeError:
-            pass
+      self.tell_filters('server_connect', False)
 
    def subscribe(self, supplicant):
       """Add `supplicant' to the list of subscribed clients."""
-      assert type(supplicant) == LocalClient
+      assert type(supplicant) in (LocalClient, ShardRelay)
       if supplicant not in self.subscribers:
          self.subscribers.append(supplicant)
 
    def unsubscribe(self, supplicant):
       """Remove `supplicant' from the list of subscribed clients."""
-      assert type(supplicant) == LocalClient
+      assert type(supplicant) in (LocalClient, ShardRelay)
       while supplicant in self.subscribers:
          self.subscribers.remove(supplicant)
 
+      if supplicant in self.paused_by:
+         self.paused_by.remove(supplicant)
+         if self.watcher is not None:
+            self.watcher.update_events(self)
+
+   def listened_to(self):
+      """Whether any client is subscribed (not counting a worker's ShardRelay when
+      nobody in the front process is.)"""
+      for sub in self.subscribers:
+         if type(sub) is not ShardRelay or sub.listening:
+            return True
+      return False
+
    def tell_all(self, msg):
       """Tell all the clients subscribed to this particular server of something."""
       assert type(msg) == str
@@ -476,6 +1249,8 @@ class LocalClient(FilteredSocket):
 
       self.attach_socket(socket)
       self.subscribedTo = None
+      self.offered_compress_flush = 'line'
+      self.address = None
 
    def tell_ok(self, msg):
       self.write_str(MESSAGE_PREFIX_OK + msg + "\r\n")
@@ -484,16 +1259,36 @@ class LocalClient(FilteredSocket):
       self.write_str(MESSAGE_PREFIX_ERR + msg + "\r\n")
 
    def unsubscribe(self):
-      if type(self.subscribedTo) == RemoteServer:
+      if isinstance(self.subscribedTo, RemoteServer):
          self.subscribedTo.unsubscribe(self)
          self.subscribedTo = None
       else:
          raise ValueError("client.unsubscribe when subscribedTo not a RemoteServer")
 
    def subscribe(self, other):
-      assert type(other) == RemoteServer
+      assert isinstance(other, RemoteServer)
       self.subscribedTo = other
 
+   def offer_compression(self, flush='line'):
+      """Offer MCCP2 to the client.  If it takes us up on it, everything we send from
+      then on is compressed, flushing per `flush' (see start_compression().)"""
+      self.offered_compress_flush = flush
+      self.telnet.request_local(telnet.COMPRESS2)
+      self.write_telnet(self.telnet.take_output())
+
+   def handle_telnet(self, events):
+      """Overridden to start and stop MCCP2 when the client asks for it."""
+      for event in events:
+         if type(event) is telnet.OptionChange and event.option == telnet.COMPRESS2 and event.local:
+            if event.enabled:
+               # The subnegotiation itself has to go out uncompressed.
+               self.send_subnegotiation(telnet.COMPRESS2, b'')
+               self.start_compression(self.offered_compress_flush)
+            else:
+               self.stop_compression()
+
+      super().handle_telnet(events)
+
    def handle_data(self, data):
       if self.subscribedTo == None:
          self.tell_err("Not subscribedTo anything.")
@@ -508,11 +1303,7 @@ class LocalClient(FilteredSocket):
       # Overridden to notify things when a client is connected.
       super().attach_socket(socket)
 
-      for f in self.filters:
-         try:
-            f.server_connect(True)
-         except AttributeError:
-            pass
+      self.tell_filters('server_connect', True)
 
    def handle_disconnect(self):
       super().handle_disconnect()
@@ -520,11 +1311,172 @@ class LocalClient(FilteredSocket):
       if self.subscribedTo != None:
          self.subscribedTo.unsubscribe(self)
 
-      for f in self.filters:
-         try:
-            f.client_connect(False)
-         except AttributeError:
-            pass
+      self.tell_filters('client_connect', False)
+
+
+class ShardLink(LineBufferingSocketContainer):
+   """One end of the socketpair between the front process and a worker (see shard.py.)
+   What's read from it comes out as shard.Frame's instead of lines."""
+   def __init__(self, index):
+      super().__init__()
+
+      self.index = index      # which worker
+      self.process = None     # (in the front) the worker's subprocess.Popen
+      self.reader = shard.FrameReader()
+
+      self.waiting = {}       # (in the front) clients waiting for a REPLY, by token
+      self.last_token = 0
+
+   def feed(self, data):
+      """Overridden to read frames; there's no Telnet on a link."""
+      return self.reader.feed(data)
+
+   def send(self, kind, world, payload=b''):
+      # (write_telnet() is the one write that doesn't wait for the end of a line.)
+      self.write_telnet(shard.frame(kind, world, payload))
+
+   def forward_command(self, world, client, name, args):
+      """Have the worker run the command `name' for `client' (see WorkerProxy.run_command.)"""
+      self.last_token += 1
+      self.waiting[self.last_token] = client
+      self.send(shard.COMMAND, world, shard.command(self.last_token, name, args))
+
+
+class ShardedServer(RemoteServer):
+   """A world whose connection, and server filters, live in a worker process: what
+   clients send it goes to the worker over `link', and what the worker sends back is
+   passed on to the subscribers from here.  `connected' is whatever the worker last
+   said it was."""
+   def __init__(self, host, port, name, link, number):
+      super().__init__(host, port, name)
+
+      self.link = link
+      self.number = number    # see shard.world_numbers()
+      self.paused = False     # whether the worker has been told to stop reading
+      self.listening = False  # whether the worker has been told anyone's subscribed
+
+   def write_line(self, line):
+      """Overridden to send the line to the worker."""
+      assert type(line) == TextLine
+      self.link.send(shard.LINE, self.number, line.as_bytes())
+
+   def connect(self):
+      self.link.send(shard.CONNECT, self.number)
+
+   def relay(self, segment):
+      """Pass on text the worker sent, already encoded and escaped."""
+      for sub in tuple(self.subscribers):
+         sub.write_segment(segment)
+
+   def subscribe(self, supplicant):
+      super().subscribe(supplicant)
+      self.update_listening()
+
+   def unsubscribe(self, supplicant):
+      super().unsubscribe(supplicant)
+      self.update_listening()
+
+   def update_listening(self):
+      """Tell the worker whether anyone's subscribed, if that's changed (so that it
+      knows whether to keep reconnecting.)"""
+      if self.listening != (len(self.subscribers) > 0):
+         self.listening = not self.listening
+         self.link.send(shard.LISTENING, self.number, b'1' if self.listening else b'0')
+
+   def update_pause(self):
+      """Tell the worker to stop (or start) reading, if that's changed."""
+      if self.paused == self.want_read():
+         self.paused = not self.paused
+         self.link.send(shard.PAUSE if self.paused else shard.RESUME, self.number)
+
+   def forward_command(self, client, name, args):
+      self.link.forward_command(self.number, client, name, args)
+
+
+###
+### STATISTICS
+###
+
+
+class LatencyHistogram:
+   """Counts how long something took, in buckets whose upper bounds (in milliseconds)
+   are `BOUNDS'; anything slower goes in a last, unbounded bucket."""
+   BOUNDS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+   def __init__(self):
+      self.counts = [0] * (len(self.BOUNDS) + 1)
+      self.n = 0
+      self.total = 0.0   # milliseconds
+
+   def add(self, seconds):
+      ms = seconds * 1000
+      i = 0
+      while i < len(self.BOUNDS) and ms > self.BOUNDS[i]:
+         i += 1
+      self.counts[i] += 1
+      self.n += 1
+      self.total += ms
+
+   def percentile(self, p):
+      """The upper bound of the bucket the `p'th percentile falls in (None if it's the
+      last one, or nothing's been counted.)"""
+      if self.n == 0:
+         return None
+      wanted = self.n * p / 100
+      seen = 0
+      for i, count in enumerate(self.counts):
+         seen += count
+         if seen >= wanted and count > 0:
+            return self.BOUNDS[i] if i < len(self.BOUNDS) else None
+      return None
+
+   def describe(self):
+      """A one-line summary."""
+      if self.n == 0:
+         return "none yet"
+
+      def bound(p):
+         b = self.percentile(p)
+         return "<={}ms".format(b) if b is not None else ">{}ms".format(self.BOUNDS[-1])
+
+      buckets = ["{}:{}".format(self.BOUNDS[i] if i < len(self.BOUNDS) else 'more', count)
+                 for i, count in enumerate(self.counts) if count > 0]
+
+      return "n={} mean={:.1f}ms p50{} p99{} [{}]".format(
+         self.n, self.total / self.n, bound(50), bound(99), ' '.join(buckets))
+
+
+class RateLimiter:
+   """A token bucket for each key (e.g. address): up to `burst' things at once, then
+   `rate' per second."""
+   def __init__(self, rate, burst):
+      self.rate = rate
+      self.burst = burst
+      self.buckets = {}   # key -> (tokens, when they were counted)
+
+   def allow(self, key, now=None):
+      """Take a token for `key' if there's one left; returns whether there was."""
+      if now is None:
+         now = time.monotonic()
+
+      tokens, then = self.buckets.get(key, (self.burst, now))
+      tokens = min(self.burst, tokens + (now - then) * self.rate)
+
+      if len(self.buckets) > 1000:
+         self.forget_full(now)
+
+      if tokens < 1:
+         self.buckets[key] = (tokens, now)
+         return False
+
+      self.buckets[key] = (tokens - 1, now)
+      return True
+
+   def forget_full(self, now):
+      """Drop the buckets that have filled up again; they'd start full anyway."""
+      for key, (tokens, then) in list(self.buckets.items()):
+         if tokens + (now - then) * self.rate >= self.burst:
+            del self.buckets[key]
 
 
 ###
@@ -532,32 +1484,84 @@ class LocalClient(FilteredSocket):
 ###
 
 
+class Timer:
+   """Something for the main loop to do later; see Proxy.call_later()."""
+   def __init__(self, when, callback, args):
+      self.when = when
+      self.callback = callback
+      self.args = args
+      self.cancelled = False
+
+   def __lt__(self, other):
+      return self.when < other.when
+
+   def cancel(self):
+      self.cancelled = True
+
+
 class Proxy:
    def __init__(self, cfg):
       self.LOCK = threading.Lock()
       self.sel = selectors.DefaultSelector()
       self.socket_wrappers = {}
+      self.cork = OutputCork()
+      self.stats = collections.Counter()
+      self.latency = collections.defaultdict(LatencyHistogram)
+
+      self.handshakes = {}          # client sockets still doing the TLS handshake
 
-      self.tls_ctx_remote = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH)
+      # (Each server gets its own context for connecting to it; see setup_servers().)
       self.tls_ctx_local  = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
-      self.tls_ctx_remote.check_hostname = False
-      # This is insecure and bad.  IDEALLY everything would serve a correctly set up
-      # certificate and it would Just Work.  But ...
-      self.tls_ctx_remote.verify_mode = ssl.CERT_NONE
       self.tls_ctx_local.load_cert_chain("ssl/cert.pem")
 
       self.servers = {}             # index of available servers by display name
-      self.server_sockets = []
+      self.server_sockets = set()
 
-      self.client_sockets = []
+      # Worlds can be split between worker processes; see shard.py.
+      self.worlds = {}              # the same servers, by number (see shard.world_numbers)
+      self.links = []               # a ShardLink to each worker, by worker number
+      self.link_sockets = set()
+      self.assignment = {}          # which worker each world went to, by name
+
+      self.client_sockets = set()
       self.client_commands = {}
 
-      self.unauthenticated_sockets = []
+      self.unauthenticated_sockets = set()
+      self.verifying_sockets = set()   # waiting for auth_pool to check their password
+      self.held_lines = {}          # what they've sent in the meantime
       self.password = Password()
 
-      self.states = [(self.server_sockets, self.handle_line_server),
-                     (self.unauthenticated_sockets, self.handle_line_auth),
-                     (self.client_sockets, self.handle_line_client)]
+      # Checking a password takes a while on purpose, so it's done on other threads.
+      self.auth_pool = concurrent.futures.ThreadPoolExecutor(
+         max_workers=cfg.get('auth_workers', AUTH_WORKERS))
+
+      # So are server filters that ask to be (see RemoteServer.filter_lines().)
+      self.filter_pool = concurrent.futures.ThreadPoolExecutor(
+         max_workers=cfg.get('filter_workers', FILTER_WORKERS))
+      attempts = cfg.get('auth_attempts_per_minute', AUTH_ATTEMPTS_PER_MINUTE)
+      self.auth_limiter = RateLimiter(attempts / 60, attempts)
+
+      # Other threads hand work back to the main loop through call_soon_threadsafe(),
+      # which wakes it up by writing to `waker'.
+      self.callbacks = collections.deque()
+      self.waker_r, self.waker = socket.socketpair()
+      self.waker_r.setblocking(False)
+      self.waker.setblocking(False)
+
+      self.timers = []   # a heap of Timer's; see call_later()
+
+      self.listener = None
+      self.inherited = None   # (handoff socket, state, fds) from the process we replaced
+
+      self.connector = connector.ConnectionManager(self, cfg)
+
+      # Every connection is in one of these states (its wrapper's `state'; see
+      # set_state()), which says which set it's in and what handles its lines.
+      self.states = {'link': (self.link_sockets, self.handle_lines_link),
+                     'server': (self.server_sockets, self.handle_lines_server),
+                     'verifying': (self.verifying_sockets, self.handle_lines_verifying),
+                     'unauthenticated': (self.unauthenticated_sockets, self.handle_lines_auth),
+                     'client': (self.client_sockets, self.handle_lines_client)}
 
       if cfg.get('debug', False):
          self.register_command("e", self.do_client_debug)
@@ -572,8 +1576,14 @@ class Proxy:
       self.register_command("hush", self.do_client_drop)
       self.register_command("h", self.do_client_help)
       self.register_command("help", self.do_client_help)
+      self.register_command("stats", self.do_client_stats)
       self.register_command("die", self.do_client_stop_everything)
       self.register_command("D", self.do_client_stop_everything)
+      self.register_command("restart", self.do_client_restart)
+
+      # Commands added later, by plugins, may need a world's filters, so they're run
+      # in the world's worker process (if it has one.)
+      self.core_commands = set(self.client_commands)
 
       self.cfg = cfg
 
@@ -598,151 +1608,163 @@ class Proxy:
    def wall(self, mesg):
       """Warn every client with the string `mesg'."""
       for socket in self.client_sockets:
-         assert socket in self.socket_wrappers
-         assert type(self.socket_wrappers[socket]) is LocalClient
-
-         c = self.socket_wrappers[socket]
-         c.tell_err(mesg)
+         self.socket_wrappers[socket].tell_err(mesg)
+
+   def set_state(self, socket, state):
+      """Move `socket' (which must be watch()'ed) into `state', one of the keys of
+      `states', or None to take it out of them all."""
+      wrapper = self.socket_wrappers[socket]
+      if wrapper.state is not None:
+         self.states[wrapper.state][0].discard(socket)
+      wrapper.state = state
+      if state is not None:
+         self.states[state][0].add(socket)
 
    ###
    ### STATE: server
    ###
 
-   def handle_line_server(self, socket, line):
+   def handle_lines_server(self, socket, lines):
       assert socket in self.server_sockets
 
-      svr = self.socket_wrappers[socket]
-      ln = line
-
-      for f in svr.filters:
-         try:
-            ln = f.from_server(ln)
-         except Exception:
-            kind, value, t = sys.exc_info()
-            logging.error("Error applying a server filter: {}".format(repr(value)))
-            logging.error(traceback.format_exc())
+      self.socket_wrappers[socket].filter_lines(lines)
 
-         if ln is None:
-            return
+   def start_connection(self, server):
+      """Start connecting to `server' (see connector.py.)  Returns False if it's already
+      connected, or being connected to."""
+      if type(server) is ShardedServer:
+         server.connect()
+         return True
 
-      self.socket_wrappers[socket].handle_data(ln)
-      return False # don't continue trying states
+      assert type(server) == RemoteServer
+      return self.connector.connect(server)
 
-   def do_start_connection(self, server):
-      logging.info("Starting to connect to server {}:{}.".format(server.host, server.port))
+   def connection_ready(self, server, sock):
+      """Called by the connection manager with a newly connected socket for `server'."""
+      server.attach_socket(sock)
+      self.watch(sock, server)
+      self.set_state(sock, 'server')
 
-      # This will always be ran in a thread -- to prevent long-blocking connection
-      # attempts from hanging the whole program (e.g., when a server is down,
-      # tinyfugue can spend quite a while waiting for a connection attempt to
-      # come through...)
+   ###
+   ### STATE: link to a worker
+   ###
 
-      # The main program will set connecting_in_thread synchronously *before*
-      # calling this thread, so we don't need to worry about accidental multiple
-      # connection attempts.
+   def handle_lines_link(self, socket, frames):
+      assert socket in self.link_sockets
 
-      # It would probably be better to try to figure out asynchronous connect() or
-      # something eventually.
+      link = self.socket_wrappers[socket]
+      for frame in frames:
+         self.handle_frame(link, frame)
 
-      try:
-         assert type(server) == RemoteServer
-         assert server.socket == None
-         assert not server.connected
+   def handle_frame(self, link, frame):
+      """Handle one frame from the worker at the other end of `link'."""
+      kind = frame.kind
 
-         rlock = False
+      if kind == shard.REPLY:
+         token, output = shard.read_reply(frame.payload)
+         client = link.waiting.pop(token, None)
+         if client is not None and client.connected:
+            client.write_segment(output)
+         return
 
-         C = socket.create_connection((server.host, server.port))
+      server = self.worlds.get(frame.world)
+      if type(server) is not ShardedServer or server.link is not link:
+         logging.warning("Worker {} sent something about a world it doesn't have.".format(link.index))
+         return
 
-         if server.use_SSL:
-            C = self.tls_ctx_remote.wrap_socket(C)
+      if kind == shard.LINE:
+         server.relay(frame.payload)
+      elif kind == shard.TELL_OK:
+         server.tell_all(frame.payload.decode('utf-8'))
+      elif kind == shard.TELL_ERR:
+         server.warn_all(frame.payload.decode('utf-8'))
+      elif kind == shard.STATUS:
+         server.connected = frame.payload == b'1'
+      else:
+         logging.warning("Worker {} sent a frame of unknown kind {}.".format(link.index, kind))
 
-         self.LOCK.acquire()
-         rlock = True
+   ###
+   ### STATE: unauthenticated client
+   ###
 
-         server.attach_socket(C)
-         self.socket_wrappers[C] = server
-         self.server_sockets += [C]
-         self.sel.register(C, selectors.EVENT_READ)
+   def handle_lines_auth(self, socket, lines):
+      assert socket in self.unauthenticated_sockets
 
-      except ConnectionRefusedError:
-         server.warn_all("Connection attempt failed: Connection refused")
+      c = self.socket_wrappers[socket]
 
-      except ssl.SSLError as e:
-         server.warn_all("Connection attempt failed, SSL error: {}", repr(e))
+      for x in range(len(lines)):
+         if not self.auth_limiter.allow(c.address[0] if c.address else None):
+            self.stats['auth_rate_limited'] += 1
+            c.tell_err("Too many attempts; wait a while.")
+            continue
 
-      except (socket.error, socket.herror, socket.gaierror, socket.timeout) as err:
-         server.warn_all("Connection attempt failed, network error: {}".format(repr(err)))
+         s = lines[x].as_str().replace('\r\n', '').replace('\n', '')
 
-      except OSError as err:
-         server.warn_all("Connection attempt failed, OSError: {}".format(repr(err)))
+         self.set_state(socket, 'verifying')
+         self.held_lines[socket] = []
 
-      except Exception:
-         kind, value, t = sys.exc_info()
-         server.warn_all("Connection attempt failed, other error: {}".format(repr(value)))
-         logging.error("NON-SOCKET CONNECTION ERROR\n===========================\n\n" + traceback.format_exc())
+         started = time.monotonic()
+         future = self.auth_pool.submit(self.password.verify, s)
+         future.add_done_callback(
+            lambda f: self.call_soon_threadsafe(self.finish_auth, socket, f, started))
 
-      finally:
-         server.connecting_in_thread = False
-         if rlock:
-            self.LOCK.release()
+         # The rest wait for the answer.
+         self.handle_lines(socket, lines[x+1:])
          return
 
-   def start_connection(self, server):
-      assert type(server) == RemoteServer
-
-      if not server.connecting_in_thread and not server.connected:
-         server.connecting_in_thread = True
-         t_connect = threading.Thread(target = self.do_start_connection, args = [server])
-         t_connect.start()
-         return True
-      else:
-         return False
+   def handle_lines_verifying(self, socket, lines):
+      # Whatever the client sends while its password is being checked is dealt with
+      # once it's been let in (or dropped, if it isn't.)
+      held = self.held_lines[socket]
+      if len(held) < MAX_HELD_LINES:
+         held += lines[:MAX_HELD_LINES - len(held)]
 
-   ###
-   ### STATE: unauthenticated client
-   ###
+   def finish_auth(self, socket, future, started):
+      """Called back on the main loop when the password `socket' sent has been checked."""
+      held = self.held_lines.pop(socket, [])
+      if socket not in self.verifying_sockets:
+         return # it went away in the meantime
 
-   def handle_line_auth(self, socket, line):
-      assert socket in self.unauthenticated_sockets
+      self.latency['password_verify'].add(time.monotonic() - started)
 
-      s = line.as_str().replace('\r\n', '').replace('\n', '')
+      try:
+         ok = future.result()
+      except Exception:
+         kind, value, t = sys.exc_info()
+         logging.error("Error checking a password: {}".format(repr(value)))
+         ok = False
 
-      if self.password.verify(s):
+      if ok:
+         self.stats['auth_ok'] += 1
          if cfg.get("warn_about_connections", True):
             self.wall("A client has authorized itself.")
 
-         while socket in self.unauthenticated_sockets:
-            self.unauthenticated_sockets.remove(socket)
-
-         self.client_sockets.append(socket)
+         self.set_state(socket, 'client')
+         self.handle_lines(socket, held)
 
       else:
-         c = self.socket_wrappers[socket]
-         c.tell_err("Incorrect.")
-
-      return True # stop the main loop from going on to state n+1
+         self.stats['auth_failed'] += 1
+         self.set_state(socket, 'unauthenticated')
+         self.socket_wrappers[socket].tell_err("Incorrect.")
+         self.handle_lines(socket, held)
 
 
    ###
    ### STATE: client
    ###
 
-   def handle_line_client(self, socket, line):
+   def handle_lines_client(self, socket, lines):
       assert socket in self.client_sockets
 
       c = self.socket_wrappers[socket]
 
-      ln = line
-      for f in c.filters:
-         try:
-            ln = f.from_client(ln)
-         except Exception:
-            kind, value, t = sys.exc_info()
-            logging.error("Error applying a client filter: {}".format(repr(value)))
-            logging.error(traceback.format_exc())
-
-         if ln is None:
-            return
+      for line in c.run_filters('from_client', lines):
+         if socket not in self.client_sockets:
+            return # a command dropped it
+         self.handle_line_client(c, line)
 
+   def handle_line_client(self, c, line):
+      """Carry out a command from the client `c', or pass the line on to its world."""
       s = line.as_str().replace('\r\n', '').replace('\n', '')
 
       if s[:len(COMMAND_PREFIX)] == COMMAND_PREFIX:
@@ -755,7 +1777,10 @@ class Proxy:
                args = ''
 
             if cmd in self.client_commands:
-               self.client_commands[cmd](args, c)
+               if cmd not in self.core_commands and type(c.subscribedTo) is ShardedServer:
+                  c.subscribedTo.forward_command(c, cmd, args)
+               else:
+                  self.client_commands[cmd](args, c)
             else:
                c.tell_err("Command `{}' not found.".format(cmd))
 
@@ -767,8 +1792,6 @@ class Proxy:
       else:
          c.handle_data(line)
 
-      return False # don't continue trying states
-
    def do_client_join(self, args, client):
       """Start listening to a server."""
       assert type(client) == LocalClient
@@ -832,24 +1855,503 @@ class Proxy:
       for fn, names in cmds.items(): # (k, v)
          client.tell_ok("{}: {}".format(', '.join(names), fn.__doc__ or "No documentation provided."))
 
+   def do_client_stats(self, args, client):
+      """Show statistics about the connection to your current world."""
+      assert type(client) == LocalClient
+
+      for name in sorted(self.stats):
+         client.tell_ok("(proxy) {}: {}".format(name, self.stats[name]))
+      for name in sorted(self.latency):
+         client.tell_ok("(proxy) {}: {}".format(name, self.latency[name].describe()))
+
+      if client.subscribedTo is None:
+         client.tell_err("Not subscribedTo anything.")
+         return
+
+      if type(client.subscribedTo) is ShardedServer:
+         # The numbers are kept where the connection is.
+         client.subscribedTo.forward_command(client, 'stats', args)
+      else:
+         self.tell_server_stats(client.subscribedTo, client)
+
+      for timing in client.filter_timings():
+         client.tell_ok("(you) " + timing.describe())
+
+      if client.stats['mccp_out_raw_bytes'] > 0:
+         client.tell_ok("MCCP to you saved {:.1f}% of the bandwidth.".format(
+            100 * (1 - client.stats['mccp_out_compressed_bytes'] / client.stats['mccp_out_raw_bytes'])))
+
+   def tell_server_stats(self, server, client):
+      """Tell `client' the statistics kept about the connection to `server'."""
+      stats = server.stats
+      for name in sorted(stats):
+         client.tell_ok("{}: {}".format(name, stats[name]))
+      latency = server.latency
+      for name in sorted(latency):
+         client.tell_ok("{} time: {}".format(name, latency[name].describe()))
+      for timing in server.filter_timings():
+         client.tell_ok(timing.describe())
+
+      saved = self.connector.resumption_savings(server)
+      if saved is not None:
+         client.tell_ok("TLS session resumption saved about {:.1f}ms of handshaking.".format(saved))
+
+      if stats['mccp_decompressed_bytes'] > 0:
+         client.tell_ok("MCCP saved {:.1f}% of the bandwidth.".format(
+            100 * (1 - stats['mccp_compressed_bytes'] / stats['mccp_decompressed_bytes'])))
+
    def do_client_stop_everything(self, args, client):
       """Stop the proxy."""
       # This is kind of stupid, isn't it?
       raise KeyboardInterrupt()
 
-   ###
-   ### MAIN LOOP
-   ###
+   def do_client_restart(self, args, client):
+      """Restart the proxy (to pick up new code or plugins) without dropping the connections to servers, where possible.  You'll have to reconnect yourself."""
+      assert type(client) == LocalClient
 
-   def run(self):
-      # I'm not sure how much sense it makes to do this here and not in __init__ but oh well.
+      client.tell_ok("Restarting...")
+      try:
+         self.hot_restart()
+      except Exception:
+         kind, value, t = sys.exc_info()
+         logging.error("HOT RESTART FAILED\n==================\n\n" + traceback.format_exc())
+         client.tell_err("Restart failed: {}".format(repr(value)))
+         return
+
+      self.wall("The proxy has restarted; reconnect to carry on.")
+      self.cork.uncork()
+      raise KeyboardInterrupt()
+
+   ###
+   ### HOT RESTART
+   ###
+
+   # A new process is started with the same command line, and handed the listening
+   # socket and the (plain TCP) connections to servers, along with what it needs to
+   # carry on with them.  Connections with TLS, or MCCP, can't be handed over like
+   # that; the new process reconnects those.  Clients always use TLS, so they have to
+   # reconnect themselves.  See handoff.py for how the sockets are passed.  (With worker
+   # processes, the connections are theirs, so this isn't possible.)
+
+   def hot_restart(self):
+      """Start a new process and hand everything over to it.  If this returns, the new
+      process has taken over and this one should quit; if it raises, the new process
+      has been killed and this one should carry on."""
+      if len(self.links) > 0:
+         raise RuntimeError("Can't hot restart with worker processes")
+
+      ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+      env = dict(os.environ)
+      env[handoff.HANDOFF_ENV] = str(theirs.fileno())
+      child = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=[theirs.fileno()])
+      theirs.close()
+
+      try:
+         # Get out whatever's waiting to go to the servers first.
+         self.cork.uncork()
+
+         self.stats['hot_restarts'] += 1
+         state, fds = self.handoff_state()
+         ours.settimeout(self.cfg.get('handoff_timeout', handoff.HANDOFF_TIMEOUT))
+         handoff.send(ours, state, fds)
+
+         if ours.recv(len(handoff.ACK)) != handoff.ACK:
+            raise ConnectionError("The new process didn't take over")
+
+      except Exception:
+         self.stats['hot_restarts'] -= 1
+         child.kill()
+         raise
+
+      finally:
+         ours.close()
+
+      # The new process does any connecting from now on.  (Not before it's taken over,
+      # since if it doesn't, this one carries on and still needs its resolver.)
+      self.connector.shutdown()
+      logging.info("Handed over to process {}.".format(child.pid))
+
+   def handoff_state(self):
+      """Returns `(state, fds)': a description of the servers, and the file descriptors
+      to pass along with it."""
+      fds = [self.fileno(self.listener)]
+      servers = {}
+
+      for name, server in self.servers.items():
+         entry = {'connected': server.connected}
+
+         if server.connected and not server.use_SSL and self.can_hand_off(server):
+            saved = server.save_state()
+            if saved is not None:
+               entry['fd'] = len(fds)
+               entry['state'] = saved
+               fds.append(self.fileno(server.socket))
+
+         servers[name] = entry
+
+      return ({'servers': servers, 'stats': dict(self.stats)}, fds)
+
+   def can_hand_off(self, server):
+      """Whether everything written to `server' has left our hands."""
+      return True
+
+   def fileno(self, socket):
+      return socket.fileno()
+
+   def receive_handoff(self, sock):
+      """Called at startup, before run(), in a process started by hot_restart()."""
+      state, fds = handoff.receive(sock)
+      self.inherited = (sock, state, fds)
+
+   def finish_handoff(self):
+      """Take over what the old process handed us, and tell it we have."""
+      sock, state, fds = self.inherited
+
+      for name, entry in state['servers'].items():
+         server = self.servers.get(name)
+
+         if 'fd' in entry:
+            conn = socket.socket(fileno=fds[entry['fd']])
+            if server is None:
+               conn.close()
+               continue
+            self.adopt_server(server, conn, entry['state'])
+
+         elif entry['connected'] and server is not None:
+            self.start_connection(server)
+
+      self.stats.update(state['stats'])
+
+      # (Before the old process hears it can go.)
+      handoff.notify_systemd("MAINPID={}".format(os.getpid()))
+      sock.sendall(handoff.ACK)
+      sock.close()
+      self.inherited = None
+
+   def adopt_server(self, server, conn, state):
+      """Carry on with a connection to `server' handed over by the old process."""
+      server.attach_socket(conn)
+      server.restore_state(state)
+      self.watch(conn, server)
+      self.set_state(conn, 'server')
+
+   def make_listener(self, bind_address):
+      """The socket to listen for clients on: inherited from the old process if there
+      was one, otherwise a new one."""
+      if self.inherited is not None:
+         sock, state, fds = self.inherited
+         listener = socket.socket(fileno=fds[0])
+      else:
+         listener = socket.socket()
+         listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+         listener.bind(bind_address)
+      listener.listen(100)
+      listener.setblocking(False)
+      self.listener = listener
+      return listener
+
+   ###
+   ### WORKER PROCESSES
+   ###
+
+   # With `"workers": N' in config.json, the worlds are split between N worker processes
+   # (see shard.py), so that a busy world, or one with slow filters, only holds up the
+   # others in its own process.  This process keeps the clients; each world is a
+   # ShardedServer here, and a RemoteServer in its worker (a WorkerProxy.)
+
+   def setup_workers(self):
+      """Start the worker processes, if the config asks for any.  Returns False if it's
+      wrong."""
+      self.world_numbers = shard.world_numbers(self.cfg['servers'])
+
+      n_workers = self.cfg.get('workers', 0)
+      if type(n_workers) is not int or n_workers < 0:
+         logging.error("workers must be a whole number (0 for none)")
+         return False
+      if n_workers == 0:
+         return True
+
+      self.assignment = shard.assign(self.cfg['servers'], n_workers)
+      self.links = [None] * n_workers
+      for index in range(n_workers):
+         self.start_worker(index)
+
+      return True
+
+   def start_worker(self, index):
+      """Start worker number `index' (again), and point its worlds at it."""
+      ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+      env = dict(os.environ)
+      env[shard.WORKER_ENV] = "{} {}".format(index, theirs.fileno())
+      env.pop(handoff.NOTIFY_ENV, None)   # (only the front talks to systemd)
+
+      link = ShardLink(index)
+      link.process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=[theirs.fileno()])
+      theirs.close()
+      logging.info("Started worker {} (process {}).".format(index, link.process.pid))
+
+      self.links[index] = link
+      self.add_link(link, ours)
+
+      for server in self.servers.values():
+         if type(server) is ShardedServer and self.assignment[server.name] == index:
+            server.link = link
+            server.paused = False
+            server.update_pause()
+            server.listening = False
+            server.update_listening()
+
+   def add_link(self, link, sock):
+      link.attach_socket(sock)
+      self.watch(sock, link)
+      self.set_state(sock, 'link')
+
+   def worker_lost(self, link):
+      """Called when the link to a worker has gone, which means the worker has too."""
+      logging.error("Worker {} died; starting another in {} seconds.".format(
+         link.index, shard.WORKER_RESPAWN_DELAY))
+      self.stats['workers_lost'] += 1
+
+      link.process.kill()
+      link.process.wait()
+
+      for server in self.servers.values():
+         if type(server) is ShardedServer and server.link is link and server.connected:
+            server.connected = False
+            server.warn_all("Lost the connection to the server (its worker process died.)")
+
+      self.call_later(shard.WORKER_RESPAWN_DELAY, self.start_worker, link.index)
+
+   def owns(self, name):
+      """Whether this process runs the world `name' itself (rather than a worker.)"""
+      return True
+
+   ###
+   ### EVENTS AND BACKPRESSURE
+   ###
+
+   def watch(self, socket, wrapper):
+      """Start handling events for `socket', which belongs to `wrapper'."""
+      self.socket_wrappers[socket] = wrapper
+      wrapper.watcher = self
+      wrapper.cork = self.cork
+      wrapper.sel_events = 0
+      self.update_events(wrapper)
+
+   def update_events(self, wrapper):
+      """Make the selector watch `wrapper''s socket for whatever it wants right now:
+      reading, unless it's paused, and writing, if it has output waiting."""
+      if type(wrapper) is ShardedServer:
+         wrapper.update_pause()
+         return
+
+      if not wrapper.connected or wrapper.socket not in self.socket_wrappers:
+         return
+
+      events = 0
+      if wrapper.want_read():
+         events |= selectors.EVENT_READ
+      if wrapper.write_interest:
+         events |= selectors.EVENT_WRITE
+
+      if events == wrapper.sel_events:
+         return
+
+      if wrapper.sel_events == 0:
+         self.sel.register(wrapper.socket, events, self.connection_event)
+      elif events == 0:
+         self.sel.unregister(wrapper.socket)
+      else:
+         self.sel.modify(wrapper.socket, events, self.connection_event)
+
+      wrapper.sel_events = events
+
+   def close_connection(self, socket):
+      """Forget about `socket' (whose connection has died, or is being dropped) and
+      close it."""
+      wrapper = self.socket_wrappers[socket]
+
+      if wrapper.sel_events != 0:
+         self.sel.unregister(socket)
+         wrapper.sel_events = 0
+
+      wrapper.handle_disconnect()
+
+      self.set_state(socket, None)
+      del self.socket_wrappers[socket]
+
+      if type(wrapper) is RemoteServer and wrapper.use_SSL:
+         self.connector.remember_session(wrapper, self.ssl_object(socket))
+
+      socket.close()
+
+      if type(wrapper) is RemoteServer:
+         self.connector.connection_lost(wrapper)
+      elif type(wrapper) is ShardLink:
+         self.worker_lost(wrapper)
+
+   def ssl_object(self, socket):
+      """The SSLSocket (or SSLObject) behind `socket', if it has one."""
+      if isinstance(socket, ssl.SSLSocket):
+         return socket
+      return None
+
+   def output_overflow(self, client):
+      """Called when more than `client.high_water' bytes are waiting to be sent to a
+      client.  What happens next depends on `client_overflow_policy' in config.json:
+
+         drop_oldest - throw away the oldest queued output, down to half the limit
+         disconnect  - drop the client
+         pause       - stop reading from the client's world until it catches up"""
+      policy = self.cfg.get('client_overflow_policy', 'drop_oldest')
+
+      if policy == 'drop_oldest':
+         dropped = client.drop_oldest(client.high_water // 2)
+         if dropped > 0:
+            self.stats['overflow_drop_oldest'] += 1
+            self.stats['overflow_dropped_bytes'] += dropped
+            client.overflowed = False
+            return
+         # (A compressed stream can't be cut; there's nothing for it but to disconnect.)
+         policy = 'disconnect'
+
+      self.stats['overflow_' + policy] += 1
+
+      if policy == 'disconnect':
+         logging.warning("Disconnecting a client with {} bytes of output backed up.".format(client.pending_output()))
+         if client.socket in self.socket_wrappers:
+            self.close_connection(client.socket)
+
+      elif policy == 'pause':
+         server = client.subscribedTo
+         if server is not None:
+            logging.info("Pausing server {} until a client catches up.".format(server.name))
+            server.paused_by.add(client)
+            self.update_events(server)
+
+   def call_soon_threadsafe(self, callback, *args):
+      """Have the main loop call `callback(*args)' as soon as it can.  Unlike almost
+      everything else here, this can be called from any thread."""
+      self.callbacks.append((callback, args))
+      try:
+         self.waker.send(b'\0')
+      except BlockingIOError:
+         pass # it's already been woken plenty
+
+   def call_later(self, delay, callback, *args):
+      """Have the main loop call `callback(*args)' in `delay' seconds.  Returns a Timer,
+      which can be cancel()'ed."""
+      timer = Timer(time.monotonic() + delay, callback, args)
+      heapq.heappush(self.timers, timer)
+      return timer
+
+   def run_timers(self):
+      """Call the callbacks of the timers that are due."""
+      now = time.monotonic()
+      while len(self.timers) > 0 and self.timers[0].when <= now:
+         timer = heapq.heappop(self.timers)
+         if timer.cancelled:
+            continue
+         try:
+            timer.callback(*timer.args)
+         except Exception:
+            logging.error("Error in a timer:\n" + traceback.format_exc())
+
+   def time_to_next_timer(self, longest):
+      """How long the main loop can wait for events before a timer is due (but no
+      longer than `longest'.)"""
+      while len(self.timers) > 0 and self.timers[0].cancelled:
+         heapq.heappop(self.timers)
+      if len(self.timers) == 0:
+         return longest
+      return max(0, min(longest, self.timers[0].when - time.monotonic()))
+
+   def watch_fd(self, sock, events, callback):
+      """Have the main loop call `callback(sock, mask)' when `sock' is ready for
+      `events' (selectors.EVENT_READ and/or EVENT_WRITE.)  For sockets that aren't
+      connections (yet); those are handled by watch()."""
+      try:
+         self.sel.modify(sock, events, callback)
+      except KeyError:
+         self.sel.register(sock, events, callback)
+
+   def unwatch_fd(self, sock):
+      try:
+         self.sel.unregister(sock)
+      except KeyError:
+         pass
+
+   def run_callbacks(self, waker=None, mask=0):
+      """Run what other threads passed to call_soon_threadsafe().  (Called by the main
+      loop when `waker_r' is readable.)"""
+      try:
+         while len(self.waker_r.recv(RECV_MAX)) == RECV_MAX:
+            pass
+      except BlockingIOError:
+         pass
+
+      while len(self.callbacks) > 0:
+         callback, args = self.callbacks.popleft()
+         try:
+            callback(*args)
+         except Exception:
+            logging.error("Error in a callback:\n" + traceback.format_exc())
+
+   def output_drained(self, client):
+      """Called when a client that overflowed is down to half its limit again."""
+      server = client.subscribedTo
+      if server is not None and client in server.paused_by:
+         server.paused_by.remove(client)
+         self.update_events(server)
+
+   ###
+   ### MAIN LOOP
+   ###
+
+   def setup_servers(self):
+      """Create a RemoteServer for everything in the `servers' section of the config."""
       for name, proto in self.cfg['servers'].items(): # (k, v)
+         if not self.owns(name):
+            continue
+
+         if len(self.links) > 0:
+            # (Its filters are set up in its worker.)
+            self.servers[name] = ShardedServer(proto['host'], proto['port'], name,
+                                               self.links[self.assignment[name]],
+                                               self.world_numbers[name])
+            self.servers[name].settings = proto
+            self.servers[name].watcher = self
+            self.worlds[self.world_numbers[name]] = self.servers[name]
+            continue
+
          self.servers[name] = RemoteServer(proto['host'], proto['port'], name)
+         self.worlds[self.world_numbers[name]] = self.servers[name]
+         self.servers[name].cork = self.cork
+         self.servers[name].settings = proto
+         self.servers[name].filter_pool = self.filter_pool
+         self.servers[name].offload_high_water = self.cfg.get('offload_high_water', OFFLOAD_HIGH_WATER)
 
          if 'encoding' in proto:
-            self.servers[name].encoding = proto['encoding']
+            try:
+               self.servers[name].set_encoding(proto['encoding'])
+            except LookupError:
+               logging.error("Unknown encoding {} for server {}; using {}".format(
+                  repr(proto['encoding']), name, ENCODING))
+         if proto.get('decode', 'auto') in DECODE_MODES:
+            self.servers[name].decode = proto.get('decode', 'auto')
+         else:
+            logging.error("Unknown decode setting {} for server {}; should be one of {}".format(
+               repr(proto['decode']), name, ', '.join(DECODE_MODES)))
          if 'ssl' in proto and proto['ssl'] is True:
             self.servers[name].use_SSL = True
+            self.servers[name].tls_context = connector.make_tls_context(
+               verify=proto.get('ssl_verify', False),
+               ca_file=proto.get('ssl_ca_file', None),
+               resume=proto.get('ssl_resume', True))
+         if proto.get('compress', False) is True:
+            self.servers[name].accept_compression()
 
          server_filters = self.cfg.get('filter_servers', [])
          try:
@@ -858,99 +2360,645 @@ class Proxy:
          except FilterSpecificationError as e:
             logging.error("Error while setting up filters: {}".format(str(e)))
 
-      client_filters = self.cfg.get('filter_clients', [])
+   def setup_clients(self):
+      """Read the client-related parts of the config.  Returns False if they're wrong."""
+      self.client_filters = self.cfg.get('filter_clients', [])
+
+      self.client_high_water = self.cfg.get('client_high_water', CLIENT_HIGH_WATER)
+      if self.cfg.get('client_overflow_policy', 'drop_oldest') not in OVERFLOW_POLICIES:
+         logging.error("client_overflow_policy must be one of {}".format(', '.join(OVERFLOW_POLICIES)))
+         return False
+
+      self.compress_flush = self.cfg.get('compress_clients', False)
+      if self.compress_flush is True:
+         self.compress_flush = 'line'
+      if self.compress_flush not in [False, 'line', 'tick']:
+         logging.error("compress_clients must be false, true, 'line' or 'tick'")
+         self.compress_flush = False
+
+      return True
+
+   def get_bind_address(self):
+      """Where to listen for clients, as a (host, port) pair, or None if the config is
+      wrong."""
+      bind_to_host = self.cfg.get("bind_to_host", BIND_TO_HOST)
+      bind_to_port = self.cfg.get("bind_to_port", BIND_TO_PORT)
+      if type(bind_to_host) != str:
+         logging.error("Error: host to bind to must be a string")
+         return None
+      if type(bind_to_port) != int:
+         logging.error("Error: port to bind to must be a string")
+         return None
+      return (bind_to_host, bind_to_port)
+
+   def add_client(self, connection, address):
+      """Start looking after a newly accepted client `connection'."""
+      if cfg.get("warn_about_connections", True):
+         self.wall("A client has connected from {}.".format(repr(address)))
+
+      client = LocalClient(connection)
+      client.address = address
+      client.high_water = self.client_high_water
+      self.watch(connection, client)
+      self.set_state(connection, 'unauthenticated')
+
+      if self.compress_flush:
+         client.offer_compression(self.compress_flush)
 
       try:
-         def do_accept(socket, mask):
-            logging.info("Accepting new client...")
+         client.add_filters(self.client_filters, self.filter_prototypes)
+      except FilterSpecificationError as e:
+         client.tell_err("Error setting up client filters: {}".format(str(e)))
 
-            # When SSL is turned on, this can block waiting for the client to send an SSL handshake.
-            # Maybe consider running it in a thread, too?  (That's a lot of threading though.  And
-            # clients are more under our control than remote servers are.)
-            try:
-               connection, address = socket.accept() # and hope it works
-            except ssl.SSLError as e:
-               logging.error("SSL error in do_accept(): {}".format(e))
-               return
-            except Exception:
-               kind, val, traceback = sys.exc_info()
-               logging.error("Error in do_accept(): {}".format(val))
-               return
+      return client
 
-            logging.info("Accepted {} from {} (mask={}).".format(repr(connection), repr(address), repr(mask)))
+   def start_handshake(self, connection, address):
+      """Start the TLS handshake with a newly accepted `connection'.  It's finished by
+      continue_handshake() as the client's data arrives, so a slow client can't hold up
+      everyone else."""
+      connection.setblocking(False)
+      try:
+         connection = self.tls_ctx_local.wrap_socket(connection, server_side=True,
+                                                     do_handshake_on_connect=False)
+      except OSError as e:
+         logging.error("Error setting up TLS for {}: {}".format(repr(address), e))
+         connection.close()
+         return
 
-            if cfg.get("warn_about_connections", True):
-               self.wall("A client has connected from {}.".format(repr(address)))
+      self.handshakes[connection] = (address, time.monotonic())
+      self.sel.register(connection, selectors.EVENT_READ, self.continue_handshake)
+      self.continue_handshake(connection)
 
-            self.socket_wrappers[connection] = LocalClient(connection)
-            self.unauthenticated_sockets += [connection]
-            self.sel.register(connection, selectors.EVENT_READ)
+   def continue_handshake(self, connection, mask=0):
+      """Take the TLS handshake on `connection' as far as it'll go right now."""
+      address, started = self.handshakes[connection]
 
-            try:
-               self.socket_wrappers[connection].add_filters(client_filters, self.filter_prototypes)
-            except FilterSpecificationError as e:
-               self.socket_wrappers[connection].tell_err("Error setting up client filters: {}".format(str(e)))
+      try:
+         connection.do_handshake()
 
-         server = socket.socket()
-         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      except ssl.SSLWantReadError:
+         self.sel.modify(connection, selectors.EVENT_READ, self.continue_handshake)
+         return
 
-         bind_to_host = self.cfg.get("bind_to_host", BIND_TO_HOST)
-         bind_to_port = self.cfg.get("bind_to_port", BIND_TO_PORT)
-         if type(bind_to_host) != str:
-            logging.error("Error: host to bind to must be a string")
-            return
-         if type(bind_to_port) != int:
-            logging.error("Error: port to bind to must be a string")
-            return
-         server.bind((bind_to_host, bind_to_port))
+      except ssl.SSLWantWriteError:
+         self.sel.modify(connection, selectors.EVENT_WRITE, self.continue_handshake)
+         return
+
+      except (ssl.SSLError, OSError) as e:
+         logging.error("TLS handshake with {} failed: {}".format(repr(address), e))
+         self.stats['tls_handshake_failed'] += 1
+         self.drop_handshake(connection)
+         return
+
+      self.latency['tls_handshake'].add(time.monotonic() - started)
+
+      self.sel.unregister(connection)
+      del self.handshakes[connection]
+
+      logging.info("Accepted {} from {}.".format(repr(connection), repr(address)))
+      self.add_client(connection, address)
+
+   def drop_handshake(self, connection):
+      self.sel.unregister(connection)
+      del self.handshakes[connection]
+      connection.close()
+
+   def expire_handshakes(self):
+      """Give up on clients that have been at the TLS handshake for too long."""
+      timeout = self.cfg.get('tls_handshake_timeout', TLS_HANDSHAKE_TIMEOUT)
+      now = time.monotonic()
+
+      for connection, (address, started) in list(self.handshakes.items()):
+         if now - started > timeout:
+            logging.warning("TLS handshake with {} timed out.".format(repr(address)))
+            self.stats['tls_handshake_timeout'] += 1
+            self.drop_handshake(connection)
+
+   def listen(self):
+      """Start listening for clients.  Returns False if the config says to listen
+      somewhere impossible."""
+      bind_address = self.get_bind_address()
+      if bind_address is None:
+         return False
+
+      self.sel.register(self.make_listener(bind_address), selectors.EVENT_READ, self.accept_client)
+      logging.info("Listening.")
+      return True
+
+   def accept_client(self, listener, mask):
+      logging.info("Accepting new client...")
+
+      # The listening socket is a plain one, so this doesn't wait for the TLS
+      # handshake; that's done bit by bit in the main loop (see start_handshake.)
+      try:
+         connection, address = listener.accept()
+      except BlockingIOError:
+         return
+      except Exception:
+         kind, val, t = sys.exc_info()
+         logging.error("Error in accept_client(): {}".format(val))
+         return
+
+      self.start_handshake(connection, address)
+
+   def connection_event(self, s, mask):
+      """Handle the selector's news about a watch()'ed connection."""
+      ss = self.socket_wrappers.get(s)
+      if ss is None:
+         return # it was closed by something earlier in this batch
+
+      if mask & selectors.EVENT_WRITE:
+         ss.flush()
+
+      if not mask & selectors.EVENT_READ:
+         return
+
+      (lines, eof) = ss.read()
+
+      if eof:
+         self.close_connection(s)
+
+      self.handle_lines(s, lines)
 
-         server = self.tls_ctx_local.wrap_socket(server, server_side=True)
+   def handle_lines(self, s, lines):
+      """Pass `lines', just read from `s', to the handler for the state `s' is in.  (If
+      one of them changes the state, the handler passes the rest back here.)"""
+      wrapper = self.socket_wrappers.get(s)
+      if wrapper is None or wrapper.state is None or len(lines) == 0:
+         return # it's been closed, or there's nothing to do
 
-         server.listen(100)
-         server.setblocking(False)
-         self.sel.register(server, selectors.EVENT_READ)
+      self.states[wrapper.state][1](s, lines)
+
+   def run(self):
+      # I'm not sure how much sense it makes to do this here and not in __init__ but oh well.
+      if not self.setup_workers():
+         return
+      self.setup_servers()
+      if not self.setup_clients():
+         return
+
+      try:
+         if not self.listen():
+            return
+         self.sel.register(self.waker_r, selectors.EVENT_READ, self.run_callbacks)
 
-         logging.info("Listening.")
+         if self.inherited is not None:
+            self.finish_handoff()
+         handoff.notify_systemd("READY=1")
 
          while True:
-            events = self.sel.select(timeout = 1)
+            events = self.sel.select(timeout = self.time_to_next_timer(1))
 
             self.LOCK.acquire()
+            self.cork.cork()
 
+            # Everything registered with the selector carries the function that
+            # handles its events (see connection_event() for the usual one.)
             for key, mask in events:
-               s = key.fileobj
-               if s == server:
-                  do_accept(s, mask)
-               else:
-                  if s in self.socket_wrappers:
-                     ss = self.socket_wrappers[s]
-                  else:
-                     raise Exception("Read on unregistered socket")
-                     break
-
-                  (lines, eof) = ss.read()
-
-                  if eof:
-                     self.sel.unregister(s)
-                     ss.handle_disconnect()
-                     for state in self.states:
-                        if s in state[0]:
-                           del state[0][state[0].index(s)]
-                     if s in self.socket_wrappers:
-                        del self.socket_wrappers[s]
-
-                  for line in lines:
-                     for state in self.states:
-                        if s in state[0]:
-                           result = state[1](s, line)
-                           if result:
-                              break # to next line
+               key.data(key.fileobj, mask)
+
+            if len(self.handshakes) > 0:
+               self.expire_handshakes()
+
+            self.run_timers()
 
+            self.cork.uncork()
             self.LOCK.release()
 
       except KeyboardInterrupt:
          logging.info("Caught KeyboardInterrupt; quitting...")
 
+      finally:
+         self.connector.shutdown()
+
+
+###
+### ASYNCIO ENGINE
+###
+
+# An alternative to Proxy.run()'s selectors loop, picked with `"engine": "asyncio"' in
+# config.json.  Everything above the transport layer is shared: the connections are
+# the same classes, and the transports take the place of sockets in the proxy's lists
+# and in `socket_wrappers', so the states, commands and plugins don't know the
+# difference.  uvloop is used if it's installed.
+
+
+class LoopCork(OutputCork):
+   """An OutputCork that's always corked; the first write of a pass through the event
+   loop schedules a flush of everything written during that pass for the next one."""
+   def __init__(self, loop):
+      super().__init__()
+      self.loop = loop
+      self.corked = True
+
+   def hold(self, c):
+      if len(self.pending) == 0:
+         self.loop.call_soon(self.uncork)
+      self.pending.add(c)
+
+   def uncork(self):
+      super().uncork()
+      self.corked = True
+
+
+class ConnectionProtocol(asyncio.Protocol):
+   """Feeds what arrives on a transport to the connection `wrapper' looks after it,
+   and passes the lines on to the proxy."""
+   def __init__(self, proxy):
+      self.proxy = proxy
+      self.transport = None
+      self.wrapper = None
+
+   def connection_made(self, transport):
+      self.transport = transport
+
+   def data_received(self, data):
+      if self.transport not in self.proxy.socket_wrappers:
+         return
+
+      try:
+         lines = self.wrapper.feed(data)
+      except zlib.error as e:
+         logging.error("Bad MCCP stream, dropping connection: {}".format(e))
+         self.proxy.close_connection(self.transport)
+         return
+
+      self.proxy.handle_lines(self.transport, lines)
+
+   def connection_lost(self, exc):
+      if self.transport in self.proxy.socket_wrappers:
+         self.proxy.close_connection(self.transport)
+
+   def pause_writing(self):
+      # The transport's buffer is past the high-water mark.
+      if self.transport in self.proxy.socket_wrappers and not self.wrapper.overflowed:
+         self.wrapper.overflowed = True
+         self.proxy.output_overflow(self.wrapper)
+
+   def resume_writing(self):
+      if self.wrapper.overflowed:
+         self.wrapper.overflowed = False
+         self.proxy.output_drained(self.wrapper)
+
+
+class ClientProtocol(ConnectionProtocol):
+   def connection_made(self, transport):
+      super().connection_made(transport)
+
+      address = transport.get_extra_info('peername')
+      logging.info("Accepted {} from {}.".format(repr(transport), repr(address)))
+
+      high_water = self.proxy.client_high_water
+      transport.set_write_buffer_limits(high=high_water, low=high_water // 2)
+
+      self.wrapper = self.proxy.add_client(transport, address)
+
+
+class ServerProtocol(ConnectionProtocol):
+   def __init__(self, proxy, server, state=None):
+      super().__init__(proxy)
+      self.server = server
+      self.state = state   # to carry on from, after a hot restart
+
+   def connection_made(self, transport):
+      super().connection_made(transport)
+
+      self.wrapper = self.server
+      self.server.attach_socket(transport)
+      if self.state is not None:
+         self.server.restore_state(self.state)
+      self.proxy.watch(transport, self.server)
+      self.proxy.set_state(transport, 'server')
+
+
+class LinkProtocol(ConnectionProtocol):
+   def __init__(self, proxy, link):
+      super().__init__(proxy)
+      self.link = link
+
+   def connection_made(self, transport):
+      super().connection_made(transport)
+
+      self.wrapper = self.link
+      self.link.attach_socket(transport)
+      self.proxy.watch(transport, self.link)
+      self.proxy.set_state(transport, 'link')
+
+   # A worker that's behind can't have frames dropped on it; it just has to catch up.
+   def pause_writing(self):
+      pass
+
+   def resume_writing(self):
+      pass
+
+
+class AsyncioProxy(Proxy):
+   """A Proxy that runs on an asyncio event loop instead of its own selectors loop.
+   TLS handshakes happen on the loop too, so no LOCK is needed."""
+   def __init__(self, cfg):
+      super().__init__(cfg)
+
+      if uvloop is not None:
+         self.loop = uvloop.new_event_loop()
+      else:
+         self.loop = asyncio.new_event_loop()
+
+      self.cork = LoopCork(self.loop)
+
+      self.connector.handshake_tls = False
+      self.handshaking_servers = set()
+
+   def call_soon_threadsafe(self, callback, *args):
+      self.loop.call_soon_threadsafe(callback, *args)
+
+   def ssl_object(self, socket):
+      return socket.get_extra_info('ssl_object')
+
+   def can_hand_off(self, server):
+      """Overridden to check the transport's own buffer too."""
+      return server.transport.get_write_buffer_size() == 0
+
+   def fileno(self, socket):
+      if isinstance(socket, asyncio.BaseTransport):
+         return socket.get_extra_info('socket').fileno()
+      return socket.fileno()
+
+   def adopt_server(self, server, conn, state):
+      conn.setblocking(False)
+      self.loop.create_task(
+         self.loop.create_connection(lambda: ServerProtocol(self, server, state), sock=conn))
+
+   def add_link(self, link, sock):
+      sock.setblocking(False)
+      self.loop.create_task(
+         self.loop.create_connection(lambda: LinkProtocol(self, link), sock=sock))
+
+   def update_events(self, wrapper):
+      """Overridden to pause and resume reading from the transport; writing is the
+      transport's business."""
+      if type(wrapper) is ShardedServer:
+         wrapper.update_pause()
+         return
+
+      if not wrapper.connected or wrapper.socket not in self.socket_wrappers:
+         return
+
+      if wrapper.want_read() != wrapper.transport.is_reading():
+         if wrapper.want_read():
+            wrapper.transport.resume_reading()
+         else:
+            wrapper.transport.pause_reading()
+
+   def close_connection(self, socket):
+      """Overridden to abort, rather than close, the transports of clients that fell
+      too far behind: closing waits for the output to drain, which it may never do."""
+      stuck = self.socket_wrappers[socket].overflowed
+      super().close_connection(socket)
+      if stuck:
+         socket.abort()
+
+   def call_later(self, delay, callback, *args):
+      return self.loop.call_later(delay, callback, *args)
+
+   def watch_fd(self, sock, events, callback):
+      self.unwatch_fd(sock)
+      if events & selectors.EVENT_READ:
+         self.loop.add_reader(sock, callback, sock, selectors.EVENT_READ)
+      if events & selectors.EVENT_WRITE:
+         self.loop.add_writer(sock, callback, sock, selectors.EVENT_WRITE)
+
+   def unwatch_fd(self, sock):
+      self.loop.remove_reader(sock)
+      self.loop.remove_writer(sock)
+
+   def start_connection(self, server):
+      """Overridden to wait for any TLS handshake left over from the last attempt."""
+      if server in self.handshaking_servers:
+         return False
+      return super().start_connection(server)
+
+   def connection_ready(self, server, sock):
+      """Overridden to make a transport out of `sock', doing the TLS handshake (which the
+      connection manager leaves to us) on the way."""
+      if server.use_SSL:
+         self.handshaking_servers.add(server)
+      self.loop.create_task(self.make_transport(server, sock))
+
+   async def make_transport(self, server, sock):
+      started = time.monotonic()
+
+      try:
+         if server.use_SSL:
+            timeout = self.connector.setting(server, 'connect_timeout', connector.CONNECT_TIMEOUT)
+            transport, protocol = await self.loop.create_connection(
+               lambda: ServerProtocol(self, server), sock=sock,
+               ssl=server.tls_context, server_hostname=server.host,
+               ssl_handshake_timeout=timeout)
+            self.connector.tls_done(server, started, transport.get_extra_info('ssl_object'))
+         else:
+            await self.loop.create_connection(lambda: ServerProtocol(self, server), sock=sock)
+
+      except (ssl.SSLError, OSError, asyncio.TimeoutError) as e:
+         sock.close()
+         server.stats['connect_failures'] += 1
+         server.warn_all("Connection attempt failed during the TLS handshake: {}".format(repr(e)))
+         self.connector.failed(server)
+
+      finally:
+         self.handshaking_servers.discard(server)
+
+   def run(self):
+      if not self.setup_workers():
+         return
+      self.setup_servers()
+      if not self.setup_clients():
+         return
+
+      bind_address = self.get_bind_address()
+      if bind_address is None:
+         return
+
+      asyncio.set_event_loop(self.loop)
+
+      try:
+         listener = self.loop.run_until_complete(
+            self.loop.create_server(lambda: ClientProtocol(self),
+                                    sock=self.make_listener(bind_address),
+                                    ssl=self.tls_ctx_local, backlog=100,
+                                    ssl_handshake_timeout=self.cfg.get('tls_handshake_timeout',
+                                                                       TLS_HANDSHAKE_TIMEOUT)))
+
+         if self.inherited is not None:
+            self.finish_handoff()
+         handoff.notify_systemd("READY=1")
+
+         logging.info("Listening (asyncio{}).".format(", uvloop" if uvloop is not None else ""))
+
+         self.loop.run_forever()
+
+      except KeyboardInterrupt:
+         logging.info("Caught KeyboardInterrupt; quitting...")
+
+      finally:
+         self.connector.shutdown()
+
+
+###
+### WORKER PROCESSES
+###
+
+# What runs in a worker process (see shard.py and Proxy.setup_workers.)  Workers always
+# use the selectors engine; they have no clients of their own.
+
+
+class ShardRelay:
+   """Subscribed to each of a worker's worlds in place of the clients, which are in the
+   front process: passes everything on to it over `link'."""
+   def __init__(self, link, number):
+      self.link = link
+      self.number = number
+      self.listening = False  # whether any client in the front is subscribed
+
+   def write_segment(self, segment):
+      self.link.send(shard.LINE, self.number, segment)
+
+   def tell_ok(self, msg):
+      self.link.send(shard.TELL_OK, self.number, msg.encode('utf-8'))
+
+   def tell_err(self, msg):
+      self.link.send(shard.TELL_ERR, self.number, msg.encode('utf-8'))
+
+
+class RelayClient:
+   """Stands in for a client of the front process while a command it forwarded runs in
+   the worker.  Whatever the command writes to the client is collected in `output',
+   to be sent back in one go."""
+   def __init__(self, server, high_water=None):
+      self.subscribedTo = server
+      self.high_water = high_water   # the front's limit for the real client
+      self.output = bytearray()
+      self.stats = collections.Counter()
+      self.address = None
+      self.connected = True
+
+   def write_segment(self, data):
+      self.output += data
+
+   def pending_output(self):
+      return len(self.output)
+
+   def write(self, data):
+      self.output += telnet.escape(data)
+
+   def write_line(self, line):
+      self.output += telnet.escape(line.as_bytes())
+
+   def write_str(self, data):
+      self.output += telnet.escape(data.encode(ENCODING))
+
+   def tell_ok(self, msg):
+      self.write_str(MESSAGE_PREFIX_OK + msg + "\r\n")
+
+   def tell_err(self, msg):
+      self.write_str(MESSAGE_PREFIX_ERR + msg + "\r\n")
+
+
+class WorkerProxy(Proxy):
+   """Runs the worlds the front process gave worker number `index', and talks to the
+   front over `link_socket' instead of to clients."""
+   def __init__(self, cfg, index, link_socket):
+      super().__init__(cfg)
+
+      self.index = index
+      self.front = ShardLink(index)
+      self.link_socket = link_socket
+      self.relays = {}   # a ShardRelay for each world, by number
+
+   def setup_workers(self):
+      """Overridden to connect to the front instead of starting workers."""
+      self.world_numbers = shard.world_numbers(self.cfg['servers'])
+      self.assignment = shard.assign(self.cfg['servers'], self.cfg['workers'])
+      self.add_link(self.front, self.link_socket)
+      return True
+
+   def owns(self, name):
+      return self.assignment[name] == self.index
+
+   def setup_servers(self):
+      super().setup_servers()
+
+      for name, server in self.servers.items():
+         number = self.world_numbers[name]
+         self.relays[number] = ShardRelay(self.front, number)
+         server.subscribe(self.relays[number])
+
+   def listen(self):
+      logging.info("Worker {} running {}.".format(self.index, ', '.join(sorted(self.servers)) or "nothing"))
+      return True
+
+   def handle_frame(self, link, frame):
+      """Overridden to handle what the front sends."""
+      server = self.worlds.get(frame.world)
+      if server is None:
+         logging.warning("The front sent something about a world this worker doesn't have.")
+         return
+
+      kind = frame.kind
+
+      if kind == shard.LINE:
+         if server.connected:
+            server.write_line(server.make_line(frame.payload))
+      elif kind == shard.CONNECT:
+         self.start_connection(server)
+      elif kind == shard.PAUSE:
+         server.paused_by.add(self.relays[frame.world])
+         self.update_events(server)
+      elif kind == shard.RESUME:
+         server.paused_by.discard(self.relays[frame.world])
+         self.update_events(server)
+      elif kind == shard.LISTENING:
+         self.relays[frame.world].listening = frame.payload == b'1'
+      elif kind == shard.COMMAND:
+         self.run_command(frame.world, server, frame.payload)
+      else:
+         logging.warning("The front sent a frame of unknown kind {}.".format(kind))
+
+   def run_command(self, number, server, payload):
+      """Run a command forwarded by the front, and send back what it said."""
+      token, name, args = shard.read_command(payload)
+      client = RelayClient(server, self.cfg.get('client_high_water', CLIENT_HIGH_WATER))
+
+      try:
+         if name == 'stats':
+            self.tell_server_stats(server, client)
+         elif name in self.client_commands:
+            self.client_commands[name](args, client)
+         else:
+            client.tell_err("Command `{}' not found.".format(name))
+
+      except Exception:
+         kind, value, t = sys.exc_info()
+         client.tell_err("Error during command processing: {}".format(repr(value)))
+         logging.error("COMMAND PROCESSING ERROR\n========================\n\n" + traceback.format_exc())
+
+      self.front.send(shard.REPLY, number, shard.reply(token, bytes(client.output)))
+
+   def connection_ready(self, server, sock):
+      super().connection_ready(server, sock)
+      self.front.send(shard.STATUS, self.world_numbers[server.name], b'1')
+
+   def close_connection(self, socket):
+      wrapper = self.socket_wrappers[socket]
+      super().close_connection(socket)
+
+      if type(wrapper) is RemoteServer:
+         self.front.send(shard.STATUS, self.world_numbers[wrapper.name], b'0')
+
+   def worker_lost(self, link):
+      """Overridden: the link that's gone is the one to the front, so it's time to go."""
+      logging.info("Worker {}: the front process has gone.".format(self.index))
+      raise KeyboardInterrupt()
+
 
 ###
 ### STARTUP / initialization
@@ -963,7 +3011,20 @@ if __name__ == '__main__':
       logging.error("Must have configuration")
       exit(1)
 
-   proxy = Proxy(cfg)
+   # Were we started by Proxy.start_worker()?
+   worker = os.environ.pop(shard.WORKER_ENV, None)
+
+   engine = cfg.get('engine', 'selectors')
+   if worker is not None:
+      index, fd = worker.split()
+      proxy = WorkerProxy(cfg, int(index), socket.socket(fileno=int(fd)))
+   elif engine == 'asyncio':
+      proxy = AsyncioProxy(cfg)
+   elif engine == 'selectors':
+      proxy = Proxy(cfg)
+   else:
+      logging.error("engine must be 'selectors' or 'asyncio'")
+      exit(1)
 
    pluginDir = cfg.get('plugin_directory', "plugins")
    plugin_err_fatal = cfg.get('plugin_errors_fatal', True)
@@ -984,6 +3045,11 @@ if __name__ == '__main__':
          if plugin_err_fatal:
             raise value
 
+   # Were we started by Proxy.hot_restart()?
+   handoff_fd = os.environ.pop(handoff.HANDOFF_ENV, None)
+   if handoff_fd is not None:
+      proxy.receive_handoff(socket.socket(fileno=int(handoff_fd)))
+
    try:
       proxy.run()
 
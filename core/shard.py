@@ -0,0 +1,119 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Splitting the worlds between worker processes (`"workers": N' in config.json.)
+#
+# The process the user starts (the "front") keeps the listening socket and the
+# clients; each world, with its connection and its server filters, lives in one of N
+# worker processes, which the front starts with the same command line and one end of
+# a Unix socketpair.  The worker finds out which it is, and which file descriptor to
+# talk to the front on, from the environment variable named by WORKER_ENV.
+#
+# Over the socketpair go frames: a header (kind, world, payload length) followed by
+# the payload.  Worlds are numbered by their place in the sorted list of server names
+# in the config, which both ends read for themselves.
+#
+#    front -> worker                       worker -> front
+#    LINE     a line from a client         LINE      (escaped) text from the world
+#    CONNECT  connect to the world         TELL_OK   a message for the world's clients
+#    PAUSE    stop reading from it         TELL_ERR  a warning for them
+#    RESUME   carry on reading             STATUS    b'1' connected, b'0' not
+#    COMMAND  [token, command, args]       REPLY     token, then what the command said
+#             (JSON), to run there
+#    LISTENING b'1' if any client is
+#             subscribed to the world, b'0'
+#             if none are
+
+import struct
+import json
+import collections
+
+
+WORKER_ENV = 'TCPHYDRA_WORKER'   # "<worker number> <file descriptor>"
+WORKER_RESPAWN_DELAY = 5 # seconds before replacing a worker that died
+
+LINE = 1
+TELL_OK = 2
+TELL_ERR = 3
+STATUS = 4
+CONNECT = 5
+PAUSE = 6
+RESUME = 7
+COMMAND = 8
+REPLY = 9
+LISTENING = 10
+
+Frame = collections.namedtuple('Frame', ['kind', 'world', 'payload'])
+
+_HEADER = struct.Struct('!BHI')
+_TOKEN = struct.Struct('!I')
+
+
+def frame(kind, world, payload=b''):
+   """The bytes for one frame."""
+   return _HEADER.pack(kind, world, len(payload)) + payload
+
+
+class FrameReader:
+   """Reassembles frames from whatever pieces of the stream arrive."""
+   def __init__(self):
+      self.buffer = bytearray()
+
+   def feed(self, data):
+      """Returns a list of the Frame's `data' completes."""
+      buf = self.buffer
+      buf += data
+
+      frames = []
+      start = 0
+      while len(buf) - start >= _HEADER.size:
+         kind, world, length = _HEADER.unpack_from(buf, start)
+         end = start + _HEADER.size + length
+         if end > len(buf):
+            break
+         frames.append(Frame(kind, world, bytes(buf[start + _HEADER.size:end])))
+         start = end
+
+      if start > 0:
+         del buf[:start]
+
+      return frames
+
+
+def command(token, name, args):
+   return json.dumps([token, name, args]).encode('utf-8')
+
+
+def read_command(payload):
+   """Returns `(token, name, args)'."""
+   return tuple(json.loads(payload.decode('utf-8')))
+
+
+def reply(token, output):
+   return _TOKEN.pack(token) + output
+
+
+def read_reply(payload):
+   """Returns `(token, output)'."""
+   return (_TOKEN.unpack_from(payload)[0], payload[_TOKEN.size:])
+
+
+def world_numbers(servers):
+   """Number the worlds in the `servers' section of the config."""
+   return {name: n for n, name in enumerate(sorted(servers))}
+
+
+def assign(servers, n_workers):
+   """Which worker (0 .. n_workers-1) each world in `servers' goes to: the one its
+   `worker' setting names, or else the next in turn."""
+   assignment = {}
+   turn = 0
+
+   for name in sorted(servers):
+      worker = servers[name].get('worker')
+      if type(worker) is int and worker >= 0 and worker < n_workers:
+         assignment[name] = worker
+      else:
+         assignment[name] = turn % n_workers
+         turn += 1
+
+   return assignment
@@ -0,0 +1,279 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# An incremental Telnet (RFC 854) codec.  It doesn't touch sockets: you feed() it
+# whatever bytes arrived and it hands back the text with the commands taken out, plus
+# a list of events describing the commands.  Anything it needs to say back to the
+# other end (answers to option negotiation) piles up until take_output() is called.
+#
+# Option negotiation follows the spirit of RFC 1143 (the "Q method") without the
+# queue bits: we never answer a reply to something we asked for ourselves, and we
+# only answer a request when it actually changes the state of an option, so the two
+# ends can't get into a loop.
+
+import collections
+
+
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+GA = 249
+NOP = 241
+SE = 240
+
+# Some options we know the names of.
+ECHO = 1
+SGA = 3
+TTYPE = 24
+EOR = 25
+NAWS = 31
+COMPRESS2 = 86  # MCCP2
+
+# Subnegotiations longer than this are cut short; nobody legitimate sends them, and
+# otherwise a broken server could make us buffer forever.
+SB_MAX = 65536
+
+# Parser states.
+TEXT = 0
+COMMAND = 1
+NEGOTIATE = 2
+SB_OPTION = 3
+SB_DATA = 4
+SB_IAC = 5
+
+# Events produced by TelnetCodec.feed():
+Command = collections.namedtuple('Command', ['command'])
+OptionChange = collections.namedtuple('OptionChange', ['option', 'local', 'enabled'])
+Subnegotiation = collections.namedtuple('Subnegotiation', ['option', 'payload'])
+
+_IAC = bytes([IAC])
+_IAC_IAC = bytes([IAC, IAC])
+
+
+def escape(data):
+   """Double any IAC bytes in `data' so they go over the wire as literal 255s."""
+   if IAC in data:
+      return data.replace(_IAC, _IAC_IAC)
+   return data
+
+
+class TelnetCodec:
+   """Incremental Telnet parser and option negotiator for one connection.
+
+   `local_options' are the options we're willing to turn on at our end (we answer DO
+   with WILL), and `remote_options' are the ones we're happy for the other end to turn
+   on (we answer WILL with DO).  Everything else is refused."""
+   def __init__(self, local_options=(), remote_options=()):
+      self.supported_local = set(local_options)
+      self.supported_remote = set(remote_options)
+
+      # feed() stops right after a subnegotiation for any of these options, so that the
+      # caller can change how it reads what follows (MCCP, for instance.)  How far
+      # feed() got is left in `consumed'.
+      self.interrupt_after = set()
+      self.consumed = 0
+
+      self.reset()
+
+   def reset(self):
+      """Forget everything about the current connection (but not which options are
+      supported.)"""
+      self.local = set()            # options currently enabled at our end
+      self.remote = set()           # options currently enabled at their end
+      self.pending_local = set()    # we sent WILL/WONT and are waiting for the answer
+      self.pending_remote = set()   # we sent DO/DONT and are waiting for the answer
+
+      self.output = bytearray()
+
+      self.state = TEXT
+      self.verb = None
+      self.sb_option = None
+      self.sb_payload = bytearray()
+
+   def save_state(self):
+      """Everything about the connection so far, as plain data (see restore_state().)"""
+      return {'local': sorted(self.local), 'remote': sorted(self.remote),
+              'pending_local': sorted(self.pending_local),
+              'pending_remote': sorted(self.pending_remote),
+              'supported_local': sorted(self.supported_local),
+              'supported_remote': sorted(self.supported_remote),
+              'interrupt_after': sorted(self.interrupt_after),
+              'output': bytes(self.output),
+              'state': self.state, 'verb': self.verb, 'sb_option': self.sb_option,
+              'sb_payload': bytes(self.sb_payload)}
+
+   def restore_state(self, state):
+      """Carry on from where the codec that gave `state' left off."""
+      self.local = set(state['local'])
+      self.remote = set(state['remote'])
+      self.pending_local = set(state['pending_local'])
+      self.pending_remote = set(state['pending_remote'])
+      self.supported_local = set(state['supported_local'])
+      self.supported_remote = set(state['supported_remote'])
+      self.interrupt_after = set(state['interrupt_after'])
+      self.output = bytearray(state['output'])
+      self.state = state['state']
+      self.verb = state['verb']
+      self.sb_option = state['sb_option']
+      self.sb_payload = bytearray(state['sb_payload'])
+
+   def feed(self, data):
+      """Parse `data'.  Returns a pair `(text, events)' where `text' is the data with
+      all Telnet commands removed (and IAC IAC turned back into one 255 byte), and
+      `events' is a list of Command, OptionChange and Subnegotiation tuples in the order
+      they occurred.  A command cut off at the end of `data' is finished by the next
+      call.
+
+      If parsing stopped early because of `interrupt_after', `consumed' will be less
+      than len(data) and the rest should be fed in again once the caller is ready."""
+      text = bytearray()
+      events = []
+
+      pos = 0
+      end = len(data)
+
+      with memoryview(data) as view:
+         while pos < end:
+            state = self.state
+
+            if state == TEXT:
+               t = data.find(IAC, pos)
+               if t == -1:
+                  text += view[pos:]
+                  pos = end
+                  break
+               text += view[pos:t]
+               pos = t + 1
+               self.state = COMMAND
+               continue
+
+            if state == SB_DATA:
+               t = data.find(IAC, pos)
+               if t == -1:
+                  self.add_sb_payload(view[pos:])
+                  pos = end
+                  break
+               self.add_sb_payload(view[pos:t])
+               pos = t + 1
+               self.state = SB_IAC
+               continue
+
+            byte = data[pos]
+            pos += 1
+
+            if state == COMMAND:
+               if byte == IAC:
+                  text.append(IAC)
+                  self.state = TEXT
+               elif byte >= WILL and byte <= DONT:
+                  self.verb = byte
+                  self.state = NEGOTIATE
+               elif byte == SB:
+                  self.state = SB_OPTION
+               else:
+                  events.append(Command(byte))
+                  self.state = TEXT
+
+            elif state == NEGOTIATE:
+               change = self.negotiate(self.verb, byte)
+               if change is not None:
+                  events.append(change)
+               self.state = TEXT
+
+            elif state == SB_OPTION:
+               self.sb_option = byte
+               self.sb_payload = bytearray()
+               self.state = SB_DATA
+
+            elif state == SB_IAC:
+               if byte == IAC:
+                  self.add_sb_payload(_IAC)
+                  self.state = SB_DATA
+               elif byte == SE:
+                  events.append(Subnegotiation(self.sb_option, bytes(self.sb_payload)))
+                  self.sb_payload = bytearray()
+                  self.state = TEXT
+                  if self.sb_option in self.interrupt_after:
+                     break
+               else:
+                  # IAC <something else> in the middle of a subnegotiation: the other
+                  # end forgot to finish it.  Drop it and treat this as a new command.
+                  self.sb_payload = bytearray()
+                  self.state = COMMAND
+                  pos -= 1
+
+      self.consumed = pos
+      return (bytes(text), events)
+
+   def add_sb_payload(self, data):
+      if len(self.sb_payload) + len(data) <= SB_MAX:
+         self.sb_payload += data
+
+   def negotiate(self, verb, option):
+      """Handle one WILL/WONT/DO/DONT from the other end.  Returns an OptionChange if
+      the state of the option changed, otherwise None."""
+      if verb == WILL or verb == WONT:
+         return self.update(option, verb == WILL, False)
+      else:
+         return self.update(option, verb == DO, True)
+
+   def update(self, option, enable, local):
+      if local:
+         enabled, supported, pending = self.local, self.supported_local, self.pending_local
+         yes, no = WILL, WONT
+      else:
+         enabled, supported, pending = self.remote, self.supported_remote, self.pending_remote
+         yes, no = DO, DONT
+
+      answering = option in pending
+      pending.discard(option)
+
+      if enable and option not in enabled:
+         if option in supported:
+            enabled.add(option)
+            if not answering:
+               self.send(yes, option)
+            return OptionChange(option, local, True)
+         elif not answering:
+            self.send(no, option)
+
+      elif not enable and option in enabled:
+         enabled.remove(option)
+         if not answering:
+            self.send(no, option)
+         return OptionChange(option, local, False)
+
+      return None
+
+   def request_local(self, option, enable=True):
+      """Offer (or withdraw) `option' at our end, i.e. send WILL (or WONT)."""
+      if enable:
+         self.supported_local.add(option)
+      if (option in self.local) != enable and option not in self.pending_local:
+         self.pending_local.add(option)
+         self.send(WILL if enable else WONT, option)
+
+   def request_remote(self, option, enable=True):
+      """Ask the other end to enable (or disable) `option', i.e. send DO (or DONT)."""
+      if enable:
+         self.supported_remote.add(option)
+      if (option in self.remote) != enable and option not in self.pending_remote:
+         self.pending_remote.add(option)
+         self.send(DO if enable else DONT, option)
+
+   def send(self, verb, option):
+      self.output += bytes([IAC, verb, option])
+
+   def send_subnegotiation(self, option, payload):
+      """Queue IAC SB `option' `payload' IAC SE."""
+      self.output += bytes([IAC, SB, option])
+      self.output += escape(payload)
+      self.output += bytes([IAC, SE])
+
+   def take_output(self):
+      """Return (and forget) everything we need to send to the other end."""
+      out = bytes(self.output)
+      self.output = bytearray()
+      return out
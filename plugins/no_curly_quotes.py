@@ -23,6 +23,8 @@ class CurlyQuoteFilter:
    
    Could potentially filter other things too, but for now this is
    all it does."""
+   passes_through = ('from_server',)
+
    def __init__(self, connection, options):
       pass
 
@@ -1,5 +1,7 @@
 class SayQuoteStripper:
     """Removes extraneous quotes at the end of a 'say' command."""
+    passes_through = ('from_server',)
+
     def __init__(self, connection, options):
         pass
 
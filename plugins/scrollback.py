@@ -1,36 +1,455 @@
 # vim: tabstop=3:shiftwidth=3:expandtab:autoindent
 
-import collections
+import os
+import re
+import mmap
+import time
+import struct
+import logging
+from array import array
+
+import ansi
+import telnet
+
+DEFAULT_BYTES = 262144 # of scrollback kept per world, unless `bytes' says otherwise
 
 # We'll maintain the histories indexed by-connection:
 histories = {}
 
+# A ring kept in a file (see Ring.open()) starts with this header, then the times,
+# starts and lengths of the lines, then the lines themselves.
+RING_MAGIC = b'THSCROLL'
+RING_VERSION = 1
+RING_HEADER = struct.Struct('<8sIIQQQQQQ')   # magic, version, (spare), budget,
+                                              # max_lines, first, count, pos, used
+
+class Ring:
+   """The last `max_lines' lines (as bytes), in a buffer of `budget' bytes allocated up
+   front.  The lines are stored one after another, wrapping round at the end of the
+   buffer, and the oldest ones make way when there isn't room for a new one.
+
+   Where each line starts, and how long it is, are kept in two more rings, of
+   `max_lines' unsigned ints each, and when it arrived (time.time()) in a third."""
+   def __init__(self, budget, max_lines):
+      self.data = bytearray(budget)
+      self.starts = array('I', bytes(4 * max_lines))
+      self.lengths = array('I', bytes(4 * max_lines))
+      self.times = array('d', bytes(8 * max_lines))
+
+      self.first = 0    # the oldest line's index in starts/lengths
+      self.count = 0    # lines
+      self.pos = 0      # where the next line goes in data
+      self.used = 0     # bytes
+
+      self.map = None   # the mmap, if it's kept in a file
+      self.path = None
+
+   @classmethod
+   def open(cls, path, budget, max_lines):
+      """A Ring kept in the file `path' (made if need be), so that it's still there
+      after the proxy stops.  The file is mapped into memory, and only its header is
+      read now; the rest is paged in when it's wanted."""
+      size = RING_HEADER.size + 16 * max_lines + budget
+
+      try:
+         f = open(path, 'r+b')
+      except FileNotFoundError:
+         f = open(path, 'w+b')
+
+      with f:
+         old = os.fstat(f.fileno()).st_size
+         if old != size:
+            if old >= RING_HEADER.size:
+               header = RING_HEADER.unpack(f.read(RING_HEADER.size))
+               if header[0] == RING_MAGIC and header[1] == RING_VERSION \
+                  and old == RING_HEADER.size + 16 * header[4] + header[3]:
+                  return cls.resize(path, budget, max_lines, header)
+            f.truncate(0)
+            f.truncate(size)
+         m = mmap.mmap(f.fileno(), size)
+
+      ring = cls.__new__(cls)
+      ring.map = m
+      ring.path = path
+
+      ring.view = view = memoryview(m)
+      at = RING_HEADER.size
+      ring.times = view[at:at + 8 * max_lines].cast('d')
+      at += 8 * max_lines
+      ring.starts = view[at:at + 4 * max_lines].cast('I')
+      at += 4 * max_lines
+      ring.lengths = view[at:at + 4 * max_lines].cast('I')
+      at += 4 * max_lines
+      ring.data = view[at:]
+
+      ring.load_header()
+      return ring
+
+   @classmethod
+   def resize(cls, path, budget, max_lines, header):
+      """Open `path', which was made with a different budget or max_lines, by copying
+      what it has into a new file of the right size."""
+      logging.info("Resizing scrollback file {}.".format(path))
+      old = cls.open(path, header[3], header[4])
+      new = cls.open(path + '.new', budget, max_lines)
+      new.clear()
+      for x in range(len(old)):
+         new.append(old.get(x), old.time_of(x))
+      new.close()
+      old.close()
+      os.replace(path + '.new', path)
+      return cls.open(path, budget, max_lines)
+
+   def load_header(self):
+      """Read first, count, pos and used from the file.  If they don't make sense
+      (it's new, say), start again from empty."""
+      magic, version, spare, budget, max_lines, first, count, pos, used = \
+         RING_HEADER.unpack_from(self.map)
+      if magic != RING_MAGIC or version != RING_VERSION or budget != len(self.data) \
+         or max_lines != len(self.starts) or count > max_lines or used > budget \
+         or (first >= max_lines and max_lines > 0) or (pos >= budget and budget > 0):
+         self.clear()
+         return
+
+      self.first, self.count, self.pos, self.used = first, count, pos, used
+
+   def save_header(self):
+      if self.map is not None:
+         RING_HEADER.pack_into(self.map, 0, RING_MAGIC, RING_VERSION, 0, len(self.data),
+                               len(self.starts), self.first, self.count, self.pos, self.used)
+
+   def close(self):
+      """(For a ring in a file) unmap it.  The Ring can't be used after this."""
+      if self.map is not None:
+         for view in (self.times, self.starts, self.lengths, self.data, self.view):
+            view.release()
+         self.map.close()
+         self.map = None
+
+   def __len__(self):
+      return self.count
+
+   def budget(self):
+      return len(self.data)
+
+   def memory(self):
+      """Bytes of memory (or file) the ring takes up (not counting the Python objects.)"""
+      return len(self.data) + (self.starts.itemsize * 2 + self.times.itemsize) * len(self.starts)
+
+   def append(self, line, when=None):
+      """Add `line' (bytes), which arrived at `when' (now, if None), dropping the oldest
+      lines until it fits.  A line longer than the whole buffer is cut down to size."""
+      if when is None:
+         when = time.time()
+
+      budget = len(self.data)
+      if len(line) > budget:
+         line = line[:budget]
+      n = len(line)
+
+      dropped = False
+      while self.count > 0 and (self.used + n > budget or self.count == len(self.starts)):
+         self.used -= self.lengths[self.first]
+         self.first = (self.first + 1) % len(self.starts)
+         self.count -= 1
+         dropped = True
+
+      # In a file, the header always describes lines that are all there: the ones
+      # about to be written over are let go of first, and the new one is only counted
+      # once it's been written.
+      if dropped:
+         self.save_header()
+
+      end = self.pos + n
+      if end <= budget:
+         self.data[self.pos:end] = line
+      else:
+         split = budget - self.pos
+         self.data[self.pos:] = line[:split]
+         self.data[:n - split] = line[split:]
+
+      i = (self.first + self.count) % len(self.starts)
+      self.starts[i] = self.pos
+      self.lengths[i] = n
+      self.times[i] = when
+      self.count += 1
+      self.used += n
+      self.pos = end % budget if budget > 0 else 0
+      self.save_header()
+
+   def extend(self, lines, when=None):
+      if when is None:
+         when = time.time()
+      for line in lines:
+         self.append(line, when)
+
+   def clear(self):
+      self.first = self.count = self.pos = self.used = 0
+      self.save_header()
+
+   def get(self, n):
+      """The `n'th oldest line."""
+      if n < 0:
+         n += self.count
+      if n < 0 or n >= self.count:
+         raise IndexError("scrollback line out of range")
+
+      i = (self.first + n) % len(self.starts)
+      return self.span(self.starts[i], self.lengths[i])
+
+   def length_of(self, n):
+      return self.lengths[(self.first + n) % len(self.starts)]
+
+   def time_of(self, n):
+      """When the `n'th oldest line arrived."""
+      return self.times[(self.first + n) % len(self.starts)]
+
+   def index_at(self, when):
+      """The index of the first line that arrived at or after `when' (len(self) if
+      none did.)"""
+      lo, hi = 0, self.count
+      while lo < hi:
+         mid = (lo + hi) // 2
+         if self.time_of(mid) < when:
+            lo = mid + 1
+         else:
+            hi = mid
+      return lo
+
+   def span(self, start, length):
+      """`length' bytes of data from `start' on, wrapping round if need be."""
+      end = start + length
+      if end <= len(self.data):
+         return bytes(self.data[start:end])
+      return bytes(self.data[start:]) + bytes(self.data[:end - len(self.data)])
+
+   def last(self, n):
+      """The last `n' lines (or all of them, if there aren't that many), oldest first."""
+      n = min(n, self.count)
+      return [self.get(x) for x in range(self.count - n, self.count)]
+
+   def lines_bytes(self, start, end):
+      """Lines `start' up to (not including) `end' all together, in one bytes object.
+      They're stored next to each other, so that's a slice (or two) of the buffer."""
+      start = max(start, 0)
+      end = min(end, self.count)
+      if start >= end:
+         return b''
+
+      i = (self.first + start) % len(self.starts)
+      length = 0
+      for x in range(end - start):
+         length += self.lengths[(i + x) % len(self.starts)]
+      return self.span(self.starts[i], length)
+
+   def last_bytes(self, n):
+      """The last `n' lines all together, in one bytes object."""
+      return self.lines_bytes(self.count - n, self.count)
+
 # The actual history-reading needs to be done by a filter.
 class MemoryFilter:
    def __init__(self, connection, options):
       global histories
 
       self.key = connection
-      histories[self.key] = collections.deque(maxlen=options['length'])
+      budget = options.get('bytes', DEFAULT_BYTES)
+
+      if 'file' in options:
+         # Kept on disk, from one run of the proxy to the next.
+         try:
+            name = connection.name
+         except AttributeError:
+            name = "client"
+         path = options['file'].replace('CONNECTION', name)
+
+         directory = os.path.dirname(path)
+         if directory != "":
+            os.makedirs(directory, exist_ok=True)
+
+         histories[self.key] = Ring.open(path, budget, options['length'])
+      else:
+         histories[self.key] = Ring(budget, options['length'])
 
    def from_server(self, line):
       global histories
 
-      histories[self.key].append(line)
+      histories[self.key].append(line.as_bytes())
 
       return line
 
+   def from_server_batch(self, lines):
+      global histories
+
+      histories[self.key].extend([line.as_bytes() for line in lines])
+
+      return lines
+
+   # Kept across a hot restart (see Proxy.hot_restart.)
+   def save_state(self):
+      global histories
+
+      history = histories[self.key]
+      if history.map is not None:
+         # It's all in the file already.
+         return {'file': history.path}
+
+      return {'data': history.last_bytes(len(history)),
+              'lengths': [history.length_of(x) for x in range(len(history))],
+              'times': [history.time_of(x) for x in range(len(history))]}
+
+   def restore_state(self, state):
+      global histories
+
+      if type(state) is list:
+         # (From before the times were kept.)
+         histories[self.key].extend(state)
+         return
+
+      if 'file' in state:
+         if histories[self.key].path == state['file']:
+            # (The old process went on adding to it after we opened it.)
+            histories[self.key].load_header()
+         return
+
+      start = 0
+      for length, when in zip(state['lengths'], state['times']):
+         histories[self.key].append(state['data'][start:start + length], when)
+         start += length
+
 # To show scrollback ...
+RECALL_AGO = re.compile(r'^(\d+)([smhd])$')
+RECALL_REGEX = re.compile(r'(?:^|\s)/(.+)/(?:\s|$)')   # (which may have spaces in)
+RECALL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+class RecallError(Exception):
+   pass
+
+def parse_recall_args(args, now):
+   """Make sense of what was asked for with ,recall: returns `(count, since, until,
+   pattern)', any of which may be None.  Raises RecallError."""
+   count = since = until = pattern = None
+   words = []
+
+   def ago(word):
+      match = RECALL_AGO.match(word)
+      if match is None:
+         raise RecallError("`{}' isn't a time like 30s, 10m, 2h or 1d.".format(word))
+      return now - int(match.group(1)) * RECALL_UNITS[match.group(2)]
+
+   match = RECALL_REGEX.search(args)
+   if match is not None:
+      try:
+         pattern = re.compile(match.group(1))
+      except re.error as e:
+         raise RecallError("Bad regular expression: {}".format(str(e)))
+      args = args[:match.start()] + ' ' + args[match.end():]
+
+   for word in args.split():
+      if word.isdigit():
+         count = int(word)
+      elif word[0].isdigit() and ('-' in word or RECALL_AGO.match(word)):
+         # `2h' is the last two hours; `2h-1h', from two hours ago until one hour ago.
+         since, sep, rest = word.partition('-')
+         since = ago(since)
+         if sep:
+            until = ago(rest)
+      else:
+         words.append(word)
+
+   if len(words) > 0:
+      if pattern is not None:
+         raise RecallError("Search for some text or a /regular expression/, not both.")
+      pattern = re.compile(re.escape(' '.join(words)), re.IGNORECASE)
+
+   return (count, since, until, pattern)
+
+def plain_text(line):
+   """The text of a line, without its colours."""
+   try:
+      return ''.join([chunk for chunk in line.as_spans() if type(chunk) is str])
+   except ansi.ANSIParsingError:
+      return line.as_str()
+
 def do_recall_scrollback(args, client):
-   """Print out recent history from the server.  Useful for new connections that are missing context."""
+   """Print out recent history from the server.  Useful for new connections that are missing context.  Takes any of: a number of lines (the last 50 with `50'), a time (`10m' for the last ten minutes; s, m, h and d work, and `2h-1h' is from two hours ago to one), and text or a /regular expression/ that the lines have to contain."""
+   if client.subscribedTo not in histories:
+      client.tell_err("No scrollback seems to exist for your current world.")
+      return
+
+   history = histories[client.subscribedTo]
+
+   try:
+      count, since, until, pattern = parse_recall_args(args, time.time())
+   except RecallError as e:
+      client.tell_err(str(e))
+      return
+
+   start = 0 if since is None else history.index_at(since)
+   end = len(history) if until is None else history.index_at(until)
+
+   if pattern is None:
+      if count is not None:
+         start = max(start, end - count)
+      data = history.lines_bytes(start, end)
+   else:
+      server = client.subscribedTo
+      found = [line for line in (history.get(x) for x in range(start, end))
+               if pattern.search(plain_text(server.make_line(line)))]
+      if count is not None:
+         found = found[-count:] if count > 0 else []
+      data = b''.join(found)
+
+   # All in one go, rather than a line at a time; but no more than the client has room
+   # for, or it would go over its high-water mark and the oldest of it, or the whole
+   # lot, would be thrown away (see Proxy.output_overflow.)
+   data = telnet.escape(data)
+   room = room_for(client)
+   if room is not None and len(data) > room:
+      lines = data.count(b'\n')
+      data = last_lines_within(data, room)
+      client.write_segment(data)
+      client.tell_err("Only the last {} of those {} lines fit in what can be sent to you at once.".format(
+         data.count(b'\n'), lines))
+      return
+
+   client.write_segment(data)
+   client.tell_ok("Done with scrollback.")
+
+# (For the messages after a replay.)
+REPLAY_MARGIN = 256
+
+def room_for(client):
+   """How many more bytes can be queued for `client' before it goes over its high-water
+   mark, or None if there's no limit."""
+   try:
+      high_water = client.high_water
+      backlog = client.pending_output()
+   except AttributeError:
+      return None
+
+   if high_water is None:
+      return None
+   return max(0, high_water - backlog - REPLAY_MARGIN)
+
+def last_lines_within(data, size):
+   """The whole lines at the end of `data' that fit in `size' bytes."""
+   if len(data) <= size:
+      return data
+   start = data.find(b'\n', len(data) - size - 1)
+   if start == -1 or start == len(data) - 1:
+      return b''
+   return data[start+1:]
+
+def do_scrollback_usage(args, client):
+   """Show how much of its scrollback space your current world is using."""
    if client.subscribedTo in histories:
-      history = histories[client.subscribedTo].copy()
-      while True:
-         try:
-            client.write_line(history.popleft())
-         except IndexError:
-            break
-      client.tell_ok("Done with scrollback.")
+      history = histories[client.subscribedTo]
+      if history.map is not None:
+         where = "in {}".format(history.path)
+      else:
+         where = "in memory"
+      client.tell_ok("{} lines of scrollback, {} of {} bytes ({} bytes {} in all.)".format(
+         len(history), history.used, history.budget(), history.memory(), where))
 
    else:
       client.tell_err("No scrollback seems to exist for your current world.")
@@ -39,3 +458,4 @@ def setup(proxy):
    proxy.register_filter("scrollback", MemoryFilter)
    proxy.register_command("recall", do_recall_scrollback)
    proxy.register_command("r", do_recall_scrollback)
+   proxy.register_command("scrollback", do_scrollback_usage)
@@ -4,19 +4,173 @@ import ansi
 import datetime
 import time
 import logging
+import threading
+import queue
 
 import os
 
 open_logs = []
 
+# Logs are written out by a thread of their own (a LogWriter, shared by all of them), so
+# the proxy never waits on the disk.  Each file is flushed once it has FLUSH_BYTES
+# waiting, or FLUSH_INTERVAL seconds after the first of them was written; both can be
+# set for each log, as `flush_bytes' and `flush_interval'.
+FLUSH_INTERVAL = 0.25 # seconds
+FLUSH_BYTES = 65536
+
+# How many batches of lines can be waiting for the writer.  If it falls that far
+# behind, more are dropped (and counted) rather than held up.
+QUEUE_MAX = 4096
+
+# When to fsync() a log (the `fsync' option): never, after every flush, or only when
+# it's closed.
+FSYNC_POLICIES = ('never', 'flush', 'close')
+
+class LogFile:
+    """A log file, as far as the LogWriter is concerned.  Only the writer's thread
+    touches one after it's been opened."""
+    def __init__(self, filehandle, flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL, fsync='never'):
+        self.filehandle = filehandle
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+
+        self.unflushed = 0        # characters written since the last flush
+        self.deadline = None      # when they have to be flushed by
+
+    def write(self, text):
+        self.filehandle.write(text)
+        self.unflushed += len(text)
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.flush_interval
+        if self.unflushed >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        self.filehandle.flush()
+        if self.fsync == 'flush':
+            os.fsync(self.filehandle.fileno())
+        self.unflushed = 0
+        self.deadline = None
+
+    def close(self):
+        self.filehandle.flush()
+        if self.fsync != 'never':
+            os.fsync(self.filehandle.fileno())
+        self.filehandle.close()
+        self.deadline = None
+
+class LogWriter(threading.Thread):
+    """Writes text to LogFiles, in the order it was given, from a thread of its own."""
+    def __init__(self, max_queued=QUEUE_MAX):
+        super().__init__(name="xlogs writer", daemon=True)
+        self.queue = queue.Queue(max_queued)
+        self.lock = threading.Lock()
+        self.dropped = 0    # batches there was no room for
+        self.errors = 0     # writes that failed
+        self.flushes = 0
+
+    def write(self, log, text, wait=False):
+        """Queue `text' to be written to `log'.  Returns False (and counts it) if there's
+        no room for it, unless told to `wait' for some."""
+        try:
+            self.queue.put((log, text), block=wait)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def close(self, log, text=''):
+        """Queue the last of `log', and closing it.  This waits for room rather than
+        dropping anything."""
+        self.queue.put((log, text))
+        self.queue.put((log, None))
+
+    def stop(self):
+        """Write out everything queued so far, and stop."""
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        dirty = set()   # logs with unflushed text
+
+        while True:
+            timeout = None
+            if len(dirty) > 0:
+                timeout = max(0, min(log.deadline for log in dirty) - time.monotonic())
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+
+            if item is None:
+                for log in dirty:
+                    self.flush(log)
+                return
+
+            if len(item) > 0:
+                log, text = item
+                try:
+                    if text is None:
+                        dirty.discard(log)
+                        log.close()
+                    else:
+                        log.write(text)
+                        if log.deadline is None:
+                            # (It's been flushed already, for being big.)
+                            self.flushes += 1
+                            dirty.discard(log)
+                        else:
+                            dirty.add(log)
+                except (OSError, ValueError) as e:
+                    logging.error("Can't write to log {}: {}".format(log.filehandle.name, e))
+                    self.errors += 1
+                    dirty.discard(log)
+
+            now = time.monotonic()
+            for log in [log for log in dirty if log.deadline <= now]:
+                self.flush(log)
+                dirty.discard(log)
+
+    def flush(self, log):
+        try:
+            log.flush()
+            self.flushes += 1
+        except (OSError, ValueError) as e:
+            logging.error("Can't flush log {}: {}".format(log.filehandle.name, e))
+            self.errors += 1
+
+writer = None
+
+def get_writer():
+    """The LogWriter, started the first time it's needed."""
+    global writer
+    if writer is None:
+        writer = LogWriter()
+        writer.start()
+    return writer
+
 class LoggingFilter:
+    # Only what the server says is logged.
+    passes_through = ('from_client',)
+
     def __init__(self, connection, options):
         print("Init with options {}".format(repr(options)))
         self.filename_template = options['filename']
         self.filename = None
-        self.filehandle = None
+        self.filehandle = None   # a LogFile
         self.xml = None
 
+        self.flush_bytes = options.get('flush_bytes', FLUSH_BYTES)
+        self.flush_interval = options.get('flush_interval', FLUSH_INTERVAL)
+        self.fsync = options.get('fsync', 'never')
+        if self.fsync not in FSYNC_POLICIES:
+            logging.error("Unknown fsync setting {} for xlogs; should be one of {}".format(
+                repr(self.fsync), ', '.join(FSYNC_POLICIES)))
+            self.fsync = 'never'
+
         # This is kind of hacky, but I don't know of a good way to get
         # access to the main code's types from within the modules it
         # imports, so I can't directly see if we're getting the right
@@ -26,6 +180,7 @@ class LoggingFilter:
             self.connection_name = connection.name
         except AttributeError:
             self.connection_name = "client"
+        self.connection = connection
 
         # (Try to) make sure there's a directory to put logs in.
         directory = os.path.dirname(self.get_new_filename())
@@ -45,11 +200,20 @@ class LoggingFilter:
 
         self.filename = self.get_new_filename()
 
+        # Reconnecting within the same minute gives the same name, so number the
+        # later logs instead of failing.
+        base, ext = os.path.splitext(self.filename)
+        n = 1
+
         try:
-            self.filehandle = open(self.filename, 'x')
-        except FileExistsError:
-            logging.error("Can't create logfile {}: it exists".format(self.filename))
-            raise
+            while self.filehandle is None:
+                try:
+                    # (Only ever flushed by the writer; see LogFile.)
+                    self.filehandle = LogFile(open(self.filename, 'x', buffering=self.flush_bytes),
+                                              self.flush_bytes, self.flush_interval, self.fsync)
+                except FileExistsError:
+                    n += 1
+                    self.filename = "{}-{}{}".format(base, n, ext)
         except FileNotFoundError:
             # This happens when it can't find the directory to put it in.
             logging.error("Can't create logfile {}: file not found (does the parent directory exist?)")
@@ -58,15 +222,10 @@ class LoggingFilter:
             logging.error("Can't create logfile {}: you don't have permission")
             raise
 
+        # What's written piles up in self.xml.xml until it's handed to the writer.
         self.xml = xmlwriter.XmlTagOutputter(indent='   ')
-
-        def addtext(text):
-            self.filehandle.write(text)
-
-        self.xml.write_callback = addtext
-        self.xml.buffer = False
-
         self.xml.open_tag("log")
+        get_writer().write(self.filehandle, self.take_xml(), wait=True)
 
         if self not in open_logs:
             open_logs.append(self)
@@ -78,7 +237,7 @@ class LoggingFilter:
             raise ValueError("Cannot close log when already closed")
 
         self.xml.close_all()
-        self.filehandle.close()
+        get_writer().close(self.filehandle, self.take_xml())
         self.filehandle = None
         self.xml = None
 
@@ -89,15 +248,41 @@ class LoggingFilter:
         if self.filehandle is None:
             self.open()
 
-        passthrough = line
+        self.write_line(line, datetime.datetime.utcnow().isoformat())
+        self.send(1)
 
-        self.xml.open_tag("line", {'date': datetime.datetime.utcnow().isoformat()})
+        return line
+
+    def from_server_batch(self, lines):
+        if self.filehandle is None:
+            self.open()
+
+        # (They all arrived at once.)
+        date = datetime.datetime.utcnow().isoformat()
+        for line in lines:
+            self.write_line(line, date)
+        self.send(len(lines))
+
+        return lines
+
+    def take_xml(self):
+        text = self.xml.xml
+        self.xml.xml = ""
+        return text
+
+    def send(self, lines):
+        """Hand what's been written (`lines' lines of it) to the writer."""
+        if not get_writer().write(self.filehandle, self.take_xml()):
+            try:
+                self.connection.stats['xlogs_dropped_lines'] += lines
+            except AttributeError:
+                pass
+
+    def write_line(self, line, date):
+        self.xml.open_tag("line", {'date': date})
 
         try:
-            # We replace '\r' and '\n' because the raw line as sent from the server
-            # may / will have some kind of trailing newline, and we don't want that
-            # in the logs -- the lines are already separated for us as it is.
-            line = ansi.parse_ANSI(line.as_str().replace('\r','').replace('\n',''))
+            line = line.as_spans()
 
         except ansi.ANSIParsingError as e:
             logging.warning("Error while trying to parse ANSI colors: {}".format(str(e)))
@@ -107,13 +292,13 @@ class LoggingFilter:
             # the ANSI codes), and repr() does that.
             #
             # ... still, this might possibly be not the best solution.
-            line = [repr(line.as_str())[1:-1]]
+            line = [repr(line.as_str().replace('\r','').replace('\n',''))[1:-1]]
 
         pending_text = None
         pending_colors = None
 
         for chunk in line:
-            if type(chunk) is dict:
+            if isinstance(chunk, dict):
                 if pending_colors is not None and pending_text is not None:
                     self.xml.inline_tag("text", pending_colors, pending_text)
                     pending_text = None
@@ -121,6 +306,13 @@ class LoggingFilter:
                 pending_colors = chunk
 
             elif type(chunk) is str:
+                # We remove '\r' and '\n' because the raw line as sent from the server
+                # may / will have some kind of trailing newline, and we don't want that
+                # in the logs -- the lines are already separated for us as it is.
+                chunk = chunk.replace('\r','').replace('\n','')
+                if len(chunk) == 0:
+                    continue
+
                 if pending_text is None:
                     pending_text = chunk
                 else:
@@ -136,25 +328,39 @@ class LoggingFilter:
             self.xml.inline_tag("text", pending_colors, pending_text)
 
         self.xml.close_tag()
-        self.filehandle.flush()
-
-        return passthrough
 
     def from_client(self, line):
         return line
 
     def server_connect(self, connected):
         if connected:
-            self.filename = self.get_new_filename()
-            logging.info("Opening new log {}".format(self.filename))
             self.open()
+            logging.info("Opened new log {}".format(self.filename))
         else:
             logging.warning("Closing log {}".format(self.filename))
             self.close()
 
+def do_log_usage(args, client):
+    """Show how the log writer is keeping up."""
+    if writer is None:
+        client.tell_ok("No logs have been written yet.")
+        return
+
+    client.tell_ok("{} logs open; {} batches of lines waiting to be written (at most {}).".format(
+        len(open_logs), writer.queue.qsize(), writer.queue.maxsize))
+    client.tell_ok("{} flushes; {} batches dropped for want of room; {} errors writing.".format(
+        writer.flushes, writer.dropped, writer.errors))
+
 def setup(proxy):
     proxy.register_filter("xlogs", LoggingFilter)
+    proxy.register_command("logs", do_log_usage)
 
 def teardown(proxy):
-    for log in open_logs:
+    global writer
+
+    for log in open_logs[:]:
         log.close()
+
+    if writer is not None:
+        writer.stop()
+        writer = None
@@ -1 +1 @@
-PYTHONPATH=. python3 core/proxy.py
\ No newline at end of file
+PYTHONPATH=. exec python3 core/proxy.py
\ No newline at end of file
@@ -0,0 +1,225 @@
+import unittest
+import unittest.mock
+import socket
+import ssl
+import selectors
+import collections
+import time
+
+import connector
+
+class TestDNSCache(unittest.TestCase):
+    def test_expiry(self):
+        cache = connector.DNSCache(ttl=10)
+        cache.put('example.org', 23, ['an address'], now=0)
+        self.assertEqual(cache.get('example.org', 23, now=5), ['an address'])
+        self.assertEqual(cache.get('example.org', 4000, now=5), None)
+        self.assertEqual(cache.get('example.org', 23, now=10), None)
+
+class TestHelpers(unittest.TestCase):
+    def test_interleave(self):
+        v6 = [(socket.AF_INET6, 0, 0, '', ('::%d' % n, 1)) for n in range(3)]
+        v4 = [(socket.AF_INET, 0, 0, '', ('10.0.0.%d' % n, 1)) for n in range(2)]
+        self.assertEqual(connector.interleave(v6 + v4),
+                         [v6[0], v4[0], v6[1], v4[1], v6[2]])
+
+    def test_backoff(self):
+        for failures in range(10):
+            delay = connector.backoff_delay(failures, 2, 60)
+            self.assertLessEqual(delay, min(60, 2 * 2 ** failures))
+            self.assertGreaterEqual(delay, min(60, 2 * 2 ** failures) / 2)
+
+class Latency(list):
+    def add(self, x):
+        self.append(x)
+
+class TestTLSContext(unittest.TestCase):
+    def test_unverified(self):
+        context = connector.make_tls_context()
+        self.assertIsInstance(context, connector.ResumingContext)
+        self.assertEqual(context.verify_mode, ssl.CERT_NONE)
+        self.assertFalse(context.check_hostname)
+
+    def test_verified(self):
+        context = connector.make_tls_context(verify=True)
+        self.assertEqual(context.verify_mode, ssl.CERT_REQUIRED)
+        self.assertTrue(context.check_hostname)
+
+    def test_offers_session(self):
+        context = connector.make_tls_context()
+        context.session = object()
+        # (A real session would be checked by OpenSSL; just see what's passed along.)
+        with unittest.mock.patch.object(ssl.SSLContext, 'wrap_bio') as wrap_bio:
+            context.wrap_bio(None, None, server_hostname='x')
+            self.assertIs(wrap_bio.call_args.kwargs['session'], context.session)
+
+            context.resume = False
+            context.wrap_bio(None, None, server_hostname='x')
+            self.assertIs(wrap_bio.call_args.kwargs.get('session'), None)
+
+class FakeServer:
+    def __init__(self, port):
+        self.host = '127.0.0.1'
+        self.port = port
+        self.use_SSL = False
+        self.connected = False
+        self.settings = {}
+        self.subscribers = []
+        self.stats = collections.Counter()
+        self.latency = collections.defaultdict(Latency)
+        self.warnings = []
+
+    def warn_all(self, msg):
+        self.warnings.append(msg)
+
+    def listened_to(self):
+        return len(self.subscribers) > 0
+
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when, self.callback, self.args = when, callback, args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Engine:
+    """Just enough of an event loop to drive a ConnectionManager."""
+    def __init__(self):
+        self.sel = selectors.DefaultSelector()
+        self.timers = []
+        self.soon = collections.deque()
+        self.ready = []
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.monotonic() + delay, callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.soon.append((callback, args))
+
+    def watch_fd(self, sock, events, callback):
+        try:
+            self.sel.modify(sock, events, callback)
+        except KeyError:
+            self.sel.register(sock, events, callback)
+
+    def unwatch_fd(self, sock):
+        try:
+            self.sel.unregister(sock)
+        except KeyError:
+            pass
+
+    def connection_ready(self, server, sock):
+        self.ready.append((server, sock))
+
+    def run_until(self, done, limit=5):
+        end = time.monotonic() + limit
+        while not done() and time.monotonic() < end:
+            for key, mask in self.sel.select(timeout=0.01):
+                key.data(key.fileobj, mask)
+            while len(self.soon) > 0:
+                callback, args = self.soon.popleft()
+                callback(*args)
+            for timer in list(self.timers):
+                if not timer.cancelled and timer.when <= time.monotonic():
+                    self.timers.remove(timer)
+                    timer.callback(*timer.args)
+
+class TestConnectionManager(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine()
+        self.manager = connector.ConnectionManager(self.engine, {'reconnect_delay': 0.05})
+
+    def tearDown(self):
+        self.manager.shutdown()
+
+    def test_connect(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        server = FakeServer(listener.getsockname()[1])
+
+        self.assertTrue(self.manager.connect(server))
+        self.assertFalse(self.manager.connect(server))
+        self.engine.run_until(lambda: len(self.engine.ready) > 0)
+
+        self.assertEqual(self.engine.ready[0][0], server)
+        self.assertEqual(len(server.latency['connect']), 1)
+        self.assertFalse(self.manager.connecting(server))
+
+        # The second time, the address comes out of the cache.
+        self.engine.ready[0][1].close()
+        self.manager.connect(server)
+        self.engine.run_until(lambda: len(self.engine.ready) > 1)
+        self.assertEqual(server.stats['dns_cache_hits'], 1)
+
+        for s in self.engine.ready:
+            s[1].close()
+        listener.close()
+
+    def test_resumption_savings(self):
+        import proxy
+        server = FakeServer(1)
+        server.latency = collections.defaultdict(proxy.LatencyHistogram)
+        self.assertEqual(self.manager.resumption_savings(server), None)
+        server.latency['tls_handshake'].add(0.010)
+        server.latency['tls_resumed'].add(0.002)
+        server.latency['tls_resumed'].add(0.004)
+        self.assertAlmostEqual(self.manager.resumption_savings(server), 14.0)
+
+    def test_refused_and_reconnect(self):
+        # Find a port nothing's listening on.
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+
+        server = FakeServer(port)
+        server.subscribers.append('someone')
+
+        self.manager.connect(server)
+        self.engine.run_until(lambda: server.stats['reconnects'] > 0)
+
+        self.assertGreaterEqual(server.stats['connect_failures'], 1)
+        self.assertIn("refused", server.warnings[0].lower())
+
+        # With nobody listening, it gives up.
+        server.subscribers.clear()
+        self.engine.run_until(lambda: len(self.manager.reconnect_timers) == 0 and not self.manager.connecting(server))
+        self.engine.run_until(lambda: False, limit=0.3)
+        self.assertEqual(self.manager.reconnect_timers, {})
+
+    def test_hung_up_on_straight_away(self):
+        # A server that accepts and then closes the connection straight away.
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        server = FakeServer(listener.getsockname()[1])
+        server.subscribers.append('someone')
+        server.settings['reconnect_delay'] = 0.01
+
+        self.manager.connect(server)
+        for n in range(1, 4):
+            self.engine.run_until(lambda: len(self.engine.ready) == n)
+            listener.accept()[0].close()
+            self.engine.ready[-1][1].close()
+            self.manager.connection_lost(server)
+            # ...is backed off from, each time for longer.
+            self.assertEqual(self.manager.failures[server], n)
+            self.assertEqual(server.stats['short_connections'], n)
+
+        # One that lasts long enough starts the count again.
+        server.settings['stable_after'] = 0
+        self.engine.run_until(lambda: len(self.engine.ready) == 4)
+        self.engine.ready[-1][1].close()
+        self.manager.connection_lost(server)
+        self.assertNotIn(server, self.manager.failures)
+
+        server.subscribers.clear()
+        self.engine.run_until(lambda: len(self.manager.reconnect_timers) == 0)
+        listener.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import unittest
+import queue
+import time
+import random
+import concurrent.futures
+
+import proxy
+
+class Upper:
+    def from_server(self, line):
+        return proxy.TextLine(line.as_str().upper(), 'utf-8')
+
+class DropShort:
+    def from_server(self, line):
+        if len(line.as_str()) < 3:
+            return None
+        return line
+
+class Doubling:
+    def from_server_batch(self, lines):
+        return [l for line in lines for l in (line, line)]
+
+class Broken:
+    def from_server(self, line):
+        raise ValueError("oops")
+
+    def from_server_batch(self, lines):
+        raise ValueError("oops")
+
+class ClientOnly:
+    def from_client(self, line):
+        return None
+
+class PassesThrough:
+    passes_through = ('from_server',)
+
+    def from_server(self, line):
+        raise AssertionError("shouldn't be called")
+
+    def from_client(self, line):
+        return None
+
+class TestRunFilters(unittest.TestCase):
+    def setUp(self):
+        self.s = proxy.FilteredSocket()
+
+    def run_filters(self, *lines):
+        result = self.s.run_filters('from_server', [proxy.TextLine(l, 'utf-8') for l in lines])
+        return [line.as_str() for line in result]
+
+    def test_per_line_and_batch(self):
+        self.s.filters = [Upper(), DropShort(), Doubling()]
+        self.s.compile_filters()
+        self.assertEqual(self.run_filters("abc", "d", "ef g"), ["ABC", "ABC", "EF G", "EF G"])
+
+    def test_errors_leave_lines_alone(self):
+        self.s.filters = [Broken(), Upper()]
+        self.s.compile_filters()
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(self.run_filters("abc"), ["ABC"])
+
+    def test_other_direction_skipped(self):
+        self.s.filters = [ClientOnly()]
+        self.s.compile_filters()
+        self.assertEqual(self.run_filters("abc"), ["abc"])
+
+    def test_passes_through(self):
+        self.s.filters = [PassesThrough(), Upper()]
+        self.s.compile_filters()
+        self.assertEqual(self.run_filters("abc"), ["ABC"])
+        self.assertEqual(self.s.run_filters('from_client', [proxy.TextLine("abc", 'utf-8')]), [])
+
+    def test_timings(self):
+        self.s.filters = [Upper(), DropShort()]
+        self.s.filter_names = ['upper']
+        self.s.compile_filters()
+        self.s.timing_every = 2
+        self.run_filters("abc", "d")
+        self.run_filters("e")
+        self.run_filters("fgh")
+        self.run_filters("ijk", "l")
+        timings = self.s.filter_timings()
+        self.assertEqual([(t.name, t.calls, t.lines) for t in timings],
+                         [('upper', 2, 3), ('DropShort', 2, 3)])
+
+class Slow:
+    def __init__(self, connection, options):
+        self.options = options
+
+    def from_server_batch(self, lines):
+        time.sleep(random.random() / 100)
+        return lines
+
+class Tagger:
+    def __init__(self, connection, options):
+        pass
+
+    def from_server(self, line):
+        return proxy.TextLine(line.as_str().rstrip() + " ok\n", 'utf-8')
+
+class Loop:
+    """Stands in for the Proxy: runs what the pool hands back when asked to."""
+    def __init__(self):
+        self.callbacks = queue.Queue()
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.callbacks.put((callback, args))
+
+    def update_events(self, wrapper):
+        pass
+
+    def run_one(self):
+        callback, args = self.callbacks.get(timeout=5)
+        callback(*args)
+
+class Sink:
+    def __init__(self):
+        self.data = b''
+
+    def write_segment(self, segment):
+        self.data += segment
+
+class TestOffload(unittest.TestCase):
+    def setUp(self):
+        self.server = proxy.RemoteServer("localhost", 1, "w")
+        self.server.add_filters([["slow", {"offload": True}], ["tagger", {}]],
+                                {"slow": Slow, "tagger": Tagger})
+        self.server.filter_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        self.server.watcher = self.loop = Loop()
+        self.sink = Sink()
+        self.server.subscribers.append(self.sink)
+
+    def tearDown(self):
+        self.server.filter_pool.shutdown()
+
+    def feed(self, n):
+        for x in range(n):
+            self.server.filter_lines([proxy.TextLine("{}a\n".format(x), 'utf-8'),
+                                      proxy.TextLine("{}b\n".format(x), 'utf-8')])
+
+    def test_stages(self):
+        self.assertEqual([(offloaded, len(chain)) for offloaded, chain in self.server.stages['from_server']],
+                         [(True, 1), (False, 1)])
+        self.assertEqual(self.server.filters[0].options, {})
+
+    def test_order_kept(self):
+        self.feed(10)
+        while self.server.offload_queued > 0:
+            self.loop.run_one()
+        expected = b''.join("{}a ok\n{}b ok\n".format(x, x).encode() for x in range(10))
+        self.assertEqual(self.sink.data, expected)
+
+    def test_backlog(self):
+        self.server.offload_high_water = 4
+        self.feed(3)
+        self.assertFalse(self.server.want_read())
+        while self.server.offload_queued > 2:
+            self.loop.run_one()
+        self.assertTrue(self.server.want_read())
+
+    def test_finish(self):
+        self.feed(3)
+        self.server.finish_offloaded()
+        self.assertEqual(self.server.offload_queued, 0)
+        self.assertEqual(self.sink.data.count(b" ok"), 6)
+        # The pool's answer for what it was doing is ignored when it gets here.
+        self.loop.run_one()
+        self.assertEqual(self.sink.data.count(b" ok"), 6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import unittest.mock
+import os
+import socket
+import tempfile
+import threading
+
+import handoff
+
+class TestHandoff(unittest.TestCase):
+    def test_encoding(self):
+        state = {'a': b"\xff\x00bytes", 'b': [1, {'c': b""}], 'd': {3, 1}}
+        self.assertEqual(handoff.loads(handoff.dumps(state)),
+                         {'a': b"\xff\x00bytes", 'b': [1, {'c': b""}], 'd': [1, 3]})
+
+    def test_pass_sockets(self):
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        a, b = socket.socketpair()
+        ours.settimeout(5)
+        theirs.settimeout(5)
+
+        # (Big enough that it won't go in one write.)
+        state = {'servers': {'x': {'fd': 0, 'state': b"y" * 500000}}}
+        sender = threading.Thread(target=handoff.send, args=(ours, state, [a.fileno()]))
+        sender.start()
+        received, fds = handoff.receive(theirs)
+        sender.join()
+
+        self.assertEqual(received, state)
+        self.assertEqual(len(fds), 1)
+
+        # The socket that came through is the same connection.
+        copy = socket.socket(fileno=fds[0])
+        copy.sendall(b"through the copy")
+        self.assertEqual(b.recv(100), b"through the copy")
+
+        for s in (ours, theirs, a, b, copy):
+            s.close()
+
+class TestNotify(unittest.TestCase):
+    def test_notify_systemd(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "notify")
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            listener.bind(path)
+            with unittest.mock.patch.dict(os.environ, {handoff.NOTIFY_ENV: path}):
+                handoff.notify_systemd("MAINPID=42")
+            self.assertEqual(listener.recv(100), b"MAINPID=42")
+            listener.close()
+
+    def test_not_under_systemd(self):
+        with unittest.mock.patch.dict(os.environ):
+            os.environ.pop(handoff.NOTIFY_ENV, None)
+            handoff.notify_systemd("READY=1")   # (does nothing)
+
+if __name__ == '__main__':
+    unittest.main()
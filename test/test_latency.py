@@ -0,0 +1,30 @@
+import unittest
+
+import proxy
+
+class TestLatencyHistogram(unittest.TestCase):
+    def setUp(self):
+        self.h = proxy.LatencyHistogram()
+
+    def test_buckets(self):
+        for seconds in [0.0005, 0.003, 0.003, 0.004, 7.0]:
+            self.h.add(seconds)
+        self.assertEqual(self.h.n, 5)
+        self.assertEqual(self.h.counts[0], 1)      # <= 1ms
+        self.assertEqual(self.h.counts[2], 3)      # <= 5ms
+        self.assertEqual(self.h.counts[-1], 1)     # > 5000ms
+
+    def test_percentiles(self):
+        for x in range(99):
+            self.h.add(0.015)
+        self.h.add(0.4)
+        self.assertEqual(self.h.percentile(50), 20)
+        self.assertEqual(self.h.percentile(99), 20)
+        self.assertEqual(self.h.percentile(100), 500)
+
+    def test_describe_empty(self):
+        self.assertEqual(self.h.describe(), "none yet")
+        self.assertEqual(self.h.percentile(50), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,303 @@
+import unittest
+import socket
+import zlib
+import asyncio
+
+import proxy
+
+class TestLineBuffering(unittest.TestCase):
+    def setUp(self):
+        self.c = proxy.LineBufferingSocketContainer()
+
+    def feed(self, *chunks):
+        lines = []
+        for chunk in chunks:
+            lines += [l.as_bytes() for l in self.c.feed(chunk)]
+        return lines
+
+    def test_split_lines(self):
+        self.assertEqual(
+                self.feed(b"one\r\ntwo\r\nthr", b"ee\r\n"),
+                [b"one\r\n", b"two\r\n", b"three\r\n"])
+
+    def test_strip_negotiation(self):
+        self.assertEqual(
+                self.feed(b"he\xff\xfb\x01llo\xff\xf9\n"),
+                [b"hello\n"])
+
+    def test_escaped_iac(self):
+        self.assertEqual(
+                self.feed(b"a\xff\xffb\n"),
+                [b"a\xffb\n"])
+
+    def test_command_split_across_reads(self):
+        self.assertEqual(
+                self.feed(b"abc\xff", b"\xfb", b"\x01def\n"),
+                [b"abcdef\n"])
+
+    def test_escaped_iac_split_across_reads(self):
+        self.assertEqual(
+                self.feed(b"abc\xff", b"\xffdef\n"),
+                [b"abc\xffdef\n"])
+    def test_mccp2(self):
+        self.c.accept_compression()
+        z = zlib.compressobj()
+        compressed = z.compress(b"squashed\r\n") + z.flush(zlib.Z_FINISH)
+        data = b"hi\r\n\xff\xfb\x56\xff\xfa\x56\xff\xf0" + compressed + b"plain\r\n"
+
+        self.assertEqual(
+                self.feed(data[:20], data[20:]),
+                [b"hi\r\n", b"squashed\r\n", b"plain\r\n"])
+        self.assertEqual(self.c.stats['mccp_compressed_bytes'], len(compressed))
+        self.assertEqual(self.c.stats['mccp_decompressed_bytes'], len(b"squashed\r\n"))
+
+    def test_mccp2_not_agreed(self):
+        data = b"hi\r\n\xff\xfa\x56\xff\xf0plain\r\n"
+        self.assertEqual(self.feed(data), [b"hi\r\n", b"plain\r\n"])
+
+        # Accepted, but never offered by the other end.
+        self.c = proxy.LineBufferingSocketContainer()
+        self.c.accept_compression()
+        self.assertEqual(self.feed(data), [b"hi\r\n", b"plain\r\n"])
+        self.assertEqual(self.c.decompressor, None)
+
+class TestDecoding(unittest.TestCase):
+    def feed(self, c, *chunks):
+        lines = []
+        for chunk in chunks:
+            lines += c.feed(chunk)
+        return lines
+
+    def test_decoded_as_they_come(self):
+        c = proxy.LineBufferingSocketContainer()
+        lines = self.feed(c, "caf\u00e9\r\nna\u00efve\r".encode('utf-8'), b"\n\x80x\n")
+        self.assertEqual([l.as_str() for l in lines], ["caf\u00e9\r\n", "na\u00efve\r\n", "?(128)x\n"])
+        self.assertEqual([l.as_bytes() for l in lines],
+                         [b"caf\xc3\xa9\r\n", b"na\xc3\xafve\r\n", b"\x80x\n"])
+
+    def test_stateful_encoding(self):
+        # The character set is only named at the start, so the second line can't be
+        # decoded by itself.
+        data = "\uc548\ub155\r\n\uc138\uacc4\r\n".encode('iso2022_kr')
+        c = proxy.LineBufferingSocketContainer()
+        c.set_encoding('iso2022_kr')
+        lines = self.feed(c, data[:12], data[12:])
+        self.assertEqual([l.as_str() for l in lines], ["\uc548\ub155\r\n", "\uc138\uacc4\r\n"])
+        self.assertNotEqual(lines[1].as_bytes().decode('iso2022_kr', 'replace'), "\uc138\uacc4\r\n")
+
+        # ... and a new process carries on where the old one left off.
+        c = proxy.LineBufferingSocketContainer()
+        c.set_encoding('iso2022_kr')
+        c.feed(data[:12])
+        d = proxy.LineBufferingSocketContainer()
+        d.set_encoding('iso2022_kr')
+        d.restore_state(c.save_state())
+        self.assertEqual([l.as_str() for l in d.feed(data[12:])], ["\uc138\uacc4\r\n"])
+
+        # ... but a new connection starts from scratch.
+        a, b = socket.socketpair()
+        c.attach_socket(a)
+        self.assertEqual([l.as_str() for l in c.feed(b"\x0e<<\x0f\r\n")], ["<<\r\n"])
+        a.close()
+        b.close()
+
+    def test_lazy(self):
+        c = proxy.LineBufferingSocketContainer()
+        c.decode = 'lazy'
+        c.set_encoding('latin-1')
+        self.assertEqual([l.as_str() for l in c.feed(b"caf\xe9\n")], ["caf\u00e9\n"])
+
+    def test_unknown_encoding(self):
+        c = proxy.LineBufferingSocketContainer()
+        with self.assertRaises(LookupError):
+            c.set_encoding('no-such-encoding')
+        self.assertEqual(c.encoding, proxy.ENCODING)
+
+class TestSaveState(unittest.TestCase):
+    def test_round_trip(self):
+        a = proxy.LineBufferingSocketContainer()
+        a.accept_compression()
+        self.assertEqual(len(a.feed(b"one\r\ntw")), 1)
+        state = a.save_state()
+
+        b = proxy.LineBufferingSocketContainer()
+        b.restore_state(state)
+        self.assertEqual([l.as_bytes() for l in b.feed(b"o\r\n")], [b"two\r\n"])
+        self.assertIn(86, b.telnet.supported_remote)
+
+    def test_not_while_compressed(self):
+        c = proxy.LineBufferingSocketContainer()
+        c.accept_compression()
+        c.feed(b"\xff\xfb\x56\xff\xfa\x56\xff\xf0")
+        self.assertEqual(c.save_state(), None)
+
+class TestOutputQueue(unittest.TestCase):
+    def test_advance_across_chunks(self):
+        q = proxy.OutputQueue()
+        for chunk in [b"abc", b"de", b"fghi"]:
+            q.append(chunk)
+        q.advance(4)
+        self.assertEqual(bytes(q.peek()), b"e")
+        q.advance(3)
+        self.assertEqual(bytes(q.peek()), b"hi")
+        self.assertEqual(len(q), 2)
+        q.advance(2)
+        self.assertEqual(len(q.chunks), 0)
+
+class TestWriting(unittest.TestCase):
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.theirs.settimeout(1)
+        self.c = proxy.LineBufferingSocketContainer(self.ours)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def test_hold_partial_line(self):
+        self.c.write(b"abc")
+        self.c.write(b"def\r\nghi")
+        self.assertEqual(self.theirs.recv(100), b"abcdef\r\n")
+        self.c.write_telnet(b"\xff\xf9")
+        self.assertEqual(self.theirs.recv(100), b"ghi\xff\xf9")
+
+    def test_cork(self):
+        self.c.cork = proxy.OutputCork()
+        self.c.cork.cork()
+        for x in range(3):
+            self.c.write_segment(b"line %d\r\n" % x)
+        self.theirs.setblocking(False)
+        self.assertRaises(BlockingIOError, self.theirs.recv, 100)
+
+        self.c.cork.uncork()
+        self.theirs.setblocking(True)
+        self.assertEqual(self.theirs.recv(100), b"line 0\r\nline 1\r\nline 2\r\n")
+
+    def test_shared_segment(self):
+        segment = b"to everyone\r\n"
+        self.c.write_segment(segment)
+        self.assertEqual(self.theirs.recv(100), segment)
+
+class Watcher:
+    def __init__(self):
+        self.calls = []
+
+    def update_events(self, conn):
+        self.calls.append(('update_events', conn.write_interest))
+
+    def output_overflow(self, conn):
+        self.calls.append(('output_overflow', conn.pending_output()))
+
+    def output_drained(self, conn):
+        self.calls.append(('output_drained', conn.pending_output()))
+
+class TestBackpressure(unittest.TestCase):
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.c = proxy.LineBufferingSocketContainer(self.ours)
+        self.c.watcher = Watcher()
+        self.c.high_water = 100000
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def fill(self):
+        line = b"x" * 99 + b"\n"
+        while not self.c.overflowed:
+            self.c.write_segment(line)
+
+    def test_write_interest_and_overflow(self):
+        self.fill()
+        calls = self.c.watcher.calls
+        self.assertEqual(calls[0], ('update_events', True))
+        self.assertEqual(calls[-1][0], 'output_overflow')
+        self.assertGreater(calls[-1][1], 100000)
+
+    def test_drain(self):
+        self.fill()
+        self.theirs.setblocking(False)
+        try:
+            while True:
+                self.theirs.recv(1 << 20)
+                self.c.flush()
+        except BlockingIOError:
+            pass
+        self.assertEqual(self.c.pending_output(), 0)
+        self.assertFalse(self.c.overflowed)
+        self.assertEqual(self.c.watcher.calls[-2:], [('update_events', False), ('output_drained', 0)])
+
+    def test_drop_oldest(self):
+        self.fill()
+        before = self.c.pending_output()
+        dropped = self.c.drop_oldest(50000)
+        self.assertLessEqual(self.c.pending_output(), 50000)
+        self.assertEqual(before - dropped, self.c.pending_output())
+
+class TestClientCompression(unittest.TestCase):
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.theirs.settimeout(1)
+        self.client = proxy.LocalClient(self.ours)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def test_negotiate_and_compress(self):
+        self.client.offer_compression()
+        self.assertEqual(self.theirs.recv(100), b"\xff\xfb\x56")
+
+        self.theirs.sendall(b"\xff\xfd\x56")
+        self.client.read()
+        self.assertEqual(self.theirs.recv(5), b"\xff\xfa\x56\xff\xf0")
+
+        self.client.write_str("hello\r\n")
+        self.assertEqual(zlib.decompressobj().decompress(self.theirs.recv(100)), b"hello\r\n")
+
+    def test_no_negotiation(self):
+        self.client.offer_compression()
+        self.theirs.recv(100)
+        self.client.write_str("hello\r\n")
+        self.assertEqual(self.theirs.recv(100), b"hello\r\n")
+
+class FakeTransport(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    def writelines(self, chunks):
+        self.writes.append(b''.join(chunks))
+
+    def get_write_buffer_size(self):
+        return 0
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.transport = FakeTransport()
+        self.c = proxy.LineBufferingSocketContainer(self.transport)
+        self.c.cork = proxy.LoopCork(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_one_write_per_pass(self):
+        self.c.write_str("one\r\n")
+        self.c.write_str("two\r\n")
+        self.assertEqual(self.transport.writes, [])
+
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.transport.writes, [b"one\r\ntwo\r\n"])
+        self.assertEqual(self.c.pending_output(), 0)
+
+    def test_still_corked_afterwards(self):
+        self.c.write_str("one\r\n")
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.c.write_str("two\r\n")
+        self.assertEqual(len(self.transport.writes), 1)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.transport.writes[1], b"two\r\n")
+
+if __name__ == '__main__':
+    unittest.main()
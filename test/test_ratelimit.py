@@ -0,0 +1,28 @@
+import unittest
+
+import proxy
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.r = proxy.RateLimiter(rate=1, burst=3)
+
+    def test_burst_then_limited(self):
+        self.assertEqual([self.r.allow('a', now=0) for x in range(4)],
+                         [True, True, True, False])
+        # Other keys have their own buckets.
+        self.assertTrue(self.r.allow('b', now=0))
+
+    def test_refill(self):
+        for x in range(3):
+            self.r.allow('a', now=0)
+        self.assertFalse(self.r.allow('a', now=0.5))
+        self.assertTrue(self.r.allow('a', now=1.5))
+        self.assertFalse(self.r.allow('a', now=1.6))
+
+    def test_forget_full(self):
+        self.r.allow('a', now=0)
+        self.r.forget_full(now=10)
+        self.assertEqual(self.r.buckets, {})
+
+if __name__ == '__main__':
+    unittest.main()
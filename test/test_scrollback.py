@@ -0,0 +1,150 @@
+import unittest
+import os
+import tempfile
+
+from plugins import scrollback
+
+class TestRing(unittest.TestCase):
+    def test_line_limit(self):
+        ring = scrollback.Ring(1000, 3)
+        ring.extend([b"one\r\n", b"two\r\n", b"three\r\n", b"four\r\n"])
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.last(10), [b"two\r\n", b"three\r\n", b"four\r\n"])
+        self.assertEqual(ring.get(-1), b"four\r\n")
+
+    def test_byte_budget_and_wrapping(self):
+        ring = scrollback.Ring(16, 100)
+        lines = [b"%d:abcde\n" % x for x in range(10)]
+        for x, line in enumerate(lines):
+            ring.append(line)
+            self.assertLessEqual(ring.used, 16)
+            # Whatever's left is the newest lines, intact, however they wrapped round.
+            self.assertEqual(ring.last(len(ring)), lines[x + 1 - len(ring):x + 1])
+            self.assertEqual(ring.last_bytes(len(ring)), b''.join(lines[x + 1 - len(ring):x + 1]))
+        self.assertEqual(len(ring), 2)
+
+    def test_last_bytes(self):
+        ring = scrollback.Ring(100, 10)
+        ring.extend([b"a\n", b"", b"bc\n", b""])
+        self.assertEqual(ring.last_bytes(3), b"bc\n")
+        self.assertEqual(ring.last_bytes(0), b"")
+        self.assertEqual(ring.last_bytes(99), b"a\nbc\n")
+
+    def test_huge_line(self):
+        ring = scrollback.Ring(8, 10)
+        ring.append(b"short\n")
+        ring.append(b"x" * 20)
+        self.assertEqual(ring.last(10), [b"x" * 8])
+
+    def test_times(self):
+        ring = scrollback.Ring(100, 10)
+        for x in range(5):
+            ring.append(b"%d\n" % x, 100.0 + x)
+        self.assertEqual(ring.index_at(102.0), 2)
+        self.assertEqual(ring.index_at(102.5), 3)
+        self.assertEqual(ring.index_at(0), 0)
+        self.assertEqual(ring.index_at(200), 5)
+        self.assertEqual(ring.lines_bytes(ring.index_at(101), ring.index_at(103)), b"1\n2\n")
+
+class TestRingFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "world.ring")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_reopen(self):
+        ring = scrollback.Ring.open(self.path, 16, 4)
+        self.assertEqual(len(ring), 0)
+        for x in range(6):
+            ring.append(b"%d:abc\n" % x, 100.0 + x)
+        ring.close()
+
+        ring = scrollback.Ring.open(self.path, 16, 4)
+        self.assertEqual(ring.last(10), [b"4:abc\n", b"5:abc\n"])
+        self.assertEqual(ring.time_of(1), 105.0)
+        ring.append(b"6\n")
+        self.assertEqual(ring.last_bytes(2), b"5:abc\n6\n")
+        ring.close()
+
+    def test_resize(self):
+        ring = scrollback.Ring.open(self.path, 100, 10)
+        ring.extend([b"one\n", b"two\n", b"three\n"], 50.0)
+        ring.close()
+
+        ring = scrollback.Ring.open(self.path, 12, 5)
+        self.assertEqual(ring.last(10), [b"two\n", b"three\n"])
+        self.assertEqual(ring.time_of(0), 50.0)
+        self.assertEqual(ring.budget(), 12)
+        ring.close()
+
+    def test_garbage(self):
+        with open(self.path, 'wb') as f:
+            f.write(b"\xff" * 5000)
+        ring = scrollback.Ring.open(self.path, 100, 10)
+        self.assertEqual(len(ring), 0)
+        ring.append(b"fresh\n")
+        self.assertEqual(ring.last(1), [b"fresh\n"])
+        ring.close()
+
+class TestRecallArgs(unittest.TestCase):
+    def test_parse(self):
+        parse = scrollback.parse_recall_args
+        self.assertEqual(parse("", 1000), (None, None, None, None))
+        self.assertEqual(parse("20 10m", 1000), (20, 400, None, None))
+        self.assertEqual(parse("2h-1h", 10000), (None, 10000 - 7200, 10000 - 3600, None))
+
+        count, since, until, pattern = parse("5 /^You (say|tell)/", 0)
+        self.assertEqual((count, pattern.pattern), (5, "^You (say|tell)"))
+
+        count, since, until, pattern = parse("the Dragon", 0)
+        self.assertTrue(pattern.search("You see THE DRAGON here."))
+
+    def test_errors(self):
+        for args in ["/(/", "3-x", "/x/ words"]:
+            with self.assertRaises(scrollback.RecallError):
+                scrollback.parse_recall_args(args, 0)
+
+class Client:
+    def __init__(self, world, high_water):
+        self.subscribedTo = world
+        self.high_water = high_water
+        self.sent = b""
+        self.said = []
+
+    def pending_output(self):
+        return len(self.sent)
+
+    def write_segment(self, data):
+        self.sent += data
+
+    def tell_ok(self, msg):
+        self.said.append(msg)
+
+    tell_err = tell_ok
+
+class TestRecall(unittest.TestCase):
+    def setUp(self):
+        self.world = object()
+        scrollback.histories[self.world] = scrollback.Ring(100000, 1000)
+        scrollback.histories[self.world].extend([b"line %03d\r\n" % x for x in range(100)])
+
+    def tearDown(self):
+        del scrollback.histories[self.world]
+
+    def test_all_of_it(self):
+        client = Client(self.world, None)
+        scrollback.do_recall_scrollback("", client)
+        self.assertEqual(client.sent.count(b"\n"), 100)
+        self.assertEqual(client.said, ["Done with scrollback."])
+
+    def test_cut_short(self):
+        # Room for the last 30 lines, after the margin for messages.
+        client = Client(self.world, scrollback.REPLAY_MARGIN + 30 * 10 + 5)
+        scrollback.do_recall_scrollback("", client)
+        self.assertEqual(client.sent, b"".join(b"line %03d\r\n" % x for x in range(70, 100)))
+        self.assertIn("30 of those 100", client.said[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import socket
+
+import shard
+import proxy
+
+class TestFrames(unittest.TestCase):
+    def test_split_anywhere(self):
+        stream = shard.frame(shard.LINE, 3, b"some text\r\n") + \
+                 shard.frame(shard.CONNECT, 0) + \
+                 shard.frame(shard.TELL_ERR, 65535, b"\xff" * 1000)
+
+        for step in (1, 7, 100, len(stream)):
+            reader = shard.FrameReader()
+            frames = []
+            for start in range(0, len(stream), step):
+                frames += reader.feed(stream[start:start+step])
+
+            self.assertEqual(frames, [shard.Frame(shard.LINE, 3, b"some text\r\n"),
+                                      shard.Frame(shard.CONNECT, 0, b""),
+                                      shard.Frame(shard.TELL_ERR, 65535, b"\xff" * 1000)])
+            self.assertEqual(len(reader.buffer), 0)
+
+    def test_command_and_reply(self):
+        self.assertEqual(shard.read_command(shard.command(7, 'recall', 'a b')), (7, 'recall', 'a b'))
+        self.assertEqual(shard.read_reply(shard.reply(7, b"%% Done.\r\n")), (7, b"%% Done.\r\n"))
+
+class TestAssign(unittest.TestCase):
+    def test_assign(self):
+        servers = {'d': {}, 'c': {'worker': 0}, 'b': {}, 'a': {}, 'e': {'worker': 9}}
+        self.assertEqual(shard.world_numbers(servers), {'a': 0, 'b': 1, 'c': 2, 'd': 3, 'e': 4})
+        # Turns go in name order, skipping worlds that say where they go (if they can.)
+        self.assertEqual(shard.assign(servers, 2), {'a': 0, 'b': 1, 'c': 0, 'd': 0, 'e': 1})
+
+class Link:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, kind, world, payload=b''):
+        self.sent.append(shard.Frame(kind, world, payload))
+
+class TestListening(unittest.TestCase):
+    def test_front_tells_worker(self):
+        link = Link()
+        server = proxy.ShardedServer("localhost", 4000, "world", link, 2)
+        ours, theirs = socket.socketpair()
+        a, b = proxy.LocalClient(ours), proxy.LocalClient(theirs)
+
+        server.subscribe(a)
+        server.subscribe(b)
+        server.unsubscribe(a)
+        self.assertEqual(link.sent, [shard.Frame(shard.LISTENING, 2, b'1')])
+        server.unsubscribe(b)
+        self.assertEqual(link.sent[1:], [shard.Frame(shard.LISTENING, 2, b'0')])
+        ours.close()
+        theirs.close()
+
+    def test_relay_only_counts_when_listened_to(self):
+        server = proxy.RemoteServer("localhost", 4000, "world")
+        relay = proxy.ShardRelay(Link(), 0)
+        server.subscribe(relay)
+        self.assertFalse(server.listened_to())
+        relay.listening = True
+        self.assertTrue(server.listened_to())
+
+if __name__ == '__main__':
+    unittest.main()
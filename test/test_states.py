@@ -0,0 +1,90 @@
+import unittest
+import unittest.mock
+import socket
+import ssl
+import concurrent.futures
+
+import proxy
+
+class Password:
+    def verify(self, attempt):
+        return attempt == "secret"
+
+class InlinePool:
+    """Checks passwords there and then, instead of in another thread."""
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+class TestClientStates(unittest.TestCase):
+    def setUp(self):
+        proxy.cfg = {'servers': {}, 'warn_about_connections': False}
+        with unittest.mock.patch.object(proxy, 'Password'), \
+             unittest.mock.patch.object(ssl.SSLContext, 'load_cert_chain'):
+            self.p = proxy.Proxy(proxy.cfg)
+        self.p.setup_clients()
+        self.p.password = Password()
+        self.p.auth_pool = InlinePool()
+
+        # What the auth pool hands back to the main loop waits here.
+        self.callbacks = []
+        self.p.call_soon_threadsafe = lambda callback, *args: self.callbacks.append((callback, args))
+
+        self.ours, self.theirs = socket.socketpair()
+        self.client = self.p.add_client(self.ours, ('127.0.0.1', 5000))
+
+        # What a client that's been let in gets done.
+        self.commands = []
+        self.p.register_command("note", lambda args, client: self.commands.append(args))
+
+    def tearDown(self):
+        self.theirs.close()
+        if self.ours in self.p.socket_wrappers:
+            self.p.close_connection(self.ours)
+
+    def send(self, *lines):
+        self.p.handle_lines(self.ours, [proxy.TextLine(l, 'utf-8') for l in lines])
+
+    def finish_verifying(self):
+        for callback, args in self.callbacks:
+            callback(*args)
+        self.callbacks = []
+
+    def test_log_in(self):
+        self.assertEqual(self.client.state, 'unauthenticated')
+        self.assertIn(self.ours, self.p.unauthenticated_sockets)
+
+        # What comes after the password waits until it's been checked.
+        self.send(b"secret\r\n", b",note look\r\n")
+        self.assertEqual(self.client.state, 'verifying')
+        self.assertIn(self.ours, self.p.verifying_sockets)
+        self.send(b",note north\r\n")
+        self.assertEqual(self.commands, [])
+
+        self.finish_verifying()
+        self.assertEqual(self.client.state, 'client')
+        self.assertIn(self.ours, self.p.client_sockets)
+        self.assertNotIn(self.ours, self.p.verifying_sockets)
+        self.assertEqual(self.commands, ["look", "north"])
+
+        # Once it's closed, it's in no state at all and anything left is ignored.
+        self.p.close_connection(self.ours)
+        self.assertIs(self.client.state, None)
+        for sockets, handler in self.p.states.values():
+            self.assertNotIn(self.ours, sockets)
+        self.send(b",note south\r\n")
+        self.assertEqual(self.commands, ["look", "north"])
+
+    def test_wrong_password(self):
+        self.send(b"guess\r\n")
+        self.finish_verifying()
+        self.assertEqual(self.client.state, 'unauthenticated')
+        self.assertEqual(self.p.stats['auth_failed'], 1)
+
+    def test_closed_while_verifying(self):
+        self.send(b"secret\r\n")
+        self.p.close_connection(self.ours)
+        self.finish_verifying()
+        self.assertIs(self.client.state, None)
+        self.assertEqual(self.p.stats['auth_ok'], 0)
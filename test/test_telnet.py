@@ -0,0 +1,71 @@
+import unittest
+
+import telnet
+
+class TestTelnetCodec(unittest.TestCase):
+    def setUp(self):
+        self.t = telnet.TelnetCodec(remote_options=[telnet.EOR])
+
+    def test_plain_text(self):
+        self.assertEqual(self.t.feed(b"hello\r\n"), (b"hello\r\n", []))
+
+    def test_escaped_iac(self):
+        self.assertEqual(self.t.feed(b"a\xff\xffb"), (b"a\xffb", []))
+
+    def test_command(self):
+        self.assertEqual(
+                self.t.feed(b"prompt> \xff\xf9"),
+                (b"prompt> ", [telnet.Command(telnet.GA)]))
+
+    def test_accept_supported_option(self):
+        text, events = self.t.feed(bytes([telnet.IAC, telnet.WILL, telnet.EOR]))
+        self.assertEqual(events, [telnet.OptionChange(telnet.EOR, False, True)])
+        self.assertEqual(self.t.take_output(), bytes([telnet.IAC, telnet.DO, telnet.EOR]))
+        self.assertIn(telnet.EOR, self.t.remote)
+
+        # Saying it again shouldn't get another answer.
+        self.t.feed(bytes([telnet.IAC, telnet.WILL, telnet.EOR]))
+        self.assertEqual(self.t.take_output(), b"")
+
+    def test_refuse_unsupported_option(self):
+        text, events = self.t.feed(bytes([telnet.IAC, telnet.DO, telnet.NAWS]))
+        self.assertEqual(events, [])
+        self.assertEqual(self.t.take_output(), bytes([telnet.IAC, telnet.WONT, telnet.NAWS]))
+
+    def test_no_answer_to_our_own_request(self):
+        self.t.request_remote(telnet.SGA)
+        self.assertEqual(self.t.take_output(), bytes([telnet.IAC, telnet.DO, telnet.SGA]))
+        text, events = self.t.feed(bytes([telnet.IAC, telnet.WILL, telnet.SGA]))
+        self.assertEqual(events, [telnet.OptionChange(telnet.SGA, False, True)])
+        self.assertEqual(self.t.take_output(), b"")
+
+    def test_subnegotiation(self):
+        self.assertEqual(
+                self.t.feed(b"a\xff\xfa\xc9Core.Hello {}\xff\xf0b"),
+                (b"ab", [telnet.Subnegotiation(201, b"Core.Hello {}")]))
+
+    def test_split_everywhere(self):
+        data = b"ab\xff\xff\xff\xfa\x18x\xff\xffy\xff\xf0c\xff\xfb\x19d"
+        text = b""
+        events = []
+        for x in range(len(data)):
+            t, e = self.t.feed(data[x:x+1])
+            text += t
+            events += e
+        self.assertEqual(text, b"ab\xffcd")
+        self.assertEqual(events, [telnet.Subnegotiation(24, b"x\xffy"),
+                                  telnet.OptionChange(telnet.EOR, False, True)])
+
+    def test_save_and_restore(self):
+        self.t.request_remote(telnet.SGA)
+        self.t.feed(bytes([telnet.IAC, telnet.WILL, telnet.EOR]) + b"\xff\xfa\x18par")
+        other = telnet.TelnetCodec()
+        other.restore_state(self.t.save_state())
+        self.assertEqual(other.remote, {telnet.EOR})
+        self.assertEqual(other.pending_remote, {telnet.SGA})
+        # It picks up in the middle of the subnegotiation.
+        self.assertEqual(other.feed(b"tial\xff\xf0ok"),
+                         (b"ok", [telnet.Subnegotiation(24, b"partial")]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+
+import proxy
+
+class TestTextLine(unittest.TestCase):
+    def test_bad_bytes(self):
+        line = proxy.TextLine(b"caf\xc3\xa9 \xff\xfeok\r\n", 'utf-8')
+        self.assertEqual(line.as_str(), "café ?(255)?(254)ok\r\n")
+
+    def test_cached_until_set(self):
+        line = proxy.TextLine(b"\x1b[31mred\x1b[0m\r\n", 'utf-8')
+        self.assertIs(line.as_str(), line.as_str())
+        self.assertEqual(line.as_spans(), [{'fg': 1}, "red", {}, "\r\n"])
+
+        line.set("plain\n")
+        self.assertEqual(line.as_bytes(), b"plain\n")
+        self.assertEqual(line.as_str(), "plain\n")
+        self.assertEqual(line.as_spans(), ["plain\n"])
+
+        line.set(b"\xe2\x80\x99\n")
+        self.assertEqual(line.as_str(), "’\n")
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            proxy.TextLine(b"x", 'utf-8').something = 1
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+import os
+import time
+import tempfile
+import collections
+import xml.etree.ElementTree
+
+import proxy
+from plugins import xlogs
+
+class Connection:
+    name = "world"
+
+    def __init__(self):
+        self.stats = collections.Counter()
+
+class TestLogWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "log")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def contents(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_in_order(self):
+        writer = xlogs.LogWriter()
+        writer.start()
+        log = xlogs.LogFile(open(self.path, 'x'), flush_bytes=10)
+        for x in range(100):
+            writer.write(log, "{}\n".format(x))
+        writer.close(log)
+        writer.stop()
+        self.assertEqual(self.contents(), ''.join("{}\n".format(x) for x in range(100)))
+        self.assertEqual(writer.dropped, 0)
+
+    def test_flushed_after_a_while(self):
+        writer = xlogs.LogWriter()
+        writer.start()
+        log = xlogs.LogFile(open(self.path, 'x', buffering=65536), flush_interval=0.01)
+        writer.write(log, "hello\n")
+        for x in range(100):
+            if self.contents() != "":
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.contents(), "hello\n")
+        writer.close(log)
+        writer.stop()
+
+    def test_drop_when_full(self):
+        writer = xlogs.LogWriter(max_queued=1)   # (not started)
+        log = xlogs.LogFile(open(self.path, 'x'))
+        self.assertTrue(writer.write(log, "one\n"))
+        self.assertFalse(writer.write(log, "two\n"))
+        self.assertEqual(writer.dropped, 1)
+        log.close()
+
+class TestLoggingFilter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        xlogs.teardown(None)
+        self.dir.cleanup()
+
+    def test_log(self):
+        f = xlogs.LoggingFilter(Connection(), {'filename': self.dir.name + "/CONNECTION.xml",
+                                               'fsync': 'close'})
+        f.server_connect(True)
+        lines = [proxy.TextLine(b"\x1b[1;32mhello\x1b[0m\r\n", 'utf-8'),
+                 proxy.TextLine(b"there\r\n", 'utf-8')]
+        self.assertEqual(f.from_server_batch(lines), lines)
+        f.from_server(lines[1])
+        f.server_connect(False)
+        xlogs.teardown(None)
+
+        log = xml.etree.ElementTree.parse(self.dir.name + "/world.xml").getroot()
+        self.assertEqual([line.findtext("text") for line in log], ["hello", "there", "there"])
+        self.assertEqual(log[0][0].attrib, {'fg': '2', 'bold': '1'})
+
+    def test_dropped_lines_counted(self):
+        connection = Connection()
+        f = xlogs.LoggingFilter(connection, {'filename': self.dir.name + "/CONNECTION.xml"})
+        xlogs.writer = xlogs.LogWriter(max_queued=2)   # (not started yet)
+        f.server_connect(True)
+        for x in range(3):
+            f.from_server_batch([proxy.TextLine(b"a\r\n", 'utf-8')] * 2)
+        self.assertEqual(connection.stats['xlogs_dropped_lines'], 4)
+        self.assertEqual(xlogs.writer.dropped, 2)
+
+        xlogs.writer.start()
+        f.server_connect(False)
+        xlogs.teardown(None)
+        log = xml.etree.ElementTree.parse(self.dir.name + "/world.xml").getroot()
+        self.assertEqual(len(log), 2)